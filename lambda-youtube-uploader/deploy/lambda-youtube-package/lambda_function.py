@@ -13,19 +13,10 @@ from lib.extract_video_meta import extra_video_meta
 from lib.json_file_generator import JsonFileGenerator
 from lib.taibif_api import query_multimedia_metadata
 from lib.upload_video import *
+from lib.video_index import add_uploaded_video, find_uploaded_video, save_video_index
 
 import pytz
 
-def search_list_by_keyword(client, **kwargs):
-  # See full sample for function
-  kwargs = remove_empty_kwargs(**kwargs)
-
-  response = client.search().list(
-    **kwargs
-  ).execute()
-
-  return response
-
 def check_if_video_exist(file_name, date_time_original, projectId, site, subSite, cameraLocation):
     """
     check if video exists in TaiBIF
@@ -147,25 +138,21 @@ def lambda_handler(event, context):
         url_md5 = CommenHelpers.to_md5_hexdigest(relative_url)
         print(relative_url)
         
-        found = search_list_by_keyword(client_instance,
-            part='snippet',
-            maxResults=1,
-            forMine=1,
-            q=url_md5,
-            type='video')
+        # the videos are titled with url_md5, look it up in the index of the uploaded videos
+        video_id = find_uploaded_video(client_instance, url_md5)
 
         upload_meta = [tags['projectId'], tags['projectTitle'], tags['site'], tags['subSite'], tags['cameraLocation'], url_md5]
 
         # if is_video_exist:
-        if found['pageInfo']['totalResults'] > 0:
-            if found['items'][0]['snippet']['title'] == url_md5:
-                video_id = found['items'][0]['id']['videoId']
-                print('{} was already uploaded. url: {}'.format(file_name, video_id))
+        if video_id is not None:
+            print('{} was already uploaded. url: {}'.format(file_name, video_id))
            
         else:
             # upload video
             args.title = url_md5
             video_id = initialize_upload(client_instance, args)
+            if video_id is not None:
+                add_uploaded_video(url_md5, video_id)
 
         # add video to target playlist
         youtube_url = '{}{}'.format(SYS_PARAMS.YOUTUBE_VIDEO_URL, video_id)
@@ -202,6 +189,10 @@ def lambda_handler(event, context):
     except Exception as e:
         print(e)
 
+    finally:
+        # the index changed by the sync and the upload is saved once
+        save_video_index()
+
     return {
         "statusCode": 200,
         "body": json.dumps('Success')
@@ -32,5 +32,10 @@ SYS_PARAMS = ObjDict({
     'CLIENT_ID': os.environ['CLIENT_ID'],
     'CLIENT_SECRET': os.environ['CLIENT_SECRET'],
     'REFRESH_TOKEN': os.environ['REFRESH_TOKEN'],
-    'TAIBIF_API_URL': os.environ['TAIBIF_API_URL']
+    'TAIBIF_API_URL': os.environ['TAIBIF_API_URL'],
+    # sqlite index of the uploaded videos, and its copy in SRC_BUCKET (empty to keep it in the container only,
+    # then every new container lists the whole uploads playlist). the key must not be under the prefix of
+    # the s3 upload notification
+    'VIDEO_INDEX_PATH': os.environ.get('VIDEO_INDEX_PATH', '/tmp/video-index.sqlite'),
+    'VIDEO_INDEX_KEY': os.environ.get('VIDEO_INDEX_KEY', '')
 })
@@ -0,0 +1,219 @@
+# ===========================================================
+# Index of the uploaded videos, title (url_md5) -> video id
+# A sqlite file seeded from the uploads playlist of the
+# channel and updated after every upload, so checking for a
+# duplicate is a local lookup instead of a search.list call.
+# Its copy in s3 is uploaded once per invocation if changed
+# ===========================================================
+
+import os
+import sqlite3
+
+import boto3
+import botocore
+
+from lib.sys_params import SYS_PARAMS
+
+# largest page of playlistItems.list
+PAGE_SIZE = 50
+
+_index = {'instance': None}
+
+class VideoIndex:
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS videos (title TEXT PRIMARY KEY, video_id TEXT NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        self.connection.commit()
+        self.changed = False # since the copy in s3 was saved
+
+    def get(self, title):
+        """
+        get the id of the video with a title
+
+        Args:
+            :title
+                string => video title, the url_md5 of the file
+
+        Return:
+            string => video id, None if not found
+        """
+
+        row = self.connection.execute('SELECT video_id FROM videos WHERE title = ?', (title,)).fetchone()
+        return row[0] if row is not None else None
+
+    def put_many(self, videos):
+        """
+        add videos, a title already in the index keeps its first video
+
+        Args:
+            :videos
+                list => (title, video id)
+
+        Return:
+            int => number of videos added
+        """
+
+        changes = self.connection.total_changes
+        self.connection.executemany('INSERT OR IGNORE INTO videos (title, video_id) VALUES (?, ?)', videos)
+        self.connection.commit()
+
+        added = self.connection.total_changes - changes
+        if added > 0:
+            self.changed = True
+        return added
+
+    def get_meta(self, name):
+        row = self.connection.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_meta(self, name, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, value))
+        self.connection.commit()
+        self.changed = True
+
+    def sync(self, client_instance):
+        """
+        add the videos uploaded since the last sync. the uploads playlist lists the newest
+        videos first, so the listing stops at the page with the newest video of the last
+        sync. the first sync lists the whole playlist
+
+        Args:
+            :client_instance
+                resource => youtube resource
+
+        Return:
+            int => number of videos added
+        """
+
+        uploads_playlist_id = self.get_meta('uploads_playlist_id')
+        if uploads_playlist_id is None:
+            channels = client_instance.channels().list(part='contentDetails', mine=True).execute()
+            uploads_playlist_id = channels['items'][0]['contentDetails']['relatedPlaylists']['uploads']
+            self.set_meta('uploads_playlist_id', uploads_playlist_id)
+
+        # videos added after their upload do not count, older uploads of other containers may be missing
+        last_synced_video_id = self.get_meta('last_synced_video_id')
+        newest_video_id = None
+
+        added = 0
+        next_page_token = None
+        while True:
+            kwargs = {'part': 'snippet', 'playlistId': uploads_playlist_id, 'maxResults': PAGE_SIZE}
+            if next_page_token is not None:
+                kwargs['pageToken'] = next_page_token
+            page = client_instance.playlistItems().list(**kwargs).execute()
+
+            videos = [(item['snippet']['title'], item['snippet']['resourceId']['videoId']) for item in page['items']]
+            if newest_video_id is None and len(videos) > 0:
+                newest_video_id = videos[0][1]
+
+            added += self.put_many(videos)
+
+            if any(video_id == last_synced_video_id for _, video_id in videos) or 'nextPageToken' not in page:
+                break
+
+            next_page_token = page['nextPageToken']
+
+        if newest_video_id is not None:
+            self.set_meta('last_synced_video_id', newest_video_id)
+
+        return added
+
+def get_s3_object():
+    # the sqlite file is kept in SRC_BUCKET, so a new container does not list the whole channel again.
+    # the key must be outside the prefix of the upload notification, or every save triggers the lambda
+    if not SYS_PARAMS.VIDEO_INDEX_KEY:
+        return None
+
+    return boto3.session.Session().resource('s3').Object(SYS_PARAMS.SRC_BUCKET, SYS_PARAMS.VIDEO_INDEX_KEY)
+
+def get_video_index():
+    """
+    get the video index of this container, the copy in s3 is downloaded on first use
+
+    Args:
+        None
+
+    Return:
+        object => VideoIndex
+    """
+
+    if _index['instance'] is None:
+        s3_object = get_s3_object()
+        if s3_object is None:
+            print('VIDEO_INDEX_KEY is not set, every new container lists the whole uploads playlist')
+
+        elif not os.path.exists(SYS_PARAMS.VIDEO_INDEX_PATH):
+            try:
+                s3_object.download_file(SYS_PARAMS.VIDEO_INDEX_PATH)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                    raise
+                print('No video index in s3, it is built from the uploads playlist')
+
+        _index['instance'] = VideoIndex(SYS_PARAMS.VIDEO_INDEX_PATH)
+
+    return _index['instance']
+
+def save_video_index():
+    """
+    upload the sqlite file to s3 if it changed, called once at the end of an invocation.
+    another container may overwrite it with an older copy, whose sync then lists the
+    videos it misses again
+
+    Args:
+        None
+
+    Return:
+        None
+    """
+
+    video_index = _index['instance']
+    if video_index is None or not video_index.changed:
+        return
+
+    s3_object = get_s3_object()
+    if s3_object is not None:
+        s3_object.upload_file(SYS_PARAMS.VIDEO_INDEX_PATH)
+    video_index.changed = False
+
+def find_uploaded_video(client_instance, title):
+    """
+    find the video with a title, from the index first, then from the videos uploaded since the last sync
+
+    Args:
+        :client_instance
+            resource => youtube resource
+        :title
+            string => video title, the url_md5 of the file
+
+    Return:
+        string => video id, None if the video was not uploaded
+    """
+
+    video_index = get_video_index()
+    video_id = video_index.get(title)
+    if video_id is None:
+        video_index.sync(client_instance)
+        video_id = video_index.get(title)
+
+    return video_id
+
+def add_uploaded_video(title, video_id):
+    """
+    add a video to the index right after it is uploaded
+
+    Args:
+        :title
+            string => video title, the url_md5 of the file
+        :video_id
+            string => the youtube video id
+
+    Return:
+        None
+    """
+
+    get_video_index().put_many([(title, video_id)])
@@ -0,0 +1,396 @@
+# ===========================================================
+# Bulk backfill for videos already in SRC_BUCKET
+# Usage:
+#   python backfill.py --prefix <prefix> --checkpoint <file>
+# An interrupted run resumes from the checkpoint file
+# ===========================================================
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+
+import lib.clients as Clients
+from lib.quota import set_quota_priority
+from lib.rate_limiter import set_bandwidth_limit
+from lib.sys_params import SYS_PARAMS
+
+# video extensions picked up by default, compared in lower case
+DEFAULT_EXTENSIONS = 'mp4,avi,mov,mts,m4v,wmv'
+
+# statuses that do not need to be processed again
+DONE_STATUSES = ('uploaded', 'exists')
+
+class Checkpoint:
+    """
+    progress of a backfill run, saved as json:
+        last_key => the most recently finished key
+        watermarks => per partition, every key up to this one is finished
+        done_partitions => partitions that are completely finished
+        keys => status of the finished keys after the watermarks, and of the failed keys.
+                the keys a watermark passes are dropped, so the file stays small
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {'last_key': None, 'watermarks': {}, 'done_partitions': [], 'keys': {}}
+
+        if os.path.exists(path):
+            with open(path, encoding='utf8') as f:
+                self.data.update(json.load(f))
+
+    def save(self):
+        """
+        write the checkpoint file, the old file is replaced in one step
+
+        Args:
+            None
+
+        Return:
+            None
+        """
+
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(self.data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def get_status(self, key):
+        return self.data['keys'].get(key)
+
+    def set_status(self, key, status):
+        self.data['keys'][key] = status
+        self.data['last_key'] = key
+
+    def clear_status(self, key):
+        self.data['keys'].pop(key, None)
+
+    def get_watermark(self, partition):
+        return self.data['watermarks'].get(partition)
+
+    def set_watermark(self, partition, key):
+        self.data['watermarks'][partition] = key
+
+    def is_partition_done(self, partition):
+        return partition in self.data['done_partitions']
+
+    def set_partition_done(self, partition):
+        if partition not in self.data['done_partitions']:
+            self.data['done_partitions'].append(partition)
+
+    def get_failed_keys(self):
+        return [key for key, status in self.data['keys'].items() if status == 'failed']
+
+def list_partitions(s3, bucket, prefix):
+    """
+    split the prefix into partitions, one for every 'sub folder' (upload session)
+
+    Args:
+        s3:
+            object => s3 client
+        bucket:
+            string => bucket name
+        prefix:
+            string => key prefix
+
+    Return:
+        list => (partition prefix, delimiter), the prefix itself only covers the objects directly under it
+    """
+
+    partitions = [(prefix, '/')]
+
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            partitions.append((common_prefix['Prefix'], ''))
+
+    return partitions
+
+def list_partition_keys(s3, bucket, partition, start_after, extensions):
+    """
+    list every video key of a partition, in lexicographical order
+
+    Args:
+        s3:
+            object => s3 client
+        bucket:
+            string => bucket name
+        partition:
+            tuple => (partition prefix, delimiter)
+        start_after:
+            string => only list keys after this one, None to list from the beginning
+        extensions:
+            tuple => video extensions in lower case
+
+    Return:
+        list => object keys
+    """
+
+    prefix, delimiter = partition
+    params = {'Bucket': bucket, 'Prefix': prefix}
+    if delimiter:
+        params['Delimiter'] = delimiter
+    if start_after:
+        params['StartAfter'] = start_after
+
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(**params):
+        for item in page.get('Contents', []):
+            if item['Key'].rsplit('.', 1)[-1].lower() in extensions:
+                keys.append(item['Key'])
+
+    return keys
+
+def backfill_keys(keys, bandwidth_limit):
+    """
+    run the lambda_handler stages for a batch of keys, runs in a child process.
+    the keys of a batch are processed concurrently and share their TaiBIF queries
+
+    Args:
+        keys:
+            list => object keys in SRC_BUCKET
+        bandwidth_limit:
+            int => upload bytes per second of this process, 0 for no limit
+
+    Return:
+        list => (key, status) of every key
+    """
+
+    from lambda_function import process_records
+
+    # every process keeps its clients for all of its keys
+    Clients.enable_reuse()
+    set_bandwidth_limit(bandwidth_limit)
+
+    # backfill leaves YOUTUBE_QUOTA_RESERVE units of the daily quota to the new videos
+    set_quota_priority('low')
+
+    # the keys are given the way s3 puts them in the event
+    records = [{'s3': {'bucket': {'name': SYS_PARAMS.SRC_BUCKET}, 'object': {'key': key}}} for key in keys]
+    results = process_records(records)
+    return [(key, result['status']) for key, result in zip(keys, results)]
+
+class Backfill:
+
+    def __init__(self, checkpoint, processes, list_threads, save_every, batch_size=1):
+        self.checkpoint = checkpoint
+        self.processes = processes
+        self.list_threads = list_threads
+        self.save_every = save_every
+        self.batch_size = max(1, batch_size)
+        self.max_in_flight = processes * 4 # batches
+
+        # every process uploads at the same time, so each one gets an equal share of the limit
+        self.bandwidth_limit = SYS_PARAMS.UPLOAD_BANDWIDTH_LIMIT // processes
+        if SYS_PARAMS.UPLOAD_BANDWIDTH_LIMIT > 0:
+            self.bandwidth_limit = max(1, self.bandwidth_limit)
+
+        self.executor = None
+        self.in_flight = {} # future => [(partition, key)] of its batch
+        self.batch = [] # (partition, key) waiting to be submitted
+        self.pending = {} # partition => keys waiting for the watermark, in listing order
+        self.listed = set() # partitions whose keys are all submitted
+        self.submitted = set()
+        self.finished_count = 0
+        self.quota_reached = False # no more keys are submitted after a key is deferred for the quota
+
+    def run(self, s3, bucket, prefix, extensions, retry_failed):
+        """
+        process every video under the prefix which is not finished yet
+
+        Args:
+            s3:
+                object => s3 client for listing
+            bucket:
+                string => bucket name
+            prefix:
+                string => key prefix
+            extensions:
+                tuple => video extensions in lower case
+            retry_failed:
+                bool => process the failed keys of the last run again
+
+        Return:
+            collections.Counter => number of keys per status
+        """
+
+        counter = collections.Counter()
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.processes) as executor:
+            self.executor = executor
+
+            if retry_failed:
+                for key in self.checkpoint.get_failed_keys():
+                    self.submit(None, key, counter)
+                self.flush(counter)
+
+            partitions = [partition for partition in list_partitions(s3, bucket, prefix)
+                          if not self.checkpoint.is_partition_done(partition[0])]
+            print('{} partitions to process'.format(len(partitions)))
+
+            # list a few partitions at the same time while the processes are working
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.list_threads) as list_executor:
+                for start in range(0, len(partitions), self.list_threads):
+                    if self.quota_reached:
+                        break
+
+                    window = partitions[start:start + self.list_threads]
+                    listed = list_executor.map(
+                        lambda partition: list_partition_keys(s3, bucket, partition,
+                                                              self.checkpoint.get_watermark(partition[0]),
+                                                              extensions),
+                        window)
+
+                    for partition, keys in zip(window, listed):
+                        self.pending[partition[0]] = collections.deque()
+                        for key in keys:
+                            self.submit(partition[0], key, counter)
+                        self.listed.add(partition[0])
+                        self.advance_watermark(partition[0])
+
+                    self.flush(counter)
+
+            while len(self.in_flight) > 0:
+                self.wait_one(counter)
+
+        self.checkpoint.save()
+        return counter
+
+    def submit(self, partition, key, counter):
+        if partition is not None:
+            self.pending[partition].append(key)
+
+        if key in self.submitted or self.quota_reached:
+            return
+
+        if self.checkpoint.get_status(key) in DONE_STATUSES:
+            counter['skipped'] += 1
+            return
+
+        # an unfinished key must hold the watermark of its partition
+        self.checkpoint.clear_status(key)
+        self.submitted.add(key)
+        self.batch.append((partition, key))
+
+        if len(self.batch) >= self.batch_size:
+            self.flush(counter)
+
+    def flush(self, counter):
+        """
+        submit the keys waiting in the current batch
+
+        Args:
+            counter:
+                collections.Counter => number of keys per status
+
+        Return:
+            None
+        """
+
+        if len(self.batch) == 0:
+            return
+
+        while len(self.in_flight) >= self.max_in_flight:
+            self.wait_one(counter)
+
+        batch = self.batch
+        self.batch = []
+        future = self.executor.submit(backfill_keys, [key for _, key in batch], self.bandwidth_limit)
+        self.in_flight[future] = batch
+
+    def wait_one(self, counter):
+        done, _ = concurrent.futures.wait(list(self.in_flight), return_when=concurrent.futures.FIRST_COMPLETED)
+
+        for future in done:
+            batch = self.in_flight.pop(future)
+            try:
+                statuses = dict(future.result())
+            except Exception as e:
+                print('{}: {}'.format(', '.join(key for _, key in batch), e))
+                statuses = {}
+
+            for partition, key in batch:
+                status = statuses.get(key, 'failed')
+                print('{}: {}'.format(key, status))
+                counter[status] += 1
+
+                if status == 'deferred':
+                    if not self.quota_reached:
+                        print('YouTube quota budget reached, run the same command again after the quota is reset')
+                    self.quota_reached = True
+
+                    # a deferred key is not finished, it holds the watermark of its partition.
+                    # a key of --retry-failed has no partition, it stays failed for the next run
+                    if partition is None:
+                        self.checkpoint.set_status(key, 'failed')
+                    else:
+                        continue
+                else:
+                    self.checkpoint.set_status(key, status)
+
+                if partition is not None:
+                    self.advance_watermark(partition)
+
+                self.finished_count += 1
+                if self.finished_count % self.save_every == 0:
+                    self.checkpoint.save()
+
+    def advance_watermark(self, partition):
+        """
+        move the watermark over the leading keys which are finished, failed ones included
+        since they stay in the checkpoint for --retry-failed. a partition is done when all
+        of its keys are listed and finished
+
+        Args:
+            partition:
+                string => partition prefix
+
+        Return:
+            None
+        """
+
+        keys = self.pending[partition]
+        while len(keys) > 0 and self.checkpoint.get_status(keys[0]) is not None:
+            key = keys.popleft()
+            self.checkpoint.set_watermark(partition, key)
+
+            # the listing starts after the watermark, only --retry-failed still needs the key
+            if self.checkpoint.get_status(key) in DONE_STATUSES:
+                self.checkpoint.clear_status(key)
+
+        if len(keys) == 0 and partition in self.listed:
+            self.checkpoint.set_partition_done(partition)
+            del self.pending[partition]
+
+def main():
+    parser = argparse.ArgumentParser(description='Upload the videos already in SRC_BUCKET')
+    parser.add_argument('--prefix', required=True, help='key prefix to backfill, e.g. upload/')
+    parser.add_argument('--checkpoint', default='backfill-checkpoint.json')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--list-threads', type=int, default=4)
+    parser.add_argument('--extensions', default=DEFAULT_EXTENSIONS, help='comma separated video extensions')
+    parser.add_argument('--save-every', type=int, default=20, help='save the checkpoint every n finished keys')
+    parser.add_argument('--retry-failed', action='store_true', help='process the failed keys of the last run again')
+    parser.add_argument('--batch-size', type=int, default=SYS_PARAMS.TAIBIF_MAX_BATCH_SIZE,
+                        help='keys handed to a process at once, they are uploaded by its MAX_WORKERS threads and '
+                             'queried from TaiBIF together, TAIBIF_MAX_BATCH_SIZE by default')
+    args = parser.parse_args()
+
+    checkpoint = Checkpoint(args.checkpoint)
+    extensions = tuple(ext.strip().lower() for ext in args.extensions.split(',') if ext.strip())
+    s3 = Clients.get_boto3_session().client('s3')
+
+    backfill = Backfill(checkpoint, args.processes, args.list_threads, args.save_every, args.batch_size)
+    try:
+        counter = backfill.run(s3, SYS_PARAMS.SRC_BUCKET, args.prefix, extensions, args.retry_failed)
+    except KeyboardInterrupt:
+        checkpoint.save()
+        print('Interrupted, run the same command again to resume')
+        raise
+
+    print('backfill finished: {}'.format(dict(counter)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# ===============================================================
+# Report the slowest imports of the lambda package, like
+# python -X importtime but sorted and summarized
+# Usage:
+#   python import_report.py
+#   python import_report.py --module lib.upload_video --top 30
+#   python import_report.py --budget-ms 300 --json report.json
+# ===============================================================
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+def measure_imports(module, cwd):
+    """
+    import a module in a fresh interpreter with -X importtime
+
+    Args:
+        module:
+            string => module to import
+        cwd:
+            string => working directory of the interpreter
+
+    Return:
+        list => dict of name, self_us, cumulative_us, depth for every imported module
+    """
+
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                          cwd=cwd,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+    if proc.returncode != 0:
+        raise SystemExit('Unable to import {}:\n{}'.format(module, proc.stderr))
+
+    # lines look like "import time:       628 |      40747 |       requests"
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+
+        name = fields[2].rstrip()
+        imports.append({
+            'name': name.strip(),
+            'self_us': int(fields[0]),
+            'cumulative_us': int(fields[1]),
+            'depth': (len(name) - len(name.lstrip())) // 2
+        })
+
+    return imports
+
+def print_report(module, imports, top):
+    """
+    print the total import time and the slowest imports
+
+    Args:
+        module:
+            string => the imported module
+        imports:
+            list => result of measure_imports
+        top:
+            int => number of imports to list
+
+    Return:
+        None
+    """
+
+    total_us = sum(item['cumulative_us'] for item in imports if item['depth'] == 0)
+    print('{}: {} modules, {:.1f} ms in total'.format(module, len(imports), total_us / 1000))
+
+    print('\nslowest by cumulative time:')
+    for item in sorted(imports, key=lambda item: item['cumulative_us'], reverse=True)[:top]:
+        print('  {:>10.1f} ms  {}'.format(item['cumulative_us'] / 1000, item['name']))
+
+    print('\nslowest by self time:')
+    for item in sorted(imports, key=lambda item: item['self_us'], reverse=True)[:top]:
+        print('  {:>10.1f} ms  {}'.format(item['self_us'] / 1000, item['name']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the slowest imports of the lambda package')
+    parser.add_argument('--module', action='append', help='module to import, lambda_function by default')
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--json', help='write the full measurement to this file')
+    parser.add_argument('--budget-ms', type=float, help='exit with an error if a module takes longer to import')
+    args = parser.parse_args()
+
+    modules = args.module or ['lambda_function']
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    report = {}
+    over_budget = []
+    for module in modules:
+        imports = measure_imports(module, cwd)
+        print_report(module, imports, args.top)
+        print('')
+
+        total_ms = sum(item['cumulative_us'] for item in imports if item['depth'] == 0) / 1000
+        report[module] = {'total_ms': total_ms, 'imports': imports}
+        if args.budget_ms is not None and total_ms > args.budget_ms:
+            over_budget.append(module)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
+
+    if len(over_budget) > 0:
+        raise SystemExit('Over the import budget of {} ms: {}'.format(args.budget_ms, ', '.join(over_budget)))
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,53 @@
 import argparse
+import concurrent.futures
 import json
+import os
 from lib.sys_params import SYS_PARAMS
-import urllib
-
-import boto3
-import botocore
-from googleapiclient.errors import HttpError
+import urllib.parse
 
+# googleapiclient and the json generator are imported by the stages which
+# need them, so a duplicated video never pays for loading them
 import lib.s3_helpers as S3Helpers
 import lib.common_helpers as CommenHelpers
-from lib.extract_video_meta import extra_video_meta
-from lib.json_file_generator import JsonFileGenerator
-from lib.taibif_api import query_multimedia_metadata
-from lib.upload_video import *
+from lib.clients import get_youtube_service
+from lib.content_hash import ContentHasher, find_uploaded_content, save_uploaded_content
+from lib.extract_video_meta import extra_s3_video_meta
+from lib.job_queue import SqsQueue, get_s3_records_from_sqs_message
+from lib.latency import print_latency_report
+from lib.object_index import (delete_pending_playlist_item, find_pending_playlist_item,
+                              find_processed_object, save_pending_playlist_item, save_processed_object)
+from lib.quota import UPLOAD_QUOTA_COST, QuotaDeferred, print_quota_metric, quota_reservation
+from lib.retry_policy import DeadlineExceeded, set_deadline
+from lib.s3_stream import S3RangeReader
+from lib.taibif_api import invalidate_multimedia_metadata, prefetch_multimedia_metadata, query_multimedia_metadata_cached
 
 import pytz
 
+# the worker pool lives as long as the container, so its threads and the
+# YouTube resources they keep are reused by warm invocations
+_executor = None
+
+def create_taibif_query(file_name, date_time_original, projectId, site, subSite, cameraLocation):
+    """
+    create the arguments of a TaiBIF media query
+
+    Args:
+        file_name: 
+            string => video file name
+        original_datetime: 
+            datetime =>  video original datetime 
+        projectId, site, subSite, cameraLocation: 
+            string =>  from object tags
+
+    Return:
+        tuple => file name, original datetime in timestamp, full location after md5
+    """
+
+    location_path = CommenHelpers.generate_location_path(projectId, site, subSite, cameraLocation)
+    return (file_name,
+            int(pytz.timezone('Asia/Taipei').localize(date_time_original).timestamp()),
+            CommenHelpers.to_md5_hexdigest(location_path))
+
 def check_if_video_exist(file_name, date_time_original, projectId, site, subSite, cameraLocation):
     """
     check if video exists in TaiBIF
@@ -43,8 +75,7 @@ def check_if_video_exist(file_name, date_time_original, projectId, site, subSite
 
     # check if this video has been uploaded or not
     # if the video was already uploaded, then dismiss the job
-    location_path = CommenHelpers.generate_location_path(projectId, site, subSite, cameraLocation)
-    result = query_multimedia_metadata(file_name, int(pytz.timezone('Asia/Taipei').localize(date_time_original).timestamp()), CommenHelpers.to_md5_hexdigest(location_path))
+    result = query_multimedia_metadata_cached(*create_taibif_query(file_name, date_time_original, projectId, site, subSite, cameraLocation))
 
     if 'results' in result and result['results'] is not None and len(result['results']) > 0:
         is_video_exist = True
@@ -71,22 +102,26 @@ def set_default_value(target_dict):
     target_dict.setdefault('cameraLocation', 'NULL')
     target_dict.setdefault('userId', 'NULL')
 
-def lambda_handler(event, context):  
-    print('event: {}'.format(event))
-    
-    event_key = urllib.parse.unquote(event['Records'][0]['s3']['object']['key'])
-    session_id, file_name = S3Helpers.split_file_name(event_key)
-    tags = S3Helpers.obtain_object_tags_from_s3(event_key)
-    set_default_value(tags)
+def generate_upload_args(file_path, file_name, tags):
+    """
+    create the upload options of a single video
 
-    print('session_id: {}'.format(session_id))
-    print('file_name: {}'.format(file_name))
-    print('tags: {}'.format(tags))
+    Args:
+        file_path: 
+            string => path of the downloaded video
+        file_name: 
+            string => video file name
+        tags: 
+            dict => tags of the s3 object
+
+    Return:
+        object => upload options
+    """
 
     parser = argparse.ArgumentParser()
 
     # path of the file location
-    parser.add_argument('--file', default=CommenHelpers.get_full_download_path(file_name))
+    parser.add_argument('--file', default=file_path)
 
     # video title on YouTube
     parser.add_argument('--title', default=file_name)
@@ -102,66 +137,447 @@ def lambda_handler(event, context):
 
     # set if this video is public or private. options: 'public', 'private', 'unlisted'
     parser.add_argument('--privacyStatus', default='public')
-    args = parser.parse_args()
 
-    # download file to /tmp
-    S3Helpers.download_file_to_tmp(SYS_PARAMS.SRC_BUCKET, file_name, event_key)
+    # every record has its own defaults, so command line arguments are not parsed here
+    return parser.parse_args([])
 
-    # get video metadata
-    video_meta = extra_video_meta(CommenHelpers.get_full_download_path(file_name))
+def generate_json_files(youtube_url, playlist_id, tags, file_name, session_id, video_meta, content_hash, object_key=''):
+    """
+    create the mma/mmm json files of a video and upload them to s3 bucket
+
+    Args:
+        youtube_url: 
+            string => url of the video on YouTube
+        playlist_id: 
+            string => the youtube playlist id
+        tags: 
+            dict => tags of the s3 object
+        file_name: 
+            string => video file name
+        session_id: 
+            string => upload session id
+        video_meta: 
+            dict => result of extra_s3_video_meta
+        content_hash: 
+            dict => sha256 and md5 of the video, None if unknown
+        object_key: 
+            string => s3 key of a copy of an uploaded video, its records get their own _id
+
+    Return:
+        None
+    """
+
+    from lib.json_file_generator import JsonFileGenerator
+
+    json_gen = JsonFileGenerator(bucket=SYS_PARAMS.SRC_BUCKET,
+                                youtube_url=youtube_url,
+                                youtube_playlist_id=playlist_id,
+                                projectId=tags['projectId'],
+                                projectTitle=tags['projectTitle'],
+                                site=tags['site'],
+                                subSite=tags['subSite'],
+                                cameraLocation=tags['cameraLocation'],
+                                video_name=file_name,
+                                video_length=video_meta['duration'],
+                                video_org_datetime=video_meta['date_time_original'],
+                                video_mod_datetime=video_meta['date_last_modification'],
+                                video_width=video_meta['width'],
+                                video_height=video_meta['height'],
+                                userId=tags['userId'],
+                                upload_session_id=session_id,
+                                device_metadata=video_meta['device_metadata'],
+                                exif=video_meta['exif'], 
+                                make=video_meta['make'],
+                                model=video_meta['model'],
+                                content_hash=content_hash,
+                                object_key=object_key)
+
+    json_gen.do_process()
+
+    # the cached 'not found' of this video is stale now
+    invalidate_multimedia_metadata(*create_taibif_query(file_name,
+                                                        video_meta['date_time_original'],
+                                                        tags['projectId'],
+                                                        tags['site'],
+                                                        tags['subSite'],
+                                                        tags['cameraLocation']))
+
+def get_record_key(record):
+    """
+    get the decoded object key of a s3 event record
+
+    Args:
+        record: 
+            dict => one item of event['Records']
+
+    Return:
+        string => object key
+    """
+
+    return urllib.parse.unquote(record['s3']['object']['key'])
+
+def get_result_key(record):
+    """
+    get the object key of a record for its result, a record without one is
+    reported as failed by process_record instead of stopping the batch
+
+    Args:
+        record: 
+            object => one item of event['Records']
+
+    Return:
+        string => object key, '' if the record has none
+    """
+
+    try:
+        return get_record_key(record)
+    except (KeyError, TypeError, AttributeError):
+        return ''
+
+def inspect_record(record):
+    """
+    read what the duplicate checks of a s3 record need, nothing is downloaded
+
+    Args:
+        record: 
+            dict => one item of event['Records']
+
+    Return:
+        dict => tags, head, pending_item and processed_object of the object, video_meta and
+                taibif_query unless the object was uploaded before
+    """
+
+    event_key = get_record_key(record)
+    _, file_name = S3Helpers.split_file_name(event_key)
+    tags = S3Helpers.obtain_object_tags_from_s3(event_key)
+    set_default_value(tags)
+
+    # get video metadata from the headers only, nothing is downloaded before the duplicate check
+    head = S3Helpers.get_object_head(SYS_PARAMS.SRC_BUCKET, event_key)
+
+    # the same object was processed before, e.g. a redelivered event or the same file
+    # in another upload session, which is known from the head and the tags alone
+    inspection = {'tags': tags, 'head': head, 'pending_item': find_pending_playlist_item(event_key),
+                  'processed_object': find_processed_object(head, tags), 'video_meta': None, 'taibif_query': None}
+
+    if inspection['pending_item'] is None and inspection['processed_object'] is None:
+        video_meta = extra_s3_video_meta(SYS_PARAMS.SRC_BUCKET, event_key, head)
+        inspection['video_meta'] = video_meta
+        inspection['taibif_query'] = create_taibif_query(file_name,
+                                                         video_meta['date_time_original'],
+                                                         tags['projectId'],
+                                                         tags['site'],
+                                                         tags['subSite'],
+                                                         tags['cameraLocation'])
+
+    return inspection
+
+def process_record(record, inspection=None):
+    """
+    download, check, upload and create json files for a single s3 record
+
+    Args:
+        record: 
+            dict => one item of event['Records']
+        inspection: 
+            dict => result of inspect_record, the record is inspected here if not given
+
+    Return:
+        dict => result of this record
+    """
+
+    event_key = get_record_key(record)
+    session_id, file_name = S3Helpers.split_file_name(event_key)
+
+    if inspection is None:
+        inspection = inspect_record(record)
+    tags = inspection['tags']
+    head = inspection['head']
+
+    print('session_id: {}'.format(session_id))
+    print('file_name: {}'.format(file_name))
+    print('tags: {}'.format(tags))
+
+    # records of the same batch may share a file name, so keep them apart in the temporary directory
+    local_name = '{}_{}'.format(session_id, file_name)
+    local_path = CommenHelpers.get_full_download_path(local_name)
+    args = generate_upload_args(local_path, file_name, tags)
+    args.stream = None
+
+    try:
+        # an earlier attempt uploaded the video but ran out of time before adding it to its playlist
+        pending_item = inspection['pending_item']
+        if pending_item is not None:
+            from lib.upload_video import add_playlist_item
+
+            print('{} was uploaded as {}, adding it to playlist {}'.format(file_name, pending_item['video_id'], pending_item['playlist_id']))
+            add_playlist_item(get_youtube_service(), pending_item['playlist_id'], pending_item['video_id'], tags['cameraLocation'])
+            delete_pending_playlist_item(event_key)
+            return {'key': event_key, 'status': 'uploaded', 'url': pending_item['url'], 'error': None}
+
+        processed_object = inspection['processed_object']
+        if processed_object is not None:
+            print('{} was already processed as {}. url: {}'.format(file_name, processed_object['key'], processed_object['url']))
+            return {'key': event_key, 'status': 'exists', 'url': processed_object['url'], 'error': None}
+
+        video_meta = inspection['video_meta']
+
+        # check if this video has been uploaded or not
+        # if the video was already uploaded, then dismiss the job
+        is_video_exist, youtube_url = check_if_video_exist(file_name, 
+                                                video_meta['date_time_original'], 
+                                                tags['projectId'], 
+                                                tags['site'], 
+                                                tags['subSite'], 
+                                                tags['cameraLocation'])
+        if is_video_exist:
+            print('{} was already uploaded. url: {}'.format(file_name, youtube_url))
+            save_processed_object(head, tags, youtube_url, event_key)
+            return {'key': event_key, 'status': 'exists', 'url': youtube_url, 'error': None}
+
+        # the content is hashed while it is read, renamed copies of a video have the same hash
+        hasher = ContentHasher()
+        content_hash = None
+
+        if SYS_PARAMS.STREAM_UPLOAD:
+            # read the object with ranged GETs while uploading it, nothing is written to /tmp
+            args.stream = S3RangeReader(SYS_PARAMS.SRC_BUCKET, event_key, head['ContentLength'],
+                                        SYS_PARAMS.STREAM_BLOCK_SIZE, SYS_PARAMS.STREAM_READ_AHEAD,
+                                        hasher=hasher)
+            args.mimetype = CommenHelpers.guess_video_mimetype(file_name, head.get('ContentType'))
+        else:
+            # download file to /tmp
+            S3Helpers.download_file_to_tmp(SYS_PARAMS.SRC_BUCKET, local_name, event_key, head['ContentLength'], hasher)
+            content_hash = hasher.hexdigests()
+
+            # the hash is known before uploading, so a copy under another name costs no quota
+            uploaded_content = find_uploaded_content(content_hash)
+            if uploaded_content is not None:
+                print('{} has the same content as {}. url: {}'.format(file_name, uploaded_content['key'], uploaded_content['url']))
+
+                # the copy gets records of its own in TaiBIF, keyed by its object key so the
+                # records of the uploaded video are not overwritten, pointing at the same video
+                generate_json_files(uploaded_content['url'], uploaded_content.get('playlist_id', ''),
+                                    tags, file_name, session_id, video_meta, content_hash, event_key)
+                save_processed_object(head, tags, uploaded_content['url'], event_key)
+                return {'key': event_key, 'status': 'exists', 'url': uploaded_content['url'], 'error': None}
+
+        # a redelivered event continues the upload session of the same object version
+        args.session_key = 'upload-session:{}:{}'.format(event_key, head['ETag'].strip('"'))
+
+        from lib.upload_video import initialize_upload, add_video_to_playlist, finish_upload_session
 
-    # check if this video has been uploaded or not
-    # if the video was already uploaded, then dismiss the job
-    is_video_exist, youtube_url = check_if_video_exist(file_name, 
-                                            video_meta['date_time_original'], 
-                                            tags['projectId'], 
-                                            tags['site'], 
-                                            tags['subSite'], 
-                                            tags['cameraLocation'])
-    if is_video_exist:
-        print('{} was already uploaded. url: {}'.format(file_name, youtube_url))
-    else:
         # get authorization
-        client_instance = get_authenticated_service()
+        client_instance = get_youtube_service()
 
-        try:
+        # the projected quota of the upload is reserved first, it is deferred if it would not fit today
+        with quota_reservation(UPLOAD_QUOTA_COST, 'uploading {}'.format(file_name)):
             # upload video
             video_id = initialize_upload(client_instance, args)
-        
+            youtube_url = '{}{}'.format(SYS_PARAMS.YOUTUBE_VIDEO_URL, video_id)
+
+            # a streamed upload which resumed a session did not read every byte, so it has no hash
+            if SYS_PARAMS.STREAM_UPLOAD and args.stream.is_hash_complete():
+                content_hash = hasher.hexdigests()
+
             # add video to target playlist
             playlist_id = add_video_to_playlist(client_instance, video_id, tags['cameraLocation'])
 
-            # create mma/mmm json file and upload to s3 bucket
-            json_gen = JsonFileGenerator(bucket=SYS_PARAMS.SRC_BUCKET,
-                                        youtube_url='{}{}'.format(SYS_PARAMS.YOUTUBE_VIDEO_URL, video_id),
-                                        youtube_playlist_id=playlist_id,
-                                        projectId=tags['projectId'],
-                                        projectTitle=tags['projectTitle'],
-                                        site=tags['site'],
-                                        subSite=tags['subSite'],
-                                        cameraLocation=tags['cameraLocation'],
-                                        video_name=file_name,
-                                        video_length=video_meta['duration'],
-                                        video_org_datetime=video_meta['date_time_original'],
-                                        video_mod_datetime=video_meta['date_last_modification'],
-                                        video_width=video_meta['width'],
-                                        video_height=video_meta['height'],
-                                        userId=tags['userId'],
-                                        upload_session_id=session_id,
-                                        device_metadata=video_meta['device_metadata'],
-                                        exif=video_meta['exif'], 
-                                        make=video_meta['make'],
-                                        model=video_meta['model'])
-
-            json_gen.do_process()
-
-        except HttpError as e:
-            print('An HTTP error %d occurred:\n%s' % (e.resp.status, e.content))
-
-        except Exception as e:
-            print(e)
+        # create mma/mmm json file and upload to s3 bucket
+        generate_json_files(youtube_url, playlist_id, tags, file_name, session_id, video_meta, content_hash)
+
+        # the indexes short-circuit the redelivered events, so they are written once the json files exist
+        if content_hash is not None:
+            save_uploaded_content(content_hash, youtube_url, video_id, event_key, playlist_id)
+        save_processed_object(head, tags, youtube_url, event_key)
+        finish_upload_session(args.session_key)
+
+        return {'key': event_key, 'status': 'uploaded', 'url': youtube_url, 'error': None}
+
+    finally:
+        if args.stream is not None:
+            args.stream.close()
+
+        # free the space of /tmp for the other records
+        if os.path.exists(local_path):
+            os.remove(local_path)
+
+def print_record_error(event_key, error):
+    """
+    print the error of a failed record
+
+    Args:
+        event_key: 
+            string => object key of the record
+        error: 
+            exception => the error raised by process_record
+
+    Return:
+        None
+    """
+
+    from googleapiclient.errors import HttpError
+
+    if isinstance(error, HttpError):
+        print('An HTTP error %d occurred:\n%s' % (error.resp.status, error.content))
+    else:
+        print('{}: {}'.format(event_key, error))
+
+def process_records(records):
+    """
+    process s3 records concurrently with a bounded worker pool
+
+    Args:
+        records: 
+            list => items of event['Records']
+
+    Return:
+        list => result of every record, in the same order as records
+    """
+
+    global _executor
+
+    results = [None] * len(records)
+    if len(records) == 0:
+        return results
+
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, SYS_PARAMS.MAX_WORKERS))
+
+    # every record is inspected first, so the TaiBIF queries of the batch are sent together
+    inspections = [None] * len(records)
+    inspect_futures = {_executor.submit(inspect_record, record): index for index, record in enumerate(records)}
+    for future in concurrent.futures.as_completed(inspect_futures):
+        # a record which could not be inspected is inspected again by process_record, which reports the error
+        if future.exception() is None:
+            inspections[inspect_futures[future]] = future.result()
+
+    prefetch_multimedia_metadata([inspection['taibif_query'] for inspection in inspections
+                                  if inspection is not None and inspection['taibif_query'] is not None])
+
+    futures = {_executor.submit(process_record, record, inspections[index]): index for index, record in enumerate(records)}
+
+    for future in concurrent.futures.as_completed(futures):
+        index = futures[future]
+        event_key = get_result_key(records[index])
+
+        try:
+            results[index] = future.result()
+
+        # the upload session is saved after every chunk, the redelivered record continues it
+        except DeadlineExceeded as e:
+            print('{} deferred: {}'.format(event_key, e))
+            results[index] = {'key': event_key, 'status': 'deferred', 'url': '', 'error': str(e)}
+
+        # the quota is used up for today, the record is tried again after the reset
+        except QuotaDeferred as e:
+            print('{} deferred: {}'.format(event_key, e))
+            results[index] = {'key': event_key, 'status': 'deferred', 'url': '', 'error': str(e)}
+
+        # a failed record must not stop the other records
+        except (Exception, SystemExit) as e:
+            print_record_error(event_key, e)
+            results[index] = {'key': event_key, 'status': 'failed', 'url': '', 'error': str(e)}
+
+    # the uploaded videos were queued for their playlists, they are added with a few batch requests
+    if SYS_PARAMS.PLAYLIST_ITEMS_BATCH:
+        from lib.upload_video import flush_playlist_items
+        defer_playlist_items(results, flush_playlist_items(get_youtube_service()))
+
+    return results
+
+def defer_playlist_items(results, deferred_items):
+    """
+    mark the records whose playlist items could not be sent before the deadline as deferred,
+    their items are kept in the state store for the redelivered records
+
+    Args:
+        results:
+            list => result of every record, changed in place
+        deferred_items:
+            list => pairs returned by flush_playlist_items
+
+    Return:
+        None
+    """
+
+    deferred_items = {'{}{}'.format(SYS_PARAMS.YOUTUBE_VIDEO_URL, item['video_id']): item for item in deferred_items}
+
+    for result in results:
+        item = deferred_items.get(result['url']) if result['status'] == 'uploaded' else None
+        if item is None:
+            continue
+
+        if not save_pending_playlist_item(result['key'], item['playlist_id'], item['video_id'], result['url']):
+            print('Video {} is not added to playlist {}, STATE_STORE is needed to add it later'.format(item['video_id'], item['playlist_id']))
+
+        print('{} deferred: playlistItems.insert of {} did not fit before the deadline'.format(result['key'], item['video_id']))
+        result['status'] = 'deferred'
+        result['error'] = 'playlistItems.insert deferred'
+
+def lambda_handler(event, context):  
+    print('event: {}'.format(event))
+    set_deadline(context)
+
+    results = process_records(event['Records'])
+    print('results: {}'.format(results))
+    print_latency_report()
+    print_quota_metric()
+
+    deferred_records = [record for record, result in zip(event['Records'], results) if result['status'] == 'deferred']
+    if len(deferred_records) > 0:
+        # lambda retries an asynchronous event twice within minutes, far less than a quota day,
+        # the queue keeps the deferred records until they are uploaded or its redrive policy gives up
+        if SYS_PARAMS.DEFERRED_QUEUE_URL:
+            message_id = SqsQueue(SYS_PARAMS.DEFERRED_QUEUE_URL).put(deferred_records, SYS_PARAMS.DEFERRED_DELAY_SECONDS)
+            print('{} deferred records sent to {} as {}'.format(len(deferred_records), SYS_PARAMS.DEFERRED_QUEUE_URL, message_id))
+
+        # fail the invocation so lambda retries the event, the finished records are found by the duplicate check
+        else:
+            deferred_keys = [get_record_key(record) for record in deferred_records]
+            raise DeadlineExceeded('Deferred to the next attempt: {}'.format(', '.join(deferred_keys)))
 
     return {
         "statusCode": 200,
-        "body": json.dumps('Success')
+        "body": json.dumps(results)
+    }
+
+def sqs_batch_handler(event, context):
+    """
+    entry point for the sqs event source mapping
+
+    the mapping should enable ReportBatchItemFailures, so only the messages
+    listed in batchItemFailures are redelivered. the batch size (10 by default,
+    more with a batching window) is configured on the mapping itself.
+    """
+
+    print('event: {}'.format(event))
+    set_deadline(context)
+
+    failed_message_ids = []
+    message_records = []
+
+    for message in event['Records']:
+        try:
+            for record in get_s3_records_from_sqs_message(message):
+                message_records.append((message['messageId'], record))
+
+        # get_s3_records_from_sqs_message checks the type of the body, AttributeError is
+        # caught as well so no malformed message can fail the other messages of the batch
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            print('Unable to read message {}: {}'.format(message['messageId'], e))
+            failed_message_ids.append(message['messageId'])
+
+    results = process_records([record for _, record in message_records])
+    print('results: {}'.format(results))
+    print_latency_report()
+    print_quota_metric()
+
+    # a message is redelivered if any of its records failed or ran out of time
+    for (message_id, _), result in zip(message_records, results):
+        if result['status'] in ('failed', 'deferred') and message_id not in failed_message_ids:
+            failed_message_ids.append(message_id)
+
+    return {
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]
     }
@@ -0,0 +1,108 @@
+# ===========================================================
+# Chunk size of chunked YouTube uploads
+# Grows with the measured throughput, halves on errors and
+# never exceeds the memory ceiling
+# ===========================================================
+
+# ===========================
+#        Properties
+# ===========================
+
+# YouTube accepts chunks in multiples of 256KB, only the last chunk may be shorter
+CHUNK_GRANULARITY = 256 * 1024
+
+# weight of the latest chunk in the measured throughput
+THROUGHPUT_WEIGHT = 0.3
+
+class ChunkSizer:
+    """
+    multiplicative increase / multiplicative decrease of the chunk size:
+    a chunk is sized to take about target_seconds at the measured throughput,
+    at most twice the previous one, and the size is halved after an error
+    """
+
+    def __init__(self, initial_size, max_size, target_seconds):
+        """
+        Args:
+            initial_size:
+                int => size of the first chunk in bytes
+            max_size:
+                int => memory ceiling of a chunk in bytes
+            target_seconds:
+                float => time a chunk should take, a failed chunk costs at most this long
+        """
+
+        self.max_size = max(CHUNK_GRANULARITY, max_size // CHUNK_GRANULARITY * CHUNK_GRANULARITY)
+        self.target_seconds = target_seconds
+        self.throughput = None # bytes per second
+        self.errors = 0
+        self.chunk_size = self.clamp(initial_size)
+
+    def clamp(self, size):
+        """
+        round the size down to a multiple of 256KB within [256KB, max_size]
+
+        Args:
+            size:
+                int => chunk size in bytes
+
+        Return:
+            int => valid chunk size
+        """
+
+        size = int(size) // CHUNK_GRANULARITY * CHUNK_GRANULARITY
+        return max(CHUNK_GRANULARITY, min(self.max_size, size))
+
+    def record_success(self, sent_bytes, elapsed):
+        """
+        size the next chunk from the throughput of the chunk just sent
+
+        Args:
+            sent_bytes:
+                int => bytes confirmed by YouTube for this chunk
+            elapsed:
+                float => seconds the chunk took
+
+        Return:
+            None
+        """
+
+        if sent_bytes <= 0:
+            return
+
+        throughput = sent_bytes / max(elapsed, 0.001)
+        if self.throughput is None:
+            self.throughput = throughput
+        else:
+            self.throughput = THROUGHPUT_WEIGHT * throughput + (1 - THROUGHPUT_WEIGHT) * self.throughput
+
+        self.chunk_size = self.clamp(min(self.chunk_size * 2, self.throughput * self.target_seconds))
+
+    def fit(self, seconds):
+        """
+        shrink the next chunk so it can be sent within the given time
+
+        Args:
+            seconds:
+                float => time left
+
+        Return:
+            None
+        """
+
+        if self.throughput is not None and self.chunk_size > self.throughput * seconds:
+            self.chunk_size = self.clamp(self.throughput * seconds)
+
+    def record_error(self):
+        """
+        halve the chunk size after a failed chunk
+
+        Args:
+            None
+
+        Return:
+            None
+        """
+
+        self.errors += 1
+        self.chunk_size = self.clamp(self.chunk_size // 2)
@@ -0,0 +1,227 @@
+# ===========================================================
+# Clients for boto3, requests, urllib3 and YouTube
+# Built lazily once per container / process and reused by the
+# following invocations, until their credentials expire
+# ===========================================================
+
+import datetime
+import threading
+
+from lib.sys_params import SYS_PARAMS
+
+# boto3, requests, urllib3 and googleapiclient are imported by the functions building
+# the clients, so they are only loaded by the stages which use them
+
+# ===========================
+#        Properties
+# ===========================
+
+# rebuild the clients a bit before the credentials expire,
+# so a request never starts with credentials about to expire
+EXPIRY_MARGIN = datetime.timedelta(minutes=5)
+
+_lock = threading.Lock()
+
+# the YouTube resource runs on httplib2, which is not thread-safe,
+# so every thread keeps its own instance built on the shared credentials
+_thread_data = threading.local()
+
+_shared = {
+    'reuse': SYS_PARAMS.REUSE_CLIENTS,
+    'boto3_session': None,
+    's3_client': None,
+    'http_session': None,
+    'http_pool': None,
+    'youtube_credentials': None
+}
+
+# ===========================
+#        Commen usage
+# ===========================
+
+def enable_reuse():
+    """
+    build every client once and hand out the same instance for the following jobs
+
+    Args:
+        None
+
+    Return:
+        None
+    """
+
+    _shared['reuse'] = True
+
+def is_boto3_session_expired(session):
+    """
+    check if the credentials of a boto3 session are missing or about to expire.
+    refreshable credentials (assumed roles, instance profiles) refresh themselves,
+    their expiry time moves forward after every refresh
+
+    Args:
+        session:
+            object => boto3 session
+
+    Return:
+        bool => True if the session should be rebuilt
+    """
+
+    credentials = session.get_credentials()
+    if credentials is None:
+        return True
+
+    expiry_time = getattr(credentials, '_expiry_time', None)
+    if expiry_time is None:
+        return False
+
+    return expiry_time - EXPIRY_MARGIN <= datetime.datetime.now(datetime.timezone.utc)
+
+def get_boto3_session():
+    """
+    get boto3 session
+
+    Args:
+        None
+
+    Return:
+        object => boto3 session
+    """
+
+    import boto3
+
+    if not _shared['reuse']:
+        return boto3.session.Session()
+
+    with _lock:
+        if _shared['boto3_session'] is None or is_boto3_session_expired(_shared['boto3_session']):
+            _shared['boto3_session'] = boto3.session.Session()
+            _shared['s3_client'] = None
+        return _shared['boto3_session']
+
+def get_s3_client():
+    """
+    get s3 client, boto3 clients are thread-safe so one instance is shared by all threads
+
+    Args:
+        None
+
+    Return:
+        object => s3 client
+    """
+
+    if not _shared['reuse']:
+        return get_boto3_session().client('s3')
+
+    session = get_boto3_session()
+    with _lock:
+        if _shared['s3_client'] is None:
+            _shared['s3_client'] = session.client('s3')
+        return _shared['s3_client']
+
+def get_http_pool_size():
+    """
+    get the number of keep-alive connections per host, every worker thread
+    gets its own so concurrent records never wait for a connection
+
+    Args:
+        None
+
+    Return:
+        int => pool size
+    """
+
+    return max(1, SYS_PARAMS.MAX_WORKERS) * 2
+
+def get_http_session():
+    """
+    get the http session for TaiBIF APIs
+
+    Args:
+        None
+
+    Return:
+        object => requests session, or the requests module which opens a session per call
+    """
+
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    if not _shared['reuse']:
+        return requests
+
+    with _lock:
+        if _shared['http_session'] is None:
+            # retries are left to the retry policy of the caller
+            adapter = HTTPAdapter(pool_maxsize=get_http_pool_size(), max_retries=0)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _shared['http_session'] = session
+        return _shared['http_session']
+
+def get_http_pool():
+    """
+    get the urllib3 pool for TaiBIF APIs, a lighter alternative to the requests session
+
+    Args:
+        None
+
+    Return:
+        object => urllib3 PoolManager
+    """
+
+    import urllib3
+
+    if not _shared['reuse']:
+        return urllib3.PoolManager(retries=False)
+
+    with _lock:
+        if _shared['http_pool'] is None:
+            _shared['http_pool'] = urllib3.PoolManager(maxsize=get_http_pool_size(), retries=False)
+        return _shared['http_pool']
+
+def get_youtube_credentials():
+    """
+    get the shared YouTube credentials. the access token is refreshed in place when
+    it expires, new credentials are only created once the refresh token is rejected
+
+    Args:
+        None
+
+    Return:
+        object => oauth2 credentials
+    """
+
+    from lib.upload_video import get_credentials
+
+    with _lock:
+        credentials = _shared['youtube_credentials']
+        if credentials is None or credentials.invalid:
+            credentials = get_credentials()
+            _shared['youtube_credentials'] = credentials
+        return credentials
+
+def get_youtube_service():
+    """
+    get authorized YouTube resource of the current thread
+
+    Args:
+        None
+
+    Return:
+        resource => api resource
+    """
+
+    from lib.upload_video import get_authenticated_service
+
+    if not _shared['reuse']:
+        return get_authenticated_service()
+
+    credentials = get_youtube_credentials()
+
+    # rebuild the resource when the shared credentials have been replaced
+    if getattr(_thread_data, 'youtube_credentials', None) is not credentials:
+        _thread_data.youtube = get_authenticated_service(credentials)
+        _thread_data.youtube_credentials = credentials
+
+    return _thread_data.youtube
@@ -4,6 +4,11 @@
 
 from lib.sys_params import SYS_PARAMS
 import hashlib
+import mimetypes
+import os
+
+# memory size in MB when not running on lambda
+DEFAULT_MEMORY_SIZE = 1024
 
 def get_full_download_path(file_name):
     """
@@ -47,4 +52,37 @@ def to_md5_hexdigest(input_string):
         string => string after md5
     """
 
-    return hashlib.md5(input_string.encode('utf8')).hexdigest()
\ No newline at end of file
+    return hashlib.md5(input_string.encode('utf8')).hexdigest()
+
+def guess_video_mimetype(file_name, content_type=None):
+    """
+    get the mime type of a video for uploading
+
+    Args:
+        :file_name
+            string => video file name
+        :content_type
+            string => Content-Type of the s3 object
+
+    Return:
+        string => mime type, YouTube accepts application/octet-stream if the type is unknown
+    """
+
+    if content_type and content_type.startswith('video/'):
+        return content_type
+
+    guessed_type, _ = mimetypes.guess_type(file_name)
+    return guessed_type or 'application/octet-stream'
+
+def get_memory_size():
+    """
+    get the memory size of the lambda function
+
+    Args:
+        None
+
+    Return:
+        int => memory size in MB
+    """
+
+    return int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', DEFAULT_MEMORY_SIZE))
@@ -0,0 +1,121 @@
+# ===========================================================
+# Content hash of a video, computed over the bytes while they
+# are downloaded or streamed, so it costs no extra read
+# The sha256 is the key of the dedup index in the state store
+# ===========================================================
+
+import hashlib
+
+from lib.state_store import get_state_store
+
+class ContentHasher:
+    """
+    sha256 and md5 of a byte stream fed in order
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def update(self, data):
+        self.sha256.update(data)
+        self.md5.update(data)
+        self.size += len(data)
+
+    def hexdigests(self):
+        """
+        get the hashes of the bytes fed so far
+
+        Args:
+            None
+
+        Return:
+            dict => sha256, md5 and size
+        """
+
+        return {'sha256': self.sha256.hexdigest(), 'md5': self.md5.hexdigest(), 'size': self.size}
+
+class HashingWriter:
+    """
+    write-only file object which hashes the bytes before writing them to fd.
+    it is not seekable, so s3transfer puts the downloaded parts in order before writing
+    """
+
+    def __init__(self, fd, hasher):
+        self.fd = fd
+        self.hasher = hasher
+
+    def seekable(self):
+        return False
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.fd.write(data)
+
+    def flush(self):
+        self.fd.flush()
+
+def get_content_key(sha256):
+    return 'content:sha256:{}'.format(sha256)
+
+def find_uploaded_content(content_hash):
+    """
+    look up a video with the same content in the dedup index
+
+    Args:
+        content_hash:
+            dict => result of ContentHasher.hexdigests
+
+    Return:
+        dict => index entry with url, video id and object key, None if not found
+    """
+
+    state_store = get_state_store()
+    if state_store is None:
+        return None
+
+    entry = state_store.get(get_content_key(content_hash['sha256']))
+
+    # a different size means a collision of the index key, which should never happen
+    if entry is not None and entry.get('size') != content_hash['size']:
+        return None
+
+    return entry
+
+def save_uploaded_content(content_hash, youtube_url, video_id, event_key, playlist_id=''):
+    """
+    add an uploaded video to the dedup index
+
+    Args:
+        content_hash:
+            dict => result of ContentHasher.hexdigests
+        youtube_url:
+            string => url of the video
+        video_id:
+            string => youtube video id
+        event_key:
+            string => object key of the uploaded file
+        playlist_id:
+            string => playlist of the video, for the json files of its copies
+
+    Return:
+        None
+    """
+
+    state_store = get_state_store()
+    if state_store is None:
+        return
+
+    state_store.put(get_content_key(content_hash['sha256']), {
+        'sha256': content_hash['sha256'],
+        'md5': content_hash['md5'],
+        'size': content_hash['size'],
+        'url': youtube_url,
+        'video_id': video_id,
+        'key': event_key,
+        'playlist_id': playlist_id
+    })
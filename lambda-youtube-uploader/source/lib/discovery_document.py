@@ -0,0 +1,87 @@
+# ===========================================================
+# YouTube discovery document bundled in lib/discovery
+# Only the standard library is imported, so the offline
+# update script runs without the lambda environment variables
+# ===========================================================
+
+import json
+import os
+import threading
+
+# ===========================
+#        Properties
+# ===========================
+
+API_SERVICE_NAME = 'youtube'
+API_VERSION = 'v3'
+
+# pinned discovery document shipped with the package, so building the resource
+# needs no request to Google. regenerate it with update_discovery_document.py
+DISCOVERY_DOCUMENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                       'discovery',
+                                       '{}.{}.json'.format(API_SERVICE_NAME, API_VERSION))
+
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/{}/{}/rest'.format(API_SERVICE_NAME, API_VERSION)
+
+_discovery_document = {'content': None}
+_discovery_document_lock = threading.Lock()
+
+def get_discovery_document():
+    """
+    read the bundled discovery document once, build_from_document() changes the
+    parsed document, so the raw string is kept and every build parses its own copy
+
+    Args:
+        None
+
+    Return:
+        string => discovery document, None if it is not bundled
+    """
+
+    with _discovery_document_lock:
+        if _discovery_document['content'] is None and os.path.exists(DISCOVERY_DOCUMENT_PATH):
+            with open(DISCOVERY_DOCUMENT_PATH, encoding='utf8') as f:
+                _discovery_document['content'] = f.read()
+        return _discovery_document['content']
+
+def fetch_discovery_document(url=DISCOVERY_URL):
+    """
+    download the discovery document from Google and check it is the pinned api
+
+    Args:
+        url:
+            string => discovery url
+
+    Return:
+        dict => discovery document
+    """
+
+    # only the update script downloads the document
+    import requests
+
+    resp = requests.get(url, timeout=30)
+    resp.raise_for_status()
+    document = resp.json()
+
+    if document.get('name') != API_SERVICE_NAME or document.get('version') != API_VERSION:
+        raise ValueError('Unexpected discovery document: {} {}'.format(document.get('name'), document.get('version')))
+
+    return document
+
+def save_discovery_document(document, path=DISCOVERY_DOCUMENT_PATH):
+    """
+    write the discovery document, stored without spaces since it is read on every cold start
+
+    Args:
+        document:
+            dict => discovery document
+        path:
+            string => output file
+
+    Return:
+        None
+    """
+
+    with open(path, 'w', encoding='utf8') as f:
+        f.write(json.dumps(document, separators=(',', ':'), ensure_ascii=False))
+        f.write('\n')
@@ -2,27 +2,72 @@
 # Extract video metadata
 # ========================
 
-from hachoir.parser import createParser
-from hachoir.metadata import extractMetadata
 from sys import stderr
 import os
 from lib.sys_params import SYS_PARAMS
 import datetime
 import pytz
 
-def extra_video_meta(file_name):
+from lib.s3_stream import S3RangeReader
+
+# hachoir reads small pieces around the headers (MP4 moov, AVI hdrl), which may sit
+# at either end of the file, so the reader keeps a few small blocks of both ends
+METADATA_BLOCK_SIZE = 256 * 1024
+METADATA_CACHE_BLOCKS = 8
+
+def extra_s3_video_meta(bucket, key, head):
+    """
+    get necessary information from a video in s3, only the byte ranges read by
+    hachoir are fetched instead of the whole file
+
+    Args:
+        bucket: 
+            string => bucket name
+        key: 
+            string => object key
+        head: 
+            dict => head_object response of the object
+
+    Return:
+        dict => result of extra_video_meta
+    """
+
+    reader = S3RangeReader(bucket, key, head['ContentLength'], METADATA_BLOCK_SIZE, cache_blocks=METADATA_CACHE_BLOCKS)
+    try:
+        video_meta = extra_video_meta(reader, head['LastModified'])
+    finally:
+        reader.close()
+
+    print('Read {} KB of {} KB for the metadata'.format(reader.bytes_fetched // 1024, head['ContentLength'] // 1024))
+    return video_meta
+
+def extra_video_meta(file_name, file_time=None):
     """
     get necessary information from video
 
     Args:
         file_name: 
-            string => the target file name
+            string => the target file name, or a seekable file object (e.g. S3RangeReader)
+        file_time: 
+            datetime => used as creation and modification time of a file object, 
+                        since it has no file info
 
     Return:
         dict => result
     """
 
-    parser = createParser(file_name)
+    # hachoir registers all of its parsers on import, load it only when a video is parsed
+    from hachoir.parser import createParser, guessParser
+    from hachoir.metadata import extractMetadata
+    from hachoir.stream import InputIOStream
+
+    if isinstance(file_name, str):
+        parser = createParser(file_name)
+    else:
+        # the file name tag lets hachoir guess the parser from the extension
+        name = getattr(file_name, 'name', '')
+        parser = guessParser(InputIOStream(file_name, source=name, tags=[('filename', name.split('/')[-1])]))
+
     if not parser:
         print("Unable to parse file", file=stderr)
         return {}
@@ -39,17 +84,22 @@ def extra_video_meta(file_name):
         print("Unable to extract metadata")
         return {}
 
-    # init variables
-    statinfo = os.stat(file_name)
-
-    # create time and modification time from file info
-    # THESE OPERATIONS ARE TOTALLY USELESS DUE TO MAKING COPIES TO TMP AT THE BEGINNING OF THIS LAMBDA FUNCTION
-    # THE file_ctime AND file_mtime ARE ALWAYS SET TO THE TIME MAKING THOSE COPIES
-    # TODO: FIND RELATIVELY SOLID ctime AND mtime FROM METADATA
-    file_ctime = datetime.datetime.fromtimestamp(statinfo.st_ctime).astimezone(pytz.timezone('Asia/Taipei'))
-    file_mtime = datetime.datetime.fromtimestamp(statinfo.st_mtime).astimezone(pytz.timezone('Asia/Taipei'))
-    print("File created at %d, %s" % (statinfo.st_ctime, file_ctime))
-    print("File modified at %d, %s" % (statinfo.st_mtime, file_mtime))
+    if isinstance(file_name, str):
+        # init variables
+        statinfo = os.stat(file_name)
+
+        # create time and modification time from file info
+        # THESE OPERATIONS ARE TOTALLY USELESS DUE TO MAKING COPIES TO TMP AT THE BEGINNING OF THIS LAMBDA FUNCTION
+        # THE file_ctime AND file_mtime ARE ALWAYS SET TO THE TIME MAKING THOSE COPIES
+        # TODO: FIND RELATIVELY SOLID ctime AND mtime FROM METADATA
+        file_ctime = datetime.datetime.fromtimestamp(statinfo.st_ctime).astimezone(pytz.timezone('Asia/Taipei'))
+        file_mtime = datetime.datetime.fromtimestamp(statinfo.st_mtime).astimezone(pytz.timezone('Asia/Taipei'))
+        print("File created at %d, %s" % (statinfo.st_ctime, file_ctime))
+        print("File modified at %d, %s" % (statinfo.st_mtime, file_mtime))
+    else:
+        # e.g. LastModified of the s3 object
+        file_ctime = (file_time or datetime.datetime.now(datetime.timezone.utc)).astimezone(pytz.timezone('Asia/Taipei'))
+        file_mtime = file_ctime
 
     # information from metadata
     date_time_original = metadata._Metadata__data['date_time_original']
@@ -0,0 +1,127 @@
+# ===========================================================
+# Hedged requests for idempotent calls with a long latency
+# tail. A duplicate is sent when the first request is slower
+# than the p95 of the latest calls, the first answer wins.
+# A shared budget keeps the duplicates to a few percent of
+# the calls
+# ===========================================================
+
+import concurrent.futures
+import threading
+
+# ===========================
+#        Properties
+# ===========================
+
+# duplicates which may be sent in a burst after a quiet period
+MAX_HEDGE_TOKENS = 10
+
+_executor = {'instance': None}
+_executor_lock = threading.Lock()
+
+class HedgeBudget:
+    """
+    every call earns ratio tokens and every duplicate costs one,
+    so at most ratio of the calls are hedged over time
+    """
+
+    def __init__(self, ratio, max_tokens=MAX_HEDGE_TOKENS):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = 0.0
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.lock = threading.Lock()
+
+    def add_call(self):
+        with self.lock:
+            self.calls += 1
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_acquire(self):
+        """
+        take a token for a duplicate request
+
+        Args:
+            None
+
+        Return:
+            bool => True if the duplicate may be sent
+        """
+
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.hedges += 1
+            return True
+
+    def add_win(self):
+        with self.lock:
+            self.hedge_wins += 1
+
+    def summary(self):
+        with self.lock:
+            return {'calls': self.calls, 'hedges': self.hedges, 'hedge_wins': self.hedge_wins}
+
+def get_executor():
+    # the requests run in their own threads, so the caller can stop waiting for the slow one
+    with _executor_lock:
+        if _executor['instance'] is None:
+            _executor['instance'] = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix='hedge')
+        return _executor['instance']
+
+def hedged_call(func, histogram, budget, min_samples, min_delay, action):
+    """
+    call func, and call it once more if it has not returned within the recent p95 of histogram
+
+    Args:
+        func:
+            function => idempotent call without arguments
+        histogram:
+            object => LatencyHistogram of single calls of func, gives the hedge delay
+        budget:
+            object => HedgeBudget shared by the calls
+        min_samples:
+            int => recent calls recorded in histogram before hedging starts, at least one
+        min_delay:
+            float => shortest hedge delay in seconds
+        action:
+            string => what is called, for the messages
+
+    Return:
+        object => result of the first call which succeeds
+    """
+
+    budget.add_call()
+
+    # the p95 is not known yet, nothing to compare with
+    if histogram.recent_total < max(1, min_samples):
+        return func()
+
+    # the latest calls only, so the delay follows the latency when it drifts
+    delay = max(min_delay, histogram.recent_percentile(95))
+
+    executor = get_executor()
+    futures = [executor.submit(func)]
+    done, _ = concurrent.futures.wait(futures, timeout=delay)
+
+    if len(done) == 0 and budget.try_acquire():
+        print('Hedging {} after {:.0f} ms, {}'.format(action, delay * 1000, budget.summary()))
+        futures.append(executor.submit(func))
+
+    # the first success wins, an error only counts when every request failed
+    pending = set(futures)
+    error = None
+    while len(pending) > 0:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is not futures[0]:
+                    budget.add_win()
+                return future.result()
+            if error is None:
+                error = future.exception()
+
+    raise error
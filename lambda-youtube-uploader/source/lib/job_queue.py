@@ -0,0 +1,312 @@
+# ==================================================
+# Job queues for the worker
+# Every job carries a list of s3 event records
+# ==================================================
+
+import json
+import os
+import queue
+import time
+import uuid
+
+from lib.clients import get_boto3_session
+
+class Job:
+
+    def __init__(self, job_id, records, handle=None):
+        self.job_id = job_id
+        self.records = records
+        self.handle = handle # what the queue needs to ack or nack this job
+
+def get_s3_records_from_sqs_message(message):
+    """
+    extract the s3 event records wrapped in the body of a sqs message
+
+    Args:
+        message:
+            dict => sqs message, the body is either in 'body' (lambda event) or 'Body' (receive_message)
+
+    Return:
+        list => s3 event records
+    """
+
+    body = json.loads(message['body'] if 'body' in message else message['Body'])
+
+    # notifications delivered through a sns topic are wrapped once more
+    if isinstance(body, dict) and 'Records' not in body and 'Message' in body:
+        body = json.loads(body['Message'])
+
+    return get_s3_records(body)
+
+def get_s3_records(body):
+    """
+    get the records of a parsed s3 event, ValueError is raised if it is not one
+
+    Args:
+        body:
+            object => parsed json of the event
+
+    Return:
+        list => s3 event records
+    """
+
+    if not isinstance(body, dict):
+        raise ValueError('The event is a {}, not an object'.format(type(body).__name__))
+
+    # s3 sends a test event without records when the notification is created
+    records = body.get('Records', [])
+    if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+        raise ValueError('The records of the event are not a list of objects')
+
+    return records
+
+class MemoryQueue:
+    """
+    in-memory queue, for tests and local runs
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.failed = []
+
+    def put(self, records):
+        """
+        add a job
+
+        Args:
+            records:
+                list => s3 event records
+
+        Return:
+            string => job id
+        """
+
+        job = Job(str(uuid.uuid4()), records)
+        self.queue.put(job)
+        return job.job_id
+
+    def receive(self, max_jobs, wait_seconds):
+        """
+        get at most max_jobs jobs, wait up to wait_seconds for the first one
+
+        Args:
+            max_jobs:
+                int => maximum number of jobs
+            wait_seconds:
+                int => seconds to wait if the queue is empty
+
+        Return:
+            list => jobs
+        """
+
+        jobs = []
+        try:
+            jobs.append(self.queue.get(timeout=wait_seconds))
+            while len(jobs) < max_jobs:
+                jobs.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        return jobs
+
+    def ack(self, job):
+        pass
+
+    def nack(self, job):
+        self.failed.append(job)
+
+    def defer(self, job, delay_seconds):
+        # a test queue has nothing to wait for
+        self.queue.put(job)
+
+class DirectorySpoolQueue:
+    """
+    local directory spool, every *.json file holds an s3 event with 'Records'.
+    claimed files move to processing/, failed ones to failed/. a deferred file
+    goes back to the spool, dated to when it may be claimed again
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.processing_path = os.path.join(path, 'processing')
+        self.failed_path = os.path.join(path, 'failed')
+
+        os.makedirs(self.processing_path, exist_ok=True)
+        os.makedirs(self.failed_path, exist_ok=True)
+
+    def put(self, records):
+        """
+        add a job
+
+        Args:
+            records:
+                list => s3 event records
+
+        Return:
+            string => job id
+        """
+
+        job_id = str(uuid.uuid4())
+        tmp_path = os.path.join(self.processing_path, '{}.tmp'.format(job_id))
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump({'Records': records}, f, ensure_ascii=False)
+
+        # publish the file in one step so a running worker never reads half of it
+        os.replace(tmp_path, os.path.join(self.path, '{}.json'.format(job_id)))
+        return job_id
+
+    def receive(self, max_jobs, wait_seconds):
+        """
+        claim at most max_jobs jobs, the oldest file first
+
+        Args:
+            max_jobs:
+                int => maximum number of jobs
+            wait_seconds:
+                int => not used, the worker sleeps when nothing is claimed
+
+        Return:
+            list => jobs
+        """
+
+        jobs = []
+        for name in sorted(os.listdir(self.path)):
+            if len(jobs) >= max_jobs:
+                break
+            if not name.endswith('.json'):
+                continue
+
+            try:
+                if os.path.getmtime(os.path.join(self.path, name)) > time.time():
+                    continue
+            except FileNotFoundError:
+                continue
+
+            claimed_path = os.path.join(self.processing_path, name)
+            try:
+                # rename is atomic, so only one worker gets the file
+                os.rename(os.path.join(self.path, name), claimed_path)
+            except FileNotFoundError:
+                continue
+
+            try:
+                with open(claimed_path, encoding='utf8') as f:
+                    records = get_s3_records(json.load(f))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                print('Unable to read job {}: {}'.format(name, e))
+                os.replace(claimed_path, os.path.join(self.failed_path, name))
+                continue
+
+            jobs.append(Job(name[:-len('.json')], records, claimed_path))
+
+        return jobs
+
+    def ack(self, job):
+        os.remove(job.handle)
+
+    def nack(self, job):
+        os.replace(job.handle, os.path.join(self.failed_path, os.path.basename(job.handle)))
+
+    def defer(self, job, delay_seconds):
+        """
+        put a job back in the spool, it is claimed again after delay_seconds
+
+        Args:
+            job:
+                object => claimed job
+            delay_seconds:
+                int => seconds before the job can be claimed again
+
+        Return:
+            None
+        """
+
+        not_before = time.time() + delay_seconds
+        os.utime(job.handle, (not_before, not_before))
+        os.replace(job.handle, os.path.join(self.path, os.path.basename(job.handle)))
+
+class SqsQueue:
+    """
+    sqs queue subscribed to the s3 notifications.
+    failed jobs are left in the queue and come back after the visibility timeout,
+    a redrive policy on the queue moves the ones which keep failing to a DLQ
+    """
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.sqs = get_boto3_session().client('sqs')
+
+    def put(self, records, delay_seconds=0):
+        """
+        add a job
+
+        Args:
+            records:
+                list => s3 event records
+            delay_seconds:
+                int => seconds before the job can be received, 900 at most
+
+        Return:
+            string => message id
+        """
+
+        response = self.sqs.send_message(QueueUrl=self.queue_url,
+                                         MessageBody=json.dumps({'Records': records}),
+                                         DelaySeconds=max(0, min(delay_seconds, 900)))
+        return response['MessageId']
+
+    def receive(self, max_jobs, wait_seconds):
+        """
+        receive at most max_jobs messages with long polling
+
+        Args:
+            max_jobs:
+                int => maximum number of jobs, sqs returns 10 at most
+            wait_seconds:
+                int => long polling time, 20 at most
+
+        Return:
+            list => jobs
+        """
+
+        response = self.sqs.receive_message(QueueUrl=self.queue_url,
+                                            MaxNumberOfMessages=max(1, min(max_jobs, 10)),
+                                            WaitTimeSeconds=max(0, min(wait_seconds, 20)))
+
+        jobs = []
+        for message in response.get('Messages', []):
+            try:
+                records = get_s3_records_from_sqs_message(message)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                # it can never be read, so it is deleted instead of coming back until the retention period ends
+                print('Unable to read message {}, deleting it: {}. body: {}'.format(message['MessageId'], e, message.get('Body')))
+                self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message['ReceiptHandle'])
+                continue
+
+            jobs.append(Job(message['MessageId'], records, message['ReceiptHandle']))
+
+        return jobs
+
+    def ack(self, job):
+        self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=job.handle)
+
+    def nack(self, job):
+        pass
+
+    def defer(self, job, delay_seconds):
+        """
+        send the records of a job again with a delay and delete the received message,
+        so waiting for the quota does not count towards the maxReceiveCount of the DLQ
+
+        Args:
+            job:
+                object => received job
+            delay_seconds:
+                int => seconds before the job can be received again, 900 at most
+
+        Return:
+            None
+        """
+
+        self.put(job.records, delay_seconds)
+        self.ack(job)
@@ -6,7 +6,7 @@ import datetime
 import pytz
 
 import json
-import urllib
+import urllib.parse
 from lib.sys_params import SYS_PARAMS
 
 from lib.s3_helpers import upload_json_file
@@ -36,8 +36,16 @@ class JsonFileGenerator:
         self.exif = kwargs.setdefault('exif', {}) # EXIF 整組 json 
         self.make = kwargs.setdefault('make', '') # 相機製造商
         self.model = kwargs.setdefault('model', '') # 相機型號
+        self.content_hash = kwargs.setdefault('content_hash', None) # 影片內容的 sha256 / md5
+        self.object_key = kwargs.setdefault('object_key', '') # 同內容另存的 s3 物件，與原影片分開記錄
         self.fullCameraLocation = generate_location_path(self.projectId, self.site, self.subSite, self.cameraLocation)
 
+        # a copy of an uploaded video shares its url, so its record is keyed by the url and its own s3 object
+        if self.object_key:
+            self.record_id = to_md5_hexdigest('{}{}'.format(self.youtube_url, self.object_key))
+        else:
+            self.record_id = to_md5_hexdigest(self.youtube_url)
+
         self.enpoint_mma = SYS_PARAMS.ENDPOINT_MMA
         self.enpoint_mmm = SYS_PARAMS.ENDPOINT_MMM
 
@@ -76,6 +84,10 @@ class JsonFileGenerator:
             endpoint = self.enpoint_mmm
         else:
             return None
+
+        if self.content_hash is not None:
+            body['$set']['content_sha256'] = self.content_hash['sha256']
+            body['$set']['content_md5'] = self.content_hash['md5']
         
         print(body)
 
@@ -103,7 +115,7 @@ class JsonFileGenerator:
         """
 
         return {
-            '_id': to_md5_hexdigest(self.youtube_url),
+            '_id': self.record_id,
             'projectId': self.projectId,
             'fullCameraLocationMd5': to_md5_hexdigest(self.fullCameraLocation),
             '$set': {
@@ -162,7 +174,7 @@ class JsonFileGenerator:
         """
 
         return {
-            '_id': to_md5_hexdigest(self.youtube_url),
+            '_id': self.record_id,
             'projectId': self.projectId,
             'fullCameraLocationMd5': to_md5_hexdigest(self.fullCameraLocation),
             '$set': {
@@ -0,0 +1,179 @@
+# ===========================================================
+# Latency histograms of outgoing calls
+# Buckets grow exponentially, so a histogram stays small and
+# its percentiles are within one bucket width of the truth
+# ===========================================================
+
+import bisect
+import collections
+import threading
+
+# ===========================
+#        Properties
+# ===========================
+
+# bucket upper bounds in seconds, from 1 ms to about 2 minutes, 25% apart
+BUCKET_BOUNDS = [0.001 * 1.25 ** i for i in range(54)]
+
+# latest calls kept for the recent percentiles, which follow a drifting latency
+RECENT_WINDOW = 200
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+def get_bucket_percentile(counts, total, p):
+    """
+    get the upper bound of the bucket holding the p-th percentile of the counts
+
+    Args:
+        counts:
+            list => calls in every bucket
+        total:
+            int => sum of counts
+        p:
+            float => percentile, e.g. 95
+
+    Return:
+        float => latency in seconds, None if nothing is counted
+    """
+
+    if total == 0:
+        return None
+
+    rank = p / 100 * total
+    seen = 0
+    for index, count in enumerate(counts):
+        seen += count
+        if seen >= rank and count > 0:
+            return BUCKET_BOUNDS[min(index, len(BUCKET_BOUNDS) - 1)]
+
+    return BUCKET_BOUNDS[-1]
+
+class LatencyHistogram:
+    """
+    latencies of the whole life of the process, and of the latest window calls
+    """
+
+    def __init__(self, name, window=RECENT_WINDOW):
+        self.name = name
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1) # the last bucket holds everything slower
+        self.total = 0
+        self.sum = 0.0
+        self.window = window
+        self.recent = collections.deque()
+        self.recent_counts = [0] * len(self.counts)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        """
+        add the latency of a call
+
+        Args:
+            seconds:
+                float => latency
+
+        Return:
+            None
+        """
+
+        index = bisect.bisect_left(BUCKET_BOUNDS, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += 1
+            self.sum += seconds
+
+            self.recent.append(index)
+            self.recent_counts[index] += 1
+            if len(self.recent) > self.window:
+                self.recent_counts[self.recent.popleft()] -= 1
+
+    @property
+    def recent_total(self):
+        with self.lock:
+            return len(self.recent)
+
+    def percentile(self, p):
+        """
+        get the upper bound of the bucket holding the p-th percentile
+
+        Args:
+            p:
+                float => percentile, e.g. 95
+
+        Return:
+            float => latency in seconds, None if nothing is recorded
+        """
+
+        with self.lock:
+            return get_bucket_percentile(self.counts, self.total, p)
+
+    def recent_percentile(self, p):
+        """
+        get the upper bound of the bucket holding the p-th percentile of the latest window calls
+
+        Args:
+            p:
+                float => percentile, e.g. 95
+
+        Return:
+            float => latency in seconds, None if nothing is recorded
+        """
+
+        with self.lock:
+            return get_bucket_percentile(self.recent_counts, len(self.recent), p)
+
+    def summary(self):
+        """
+        get the number of calls, the mean and the usual percentiles
+
+        Args:
+            None
+
+        Return:
+            dict => count, mean_ms, p50_ms, p95_ms, p99_ms
+        """
+
+        if self.total == 0:
+            return {'count': 0}
+
+        return {
+            'count': self.total,
+            'mean_ms': round(self.sum / self.total * 1000, 1),
+            'p50_ms': round(self.percentile(50) * 1000, 1),
+            'p95_ms': round(self.percentile(95) * 1000, 1),
+            'p99_ms': round(self.percentile(99) * 1000, 1)
+        }
+
+def get_histogram(name):
+    """
+    get the histogram of a call, created on first use
+
+    Args:
+        name:
+            string => name of the call, e.g. 'taibif media/query'
+
+    Return:
+        object => latency histogram
+    """
+
+    with _histograms_lock:
+        if name not in _histograms:
+            _histograms[name] = LatencyHistogram(name)
+        return _histograms[name]
+
+def print_latency_report():
+    """
+    print the summary of every histogram, they cover the life of the container / process
+
+    Args:
+        None
+
+    Return:
+        None
+    """
+
+    with _histograms_lock:
+        histograms = list(_histograms.values())
+
+    for histogram in histograms:
+        print('latency {}: {}'.format(histogram.name, histogram.summary()))
@@ -0,0 +1,131 @@
+# ===========================================================
+# Index of the s3 objects already processed, kept in the
+# state store. An object is identified by its ETag, size and
+# camera location, so redelivered events and the same file
+# uploaded again in another session are found without
+# downloading anything. An uploaded video whose playlist item
+# was deferred is kept here too, for the redelivered event
+# ===========================================================
+
+from lib.common_helpers import generate_location_path, to_md5_hexdigest
+from lib.state_store import get_state_store
+
+def get_object_index_key(head, tags):
+    """
+    create the index key of an object
+
+    Args:
+        head:
+            dict => head_object response of the object
+        tags:
+            dict => object tags with projectId, site, subSite and cameraLocation
+
+    Return:
+        string => index key
+    """
+
+    location = generate_location_path(tags['projectId'], tags['site'], tags['subSite'], tags['cameraLocation'])
+    return 'object:{}:{}:{}'.format(head['ETag'].strip('"'), head['ContentLength'], to_md5_hexdigest(location))
+
+def find_processed_object(head, tags):
+    """
+    look up an object with the same ETag, size and location in the index
+
+    Args:
+        head:
+            dict => head_object response of the object
+        tags:
+            dict => object tags
+
+    Return:
+        dict => index entry with url and object key, None if not found
+    """
+
+    state_store = get_state_store()
+    if state_store is None:
+        return None
+
+    return state_store.get(get_object_index_key(head, tags))
+
+def save_processed_object(head, tags, youtube_url, event_key):
+    """
+    add a processed object to the index
+
+    Args:
+        head:
+            dict => head_object response of the object
+        tags:
+            dict => object tags
+        youtube_url:
+            string => url of the video on YouTube
+        event_key:
+            string => object key
+
+    Return:
+        None
+    """
+
+    state_store = get_state_store()
+    if state_store is None:
+        return
+
+    state_store.put(get_object_index_key(head, tags), {
+        'url': youtube_url,
+        'key': event_key,
+        'last_modified': head['LastModified'].isoformat()
+    })
+
+def get_pending_playlist_item_key(event_key):
+    return 'playlist-item:{}'.format(event_key)
+
+def find_pending_playlist_item(event_key):
+    """
+    look up the playlist item an earlier attempt of an object could not send
+
+    Args:
+        event_key:
+            string => object key
+
+    Return:
+        dict => playlist_id, video_id and url, None if not found
+    """
+
+    state_store = get_state_store()
+    if state_store is None:
+        return None
+
+    return state_store.get(get_pending_playlist_item_key(event_key))
+
+def save_pending_playlist_item(event_key, playlist_id, video_id, youtube_url):
+    """
+    keep a playlist item deferred by the deadline, the redelivered event sends it
+
+    Args:
+        event_key:
+            string => object key
+        playlist_id:
+            string => the youtube playlist id
+        video_id:
+            string => the youtube video id
+        youtube_url:
+            string => url of the video on YouTube
+
+    Return:
+        bool => False if there is no state store to keep it in
+    """
+
+    state_store = get_state_store()
+    if state_store is None:
+        return False
+
+    state_store.put(get_pending_playlist_item_key(event_key), {
+        'playlist_id': playlist_id,
+        'video_id': video_id,
+        'url': youtube_url
+    })
+    return True
+
+def delete_pending_playlist_item(event_key):
+    state_store = get_state_store()
+    if state_store is not None:
+        state_store.delete(get_pending_playlist_item_key(event_key))
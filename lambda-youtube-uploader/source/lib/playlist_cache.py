@@ -0,0 +1,177 @@
+# ===========================================================
+# Title -> id map of the playlists of the channel
+# Built once from playlists.list and kept in memory, with a
+# json snapshot in s3 so a new container needs no API call
+# ===========================================================
+
+import json
+import threading
+import time
+
+import botocore.exceptions
+
+from lib.sys_params import SYS_PARAMS
+from lib.clients import get_s3_client
+
+_cache = {'instance': None}
+_cache_lock = threading.Lock()
+
+class PlaylistCache:
+    """
+    title -> playlist id, refreshed by a full scan when a title is missing
+    """
+
+    def __init__(self, snapshot_bucket=None, snapshot_key=None):
+        self.snapshot_bucket = snapshot_bucket
+        self.snapshot_key = snapshot_key
+        self.playlists = None
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+    def load_snapshot(self):
+        """
+        read the snapshot from s3
+
+        Args:
+            None
+
+        Return:
+            dict => title -> playlist id, None if there is no snapshot
+        """
+
+        if not self.snapshot_bucket:
+            return None
+
+        try:
+            response = get_s3_client().get_object(Bucket=self.snapshot_bucket, Key=self.snapshot_key)
+            return json.loads(response['Body'].read().decode('utf8'))['playlists']
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                print('Failed to read the playlist snapshot: {}'.format(e))
+            return None
+
+    def save_snapshot(self):
+        """
+        write the map to s3, a failed write only costs a scan in another container
+
+        Args:
+            None
+
+        Return:
+            None
+        """
+
+        if not self.snapshot_bucket:
+            return
+
+        with self.lock:
+            body = json.dumps({'playlists': self.playlists, 'updated_at': int(time.time())}, ensure_ascii=False)
+
+        try:
+            get_s3_client().put_object(Bucket=self.snapshot_bucket,
+                                       Key=self.snapshot_key,
+                                       Body=body.encode('utf8'),
+                                       ContentType='application/json')
+        except botocore.exceptions.ClientError as e:
+            print('Failed to write the playlist snapshot: {}'.format(e))
+
+    def get(self, title):
+        """
+        get the id of a playlist
+
+        Args:
+            title:
+                string => playlist title
+
+        Return:
+            string, int => playlist id or None, generation of the map it was looked up in
+        """
+
+        with self.lock:
+            if self.playlists is None:
+                self.playlists = self.load_snapshot()
+            if self.playlists is None:
+                return None, None
+            return self.playlists.get(title), self.generation
+
+    def refresh(self, list_playlists, seen_generation):
+        """
+        replace the map with a full scan, unless another thread did it since seen_generation
+
+        Args:
+            list_playlists:
+                function => returns title -> playlist id of every playlist
+            seen_generation:
+                int => generation returned by get, None if the map was empty
+
+        Return:
+            None
+        """
+
+        with self.refresh_lock:
+            with self.lock:
+                if self.playlists is not None and self.generation != seen_generation:
+                    return
+
+            playlists = list_playlists()
+
+            with self.lock:
+                self.playlists = playlists
+                self.generation += 1
+
+        self.save_snapshot()
+
+    def add(self, title, playlist_id):
+        """
+        add a playlist created by this process
+
+        Args:
+            title:
+                string => playlist title
+            playlist_id:
+                string => playlist id
+
+        Return:
+            None
+        """
+
+        with self.lock:
+            if self.playlists is None:
+                self.playlists = {}
+            self.playlists[title] = playlist_id
+
+        self.save_snapshot()
+
+    def remove(self, title):
+        """
+        forget a playlist which could not be used, e.g. deleted on YouTube
+
+        Args:
+            title:
+                string => playlist title
+
+        Return:
+            None
+        """
+
+        with self.lock:
+            if self.playlists is not None:
+                self.playlists.pop(title, None)
+
+def get_playlist_cache():
+    """
+    get the playlist map shared by the threads of this process
+
+    Args:
+        None
+
+    Return:
+        object => PlaylistCache with the snapshot at PLAYLIST_SNAPSHOT_LOCATION
+    """
+
+    with _cache_lock:
+        if _cache['instance'] is None:
+            bucket, _, key = SYS_PARAMS.PLAYLIST_SNAPSHOT_LOCATION.replace('s3://', '', 1).partition('/')
+            _cache['instance'] = PlaylistCache(bucket or None, key or None)
+        return _cache['instance']
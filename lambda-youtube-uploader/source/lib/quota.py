@@ -0,0 +1,434 @@
+# ===========================================================
+# YouTube Data API quota accounting
+# Every call is charged to a ledger of the quota day (it is
+# reset at midnight Pacific time), uploads reserve their
+# projected cost first and are deferred when it would not fit
+# ===========================================================
+
+import contextlib
+import datetime
+import json
+import random
+import threading
+import time
+import uuid
+
+import pytz
+
+from lib.sys_params import SYS_PARAMS
+from lib.state_store import get_state_store
+
+# ===========================
+#        Properties
+# ===========================
+
+# units charged per call, https://developers.google.com/youtube/v3/determine_quota_cost
+QUOTA_COSTS = {
+    'videos.insert': 1600,
+    'search.list': 100,
+    'playlists.list': 1,
+    'playlists.insert': 50,
+    'playlistItems.insert': 50
+}
+
+# every other call, including invalid ones, costs at least one unit
+DEFAULT_QUOTA_COST = 1
+
+# an upload inserts the video and adds it to its playlist
+UPLOAD_QUOTA_COST = QUOTA_COSTS['videos.insert'] + QUOTA_COSTS['playlistItems.insert']
+
+QUOTA_TIMEZONE = pytz.timezone('America/Los_Angeles')
+
+METRIC_NAMESPACE = 'CameraTrap/YouTubeUploader'
+
+# error reasons of a request refused because the quota is used up
+QUOTA_ERROR_REASONS = ('quotaExceeded', 'dailyLimitExceeded')
+
+# a reservation which is not released within this time belongs to a process which stopped
+RESERVATION_TTL_SECONDS = 60 * 60
+
+# the ledger of a quota day is not needed after the day
+LEDGER_TTL_SECONDS = 2 * 24 * 60 * 60
+
+# conditional writes of a ledger change before giving up, the sleep between
+# two attempts is random up to UPDATE_BACKOFF_SECONDS * 2 ** attempt
+MAX_UPDATE_ATTEMPTS = 10
+UPDATE_BACKOFF_SECONDS = 0.01
+
+_ledger = {'instance': None}
+_ledger_lock = threading.Lock()
+
+# the reservation of the job running in the current thread, its calls are taken out of it
+_current_reservation = threading.local()
+
+# 'high' for the lambda and the worker, 'low' for backfill
+_priority = {'value': 'high'}
+
+class QuotaDeferred(Exception):
+    """
+    the work does not fit in the quota left today, it should be re-queued
+    """
+
+class QuotaLedgerBusy(Exception):
+    """
+    other processes kept changing the ledger, a change could not be saved
+    """
+
+# ===========================
+#          Ledger
+# ===========================
+
+class QuotaLedger:
+    """
+    units spent and reserved on the current quota day. with a state store the
+    ledger is one document shared by every process, each change is a conditional
+    write which is made again when another process changed the ledger in between
+    """
+
+    def __init__(self, budget, state_store=None):
+        self.budget = budget
+        self.state_store = state_store
+        self.day = None
+        self.document = None
+        self.lock = threading.Lock()
+
+    def get_day(self):
+        return datetime.datetime.now(QUOTA_TIMEZONE).strftime('%Y-%m-%d')
+
+    def prepare(self, document):
+        # ledgers saved before the shared reservations only have 'spent'
+        if document is None:
+            document = {'spent': 0}
+        document.setdefault('reservations', {})
+
+        # the reservations of a process which stopped without releasing them
+        now = time.time()
+        document['reservations'] = {reservation_id: reservation
+                                    for reservation_id, reservation in document['reservations'].items()
+                                    if reservation['expires_at'] > now}
+        return document
+
+    def read(self):
+        """
+        get the ledger of the current quota day
+
+        Args:
+            None
+
+        Return:
+            dict => spent and reservations
+        """
+
+        with self.lock:
+            day = self.get_day()
+            if self.state_store is None:
+                if day != self.day:
+                    self.day = day
+                    self.document = self.prepare(None)
+                return self.prepare(self.document)
+
+            document, _ = self.state_store.get_versioned('youtube-quota:{}'.format(day))
+            return self.prepare(document)
+
+    def update(self, change):
+        """
+        change the ledger of the current quota day
+
+        Args:
+            change:
+                function => changes the ledger document in place, its return value is returned
+
+        Return:
+            object => result of change
+
+        Raise:
+            QuotaLedgerBusy => the change was not saved after MAX_UPDATE_ATTEMPTS conditional writes
+        """
+
+        with self.lock:
+            day = self.get_day()
+            if self.state_store is None:
+                # a new quota day starts from zero
+                if day != self.day:
+                    self.day = day
+                    self.document = self.prepare(None)
+                return change(self.prepare(self.document))
+
+            key = 'youtube-quota:{}'.format(day)
+            for attempt in range(MAX_UPDATE_ATTEMPTS):
+                if attempt > 0:
+                    time.sleep(random.uniform(0, UPDATE_BACKOFF_SECONDS * 2 ** attempt))
+
+                document, version = self.state_store.get_versioned(key)
+                stored = json.dumps(document, sort_keys=True)
+                document = self.prepare(document)
+                result = change(document)
+
+                if version is not None and json.dumps(document, sort_keys=True) == stored:
+                    return result
+
+                if version is None:
+                    saved = self.state_store.put_if_absent(key, document, LEDGER_TTL_SECONDS)
+                else:
+                    saved = self.state_store.replace_if(key, version, document, LEDGER_TTL_SECONDS)
+                if saved:
+                    return result
+
+            raise QuotaLedgerBusy('The quota ledger {} changed during {} attempts'.format(key, MAX_UPDATE_ATTEMPTS))
+
+    def record(self, action, reservation_id=None):
+        """
+        charge a call to the ledger
+
+        Args:
+            action:
+                string => api method, e.g. 'videos.insert'
+            reservation_id:
+                string => reservation of the job which made the call, None if it has none
+
+        Return:
+            None
+        """
+
+        cost = QUOTA_COSTS.get(action, DEFAULT_QUOTA_COST)
+
+        def change(document):
+            document['spent'] += cost
+
+            # the spent units are no longer held by the reservation, so they are not counted twice
+            reservation = document['reservations'].get(reservation_id)
+            if reservation is not None:
+                reservation['units'] -= min(cost, reservation['units'])
+                if reservation['units'] == 0:
+                    del document['reservations'][reservation_id]
+
+        self.update(change)
+
+    def mark_exhausted(self):
+        """
+        YouTube refused a call for the quota, nothing more can be spent today
+
+        Args:
+            None
+
+        Return:
+            None
+        """
+
+        def change(document):
+            document['spent'] = max(document['spent'], self.budget)
+
+        self.update(change)
+
+    def remaining(self):
+        """
+        get the units left today, without the reservations
+
+        Args:
+            None
+
+        Return:
+            int => units
+        """
+
+        return self.budget - self.read()['spent']
+
+    def reserve(self, units, keep):
+        """
+        reserve units for a job if they fit in the budget, next to the reservations of every process
+
+        Args:
+            units:
+                int => projected cost of the job
+            keep:
+                int => units which must still be left afterwards
+
+        Return:
+            string => reservation id, None if the units do not fit
+        """
+
+        reservation_id = uuid.uuid4().hex
+
+        def change(document):
+            reserved = sum(reservation['units'] for reservation in document['reservations'].values())
+            if self.budget - document['spent'] - reserved - units < keep:
+                return None
+            document['reservations'][reservation_id] = {'units': units, 'expires_at': time.time() + RESERVATION_TTL_SECONDS}
+            return reservation_id
+
+        return self.update(change)
+
+    def release(self, reservation_id):
+        """
+        give back the units of a reservation which were not spent
+
+        Args:
+            reservation_id:
+                string => id returned by reserve
+
+        Return:
+            None
+        """
+
+        def change(document):
+            document['reservations'].pop(reservation_id, None)
+
+        self.update(change)
+
+def get_quota_ledger():
+    """
+    get the quota ledger of this process
+
+    Args:
+        None
+
+    Return:
+        object => QuotaLedger of YOUTUBE_QUOTA_BUDGET units a day
+    """
+
+    with _ledger_lock:
+        if _ledger['instance'] is None:
+            _ledger['instance'] = QuotaLedger(SYS_PARAMS.YOUTUBE_QUOTA_BUDGET, get_state_store())
+        return _ledger['instance']
+
+def record_quota(action):
+    # the call was made, a busy ledger loses the units rather than failing the job,
+    # quotaExceeded errors correct the ledger
+    try:
+        get_quota_ledger().record(action, getattr(_current_reservation, 'id', None))
+    except QuotaLedgerBusy as e:
+        print('{} not recorded: {}'.format(action, e))
+
+def is_quota_error(e):
+    """
+    check if an error is YouTube refusing a call for the quota
+
+    Args:
+        e:
+            exception => error raised by a call
+
+    Return:
+        bool => True for quotaExceeded and dailyLimitExceeded
+    """
+
+    content = getattr(e, 'content', None)
+    if getattr(getattr(e, 'resp', None), 'status', None) != 403 or content is None:
+        return False
+
+    if isinstance(content, bytes):
+        content = content.decode('utf8', errors='replace')
+
+    return any(reason in content for reason in QUOTA_ERROR_REASONS)
+
+def record_quota_error(e):
+    """
+    mark the quota as used up if YouTube refused a call for it
+
+    Args:
+        e:
+            exception => error raised by a call
+
+    Return:
+        None
+    """
+
+    if is_quota_error(e):
+        print('YouTube quota exceeded, deferring the uploads until the quota is reset')
+        try:
+            get_quota_ledger().mark_exhausted()
+        except QuotaLedgerBusy as e:
+            print('The exhausted quota is not recorded: {}'.format(e))
+
+# ===========================
+#         Scheduler
+# ===========================
+
+def set_quota_priority(priority):
+    """
+    set the priority of the jobs of this process
+
+    Args:
+        priority:
+            string => 'high', or 'low' for jobs which leave YOUTUBE_QUOTA_RESERVE units to the others
+
+    Return:
+        None
+    """
+
+    _priority['value'] = priority
+
+@contextlib.contextmanager
+def quota_reservation(units, action):
+    """
+    reserve the projected cost of a job while it runs, QuotaDeferred is raised if it does not fit
+    or if YouTube refuses a call of the job for the quota
+
+    Args:
+        units:
+            int => projected cost
+        action:
+            string => what is about to start, for the error message
+
+    Return:
+        None
+    """
+
+    ledger = get_quota_ledger()
+    keep = SYS_PARAMS.YOUTUBE_QUOTA_RESERVE if _priority['value'] == 'low' else 0
+
+    # a job is deferred the same way when the ledger is too busy to reserve its units
+    try:
+        reservation_id = ledger.reserve(units, keep)
+    except QuotaLedgerBusy as e:
+        raise QuotaDeferred('Unable to reserve YouTube quota for {}: {}'.format(action, e)) from e
+
+    if reservation_id is None:
+        raise QuotaDeferred('Not enough YouTube quota for {} ({} units), {} units left today and {} kept for other jobs'.format(
+            action, units, ledger.remaining(), keep))
+
+    _current_reservation.id = reservation_id
+    try:
+        yield
+    except Exception as e:
+        # YouTube knows the quota better than the ledger, the job is deferred the same way
+        if is_quota_error(e):
+            raise QuotaDeferred('YouTube quota exceeded while {}'.format(action)) from e
+        raise
+    finally:
+        _current_reservation.id = None
+
+        # an unreleased reservation expires after RESERVATION_TTL_SECONDS
+        try:
+            ledger.release(reservation_id)
+        except QuotaLedgerBusy as e:
+            print('Reservation {} not released: {}'.format(reservation_id, e))
+
+def print_quota_metric():
+    """
+    print the quota left today in the CloudWatch embedded metric format
+
+    Args:
+        None
+
+    Return:
+        None
+    """
+
+    ledger = get_quota_ledger()
+    remaining = ledger.remaining()
+
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRIC_NAMESPACE,
+                'Dimensions': [[]],
+                'Metrics': [
+                    {'Name': 'YouTubeQuotaRemaining', 'Unit': 'Count'},
+                    {'Name': 'YouTubeQuotaSpent', 'Unit': 'Count'}
+                ]
+            }]
+        },
+        'YouTubeQuotaRemaining': remaining,
+        'YouTubeQuotaSpent': ledger.budget - remaining
+    }))
@@ -0,0 +1,115 @@
+# ===========================================================
+# Bandwidth limit shared by all uploads of a process
+# Every upload reads its video through ThrottledReader, which
+# takes the bytes from one token bucket
+# ===========================================================
+
+import threading
+import time
+
+from lib.sys_params import SYS_PARAMS
+
+_limiter = {'bucket': None, 'rate': None}
+_limiter_lock = threading.Lock()
+
+class TokenBucket:
+    """
+    token bucket of bytes, refilled at rate bytes per second up to capacity.
+    a reader may take more than it has, it then sleeps until the debt is paid,
+    so readers are served in the order they ask
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        Args:
+            rate:
+                float => bytes per second
+            capacity:
+                float => largest burst in bytes, one second of rate by default
+        """
+
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """
+        take amount bytes from the bucket, sleep if there are not enough
+
+        Args:
+            amount:
+                int => bytes
+
+        Return:
+            float => seconds slept
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+class ThrottledReader:
+    """
+    file object wrapper whose reads take tokens from a bucket,
+    everything else is passed to the wrapped file object
+    """
+
+    def __init__(self, fd, bucket):
+        self.fd = fd
+        self.bucket = bucket
+
+    def read(self, size=-1):
+        data = self.fd.read(size)
+        if data:
+            self.bucket.consume(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fd, name)
+
+def set_bandwidth_limit(rate):
+    """
+    replace the bandwidth limit of this process, e.g. a share of the limit in a child process
+
+    Args:
+        rate:
+            int => bytes per second, 0 for no limit
+
+    Return:
+        None
+    """
+
+    with _limiter_lock:
+        if _limiter['rate'] == rate:
+            return
+
+        _limiter['rate'] = rate
+        _limiter['bucket'] = TokenBucket(rate) if rate > 0 else None
+
+def get_upload_bucket():
+    """
+    get the token bucket shared by all uploads of this process
+
+    Args:
+        None
+
+    Return:
+        object => token bucket, None if UPLOAD_BANDWIDTH_LIMIT is not set
+    """
+
+    with _limiter_lock:
+        if _limiter['rate'] is None:
+            _limiter['rate'] = SYS_PARAMS.UPLOAD_BANDWIDTH_LIMIT
+            if _limiter['rate'] > 0:
+                _limiter['bucket'] = TokenBucket(_limiter['rate'])
+        return _limiter['bucket']
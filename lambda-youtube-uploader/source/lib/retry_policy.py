@@ -0,0 +1,162 @@
+# ===========================================================
+# Retry policy shared by YouTube, TaiBIF and s3 calls
+# Backoff sleeps and upload chunks are only started if they
+# can finish before the deadline of the lambda invocation
+# ===========================================================
+
+import random
+import threading
+import time
+
+from lib.sys_params import SYS_PARAMS
+
+# ===========================
+#        Properties
+# ===========================
+
+# Maximum number of times to retry before giving up.
+MAX_RETRIES = 10
+
+# longest backoff sleep in seconds
+MAX_SLEEP_SECONDS = 64
+
+_deadline = {'at': None} # time.monotonic() to stop at, None without a deadline
+_deadline_lock = threading.Lock()
+
+class DeadlineExceeded(Exception):
+    """
+    the work cannot finish before the lambda times out, it should be saved and re-queued
+    """
+
+class RetriesExhausted(Exception):
+    """
+    a call still fails after MAX_RETRIES retries
+    """
+
+# ===========================
+#         Deadline
+# ===========================
+
+def set_deadline(context):
+    """
+    set the deadline of this invocation from the lambda context, DEADLINE_MARGIN_SECONDS
+    before the timeout are kept for saving the progress and returning
+
+    Args:
+        context:
+            object => lambda context, None for no deadline (worker, backfill)
+
+    Return:
+        None
+    """
+
+    with _deadline_lock:
+        if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+            _deadline['at'] = None
+        else:
+            remaining = context.get_remaining_time_in_millis() / 1000 - SYS_PARAMS.DEADLINE_MARGIN_SECONDS
+            _deadline['at'] = time.monotonic() + remaining
+
+def get_remaining_seconds():
+    """
+    get the time left before the deadline
+
+    Args:
+        None
+
+    Return:
+        float => seconds, None without a deadline
+    """
+
+    deadline = _deadline['at']
+    if deadline is None:
+        return None
+
+    return deadline - time.monotonic()
+
+def check_deadline(seconds_needed, action):
+    """
+    make sure an action can finish before the deadline
+
+    Args:
+        seconds_needed:
+            float => estimated time of the action
+        action:
+            string => what is about to start, for the error message
+
+    Return:
+        None
+    """
+
+    remaining = get_remaining_seconds()
+    if remaining is not None and remaining < seconds_needed:
+        raise DeadlineExceeded('{:.1f} s left, not enough for {} ({:.1f} s)'.format(remaining, action, seconds_needed))
+
+# ===========================
+#          Policy
+# ===========================
+
+class RetryPolicy:
+    """
+    exponential backoff with full jitter, bounded by the retry count and the deadline
+    """
+
+    def __init__(self, max_retries=MAX_RETRIES, max_sleep=MAX_SLEEP_SECONDS):
+        self.max_retries = max_retries
+        self.max_sleep = max_sleep
+
+    def backoff(self, retry, action):
+        """
+        sleep before the given retry
+
+        Args:
+            retry:
+                int => number of the retry, starts from 1
+            action:
+                string => what is retried, for the messages
+
+        Return:
+            None
+        """
+
+        if retry > self.max_retries:
+            raise RetriesExhausted('No longer attempting to retry {}.'.format(action))
+
+        sleep_seconds = random.random() * min(self.max_sleep, 2 ** retry)
+
+        # a sleep must leave time for the retry itself
+        check_deadline(sleep_seconds, 'sleeping before retrying {}'.format(action))
+
+        print('Sleeping %f seconds and then retrying...' % sleep_seconds)
+        time.sleep(sleep_seconds)
+
+    def call(self, func, is_retriable, action):
+        """
+        call func until it succeeds or the error is not retriable
+
+        Args:
+            func:
+                function => called without arguments
+            is_retriable:
+                function => gets the exception and returns True if the call should be retried
+            action:
+                string => what is called, for the messages
+
+        Return:
+            object => result of func
+        """
+
+        retry = 0
+        while True:
+            check_deadline(0, action)
+            try:
+                return func()
+            except Exception as e:
+                if not is_retriable(e):
+                    raise
+                print('A retriable error occurred in {}: {}'.format(action, e))
+
+            retry += 1
+            self.backoff(retry, action)
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
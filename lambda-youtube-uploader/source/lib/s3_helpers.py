@@ -3,30 +3,119 @@
 # ========================
 
 import collections
+import time
 from lib.sys_params import SYS_PARAMS
 
-import boto3
-import botocore
+import botocore.exceptions
 
 import lib.s3_helpers
-from lib.common_helpers import get_full_download_path
+from lib.common_helpers import get_full_download_path, get_memory_size
+from lib.content_hash import HashingWriter
+from lib.clients import get_s3_client
+from lib.retry_policy import DEFAULT_RETRY_POLICY
 
-def get_s3_resource():
+# ===========================
+#        Properties
+# ===========================
+
+MB = 1024 * 1024
+
+# part size limits of the ranged GETs, s3 serves about the same rate per connection
+# for any part larger than 8MB, smaller parts spend most of their time on requests
+MIN_PART_SIZE = 8 * MB
+MAX_PART_SIZE = 64 * MB
+MAX_CONCURRENCY = 16
+
+# lambda gets more network bandwidth with more memory, one connection per 256MB
+# keeps the connections busy without waiting on each other
+MEMORY_PER_CONNECTION = 256
+
+# error codes of s3 which are worth another try
+RETRIABLE_ERROR_CODES = ('SlowDown', 'RequestTimeout', 'InternalError', 'ServiceUnavailable')
+
+def is_retriable_error(e):
     """
-    get s3 resource for further process
+    check if a failed s3 call may succeed when it is made again,
+    boto3 retries by itself first, this covers the errors left after that
 
     Args:
-        None
+        e:
+            exception => error raised by boto3
 
     Return:
-        object => s3 resource
+        bool => True if the call should be retried
     """
 
-    # init the boto3 session
-    session = boto3.session.Session()
-    return session.resource('s3')
+    if isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.ReadTimeoutError)):
+        return True
 
-def download_file_to_tmp(bucket, file_name, file_key):
+    if isinstance(e, botocore.exceptions.ClientError):
+        return (e.response['Error']['Code'] in RETRIABLE_ERROR_CODES or
+                e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500)
+
+    return False
+
+def call_s3(func, action, **kwargs):
+    """
+    call a s3 client method with the shared retry policy
+
+    Args:
+        func:
+            function => method of the s3 client
+        action:
+            string => name of the call, for the messages
+        **kwargs:
+            arguments of the call
+
+    Return:
+        object => result of the call
+    """
+
+    return DEFAULT_RETRY_POLICY.call(lambda: func(**kwargs), is_retriable_error, action)
+
+def tune_transfer_config(object_size, memory_size=None):
+    """
+    pick the part size and the number of threads of a download from the object size
+    and the lambda memory size, SYS_PARAMS.DOWNLOAD_* override the picked values
+
+    Args:
+        object_size:
+            int => object size in bytes
+        memory_size:
+            int => lambda memory size in MB, read from AWS_LAMBDA_FUNCTION_MEMORY_SIZE if not given
+
+    Return:
+        object => boto3 TransferConfig
+    """
+
+    from boto3.s3.transfer import TransferConfig
+
+    if memory_size is None:
+        memory_size = get_memory_size()
+
+    concurrency = SYS_PARAMS.DOWNLOAD_MAX_CONCURRENCY
+    if concurrency <= 0:
+        concurrency = max(2, min(MAX_CONCURRENCY, memory_size // MEMORY_PER_CONNECTION))
+
+    part_size = SYS_PARAMS.DOWNLOAD_PART_SIZE
+    if part_size <= 0:
+        # split the object evenly between the threads, rounded up to whole MB
+        part_size = -(-object_size // concurrency)
+        part_size = max(MIN_PART_SIZE, min(MAX_PART_SIZE, -(-part_size // MB) * MB))
+
+        # the parts being downloaded are buffered in memory, keep them under a quarter of it
+        while part_size > MIN_PART_SIZE and part_size * concurrency > memory_size * MB // 4:
+            part_size //= 2
+
+    # an object smaller than one part is downloaded with a single GET
+    concurrency = max(1, min(concurrency, -(-object_size // part_size)))
+
+    return TransferConfig(multipart_threshold=part_size,
+                          multipart_chunksize=part_size,
+                          max_concurrency=concurrency,
+                          use_threads=SYS_PARAMS.DOWNLOAD_USE_THREADS)
+
+def download_file_to_tmp(bucket, file_name, file_key, object_size=None, hasher=None):
     """
     download file from s3 bucket to a temporary folder for further process
 
@@ -37,16 +126,41 @@ def download_file_to_tmp(bucket, file_name, file_key):
             string => target bucket
         file_key: 
             string => object key from s3
+        object_size:
+            int => object size in bytes, read with head_object if not given
+        hasher:
+            object => ContentHasher fed with the bytes while they are written
 
     Return:
         None
     """
 
     # get s3 client
-    s3 = get_s3_resource()
+    s3 = get_s3_client()
+    path = get_full_download_path(file_name)
+
+    def download():
+        if hasher is None:
+            s3.download_file(bucket, file_key, path, Config=config)
+            return
+
+        # a retry writes the file again from the beginning, so the hash starts over too
+        hasher.reset()
+        with open(path, 'wb') as f:
+            s3.download_fileobj(bucket, file_key, HashingWriter(f, hasher), Config=config)
 
     try:    
-        s3.Object(bucket, file_key).download_file(get_full_download_path(file_name))
+        if object_size is None:
+            object_size = call_s3(s3.head_object, 'head_object', Bucket=bucket, Key=file_key)['ContentLength']
+        config = tune_transfer_config(object_size)
+
+        start_time = time.time()
+        DEFAULT_RETRY_POLICY.call(download, is_retriable_error, 'download')
+        elapsed = max(time.time() - start_time, 0.001)
+
+        print('Downloaded {:.1f} MB in {:.2f} s, {:.1f} MB/s (part size {} MB, {} threads)'.format(
+            object_size / MB, elapsed, object_size / MB / elapsed,
+            config.multipart_chunksize // MB, config.max_concurrency))
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404":
             print("The object does not exist.")
@@ -73,10 +187,10 @@ def upload_json_file(bucket, key, body, tagging_string):
     """
 
     # get s3 client
-    s3 = get_s3_resource()
+    s3 = get_s3_client()
     
     try:    
-        reponse = s3.meta.client.put_object(Bucket=bucket, Key=key, Body=body, Tagging=tagging_string, ContentType='application/json', ContentEncoding='utf-8', ACL='public-read')
+        reponse = call_s3(s3.put_object, 'put_object', Bucket=bucket, Key=key, Body=body, Tagging=tagging_string, ContentType='application/json', ContentEncoding='utf-8', ACL='public-read')
         print(reponse)
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404":
@@ -88,6 +202,23 @@ def upload_json_file(bucket, key, body, tagging_string):
         print(e)
         raise
 
+def get_object_head(bucket, key):
+    """
+    get size, type and modification time of an object without downloading it
+
+    Args:
+        bucket:
+            string => bucket name
+        key: 
+            string => object key
+
+    Return:
+        dict => head_object response
+    """
+
+    s3 = get_s3_client()
+    return call_s3(s3.head_object, 'head_object', Bucket=bucket, Key=key)
+
 def split_file_name(key):
     """
     split s3 object key to session_id and file name
@@ -116,12 +247,12 @@ def obtain_object_tags_from_s3(key):
     """
 
     # get s3 client
-    s3 = get_s3_resource()
+    s3 = get_s3_client()
 
     tag_dict = collections.OrderedDict()
 
     try:    
-        tags = s3.meta.client.get_object_tagging(Bucket=SYS_PARAMS.SRC_BUCKET, Key=key)['TagSet']
+        tags = call_s3(s3.get_object_tagging, 'get_object_tagging', Bucket=SYS_PARAMS.SRC_BUCKET, Key=key)['TagSet']
         for tag in tags:
             tag_dict.update({tag.setdefault('Key', 'NULL'): tag.setdefault('Value', 'NULL')})
 
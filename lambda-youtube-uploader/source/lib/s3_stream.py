@@ -0,0 +1,204 @@
+# ==========================================================
+# Read-only file object over a s3 object
+# The object is fetched block by block with ranged GETs,
+# the following blocks are fetched ahead in the background
+# ==========================================================
+
+import collections
+import concurrent.futures
+import io
+import threading
+
+from lib.clients import get_s3_client
+
+class S3RangeReader(io.RawIOBase):
+    """
+    seekable file object of a s3 object, nothing is written to the disk.
+    at most (read_ahead + cache_blocks) blocks are kept in memory
+    """
+
+    def __init__(self, bucket, key, size, block_size, read_ahead=0, cache_blocks=1, hasher=None):
+        """
+        Args:
+            bucket:
+                string => bucket name
+            key:
+                string => object key
+            size:
+                int => object size in bytes, from head_object
+            block_size:
+                int => bytes of every ranged GET
+            read_ahead:
+                int => number of blocks fetched ahead of the current position
+            cache_blocks:
+                int => number of the most recently read blocks kept, for parsers jumping
+                       between the beginning and the end of the object
+            hasher:
+                object => ContentHasher fed with every byte the first time it is read in order
+        """
+
+        super().__init__()
+
+        self.bucket = bucket
+        self.key = key
+        self.name = 's3://{}/{}'.format(bucket, key)
+        self.size = size
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        self.cache_blocks = max(1, cache_blocks)
+        self.bytes_fetched = 0
+        self.hasher = hasher
+        self.hashed_until = 0 # every byte before this offset has been hashed
+
+        self._s3 = get_s3_client()
+        self._lock = threading.Lock()
+        self._position = 0
+        self._blocks = {} # block index => future of the block content
+        self._cache = collections.OrderedDict() # block index => content, least recently read first
+        self._executor = None
+        if read_ahead > 0:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=read_ahead)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('Invalid whence: {}'.format(whence))
+
+        if position < 0:
+            raise ValueError('Negative seek position: {}'.format(position))
+
+        self._position = position
+        return position
+
+    def fetch_block(self, index):
+        """
+        get a block with a ranged GET
+
+        Args:
+            index:
+                int => block index
+
+        Return:
+            bytes => block content
+        """
+
+        start = index * self.block_size
+        end = min(start + self.block_size, self.size) - 1
+        response = self._s3.get_object(Bucket=self.bucket, Key=self.key, Range='bytes={}-{}'.format(start, end))
+        block = response['Body'].read()
+
+        with self._lock:
+            self.bytes_fetched += len(block)
+
+        return block
+
+    def get_block(self, index):
+        """
+        get a block, schedule the following ones and drop the blocks out of the window
+
+        Args:
+            index:
+                int => block index
+
+        Return:
+            bytes => block content
+        """
+
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+
+        last_index = (self.size - 1) // self.block_size
+        window = range(index, min(index + self.read_ahead, last_index) + 1)
+
+        for block_index in list(self._blocks):
+            if block_index not in window:
+                self._blocks.pop(block_index).cancel()
+
+        if self._executor is None:
+            block = self.fetch_block(index)
+        else:
+            for block_index in window:
+                if block_index not in self._blocks:
+                    self._blocks[block_index] = self._executor.submit(self.fetch_block, block_index)
+            block = self._blocks[index].result()
+
+        self._cache[index] = block
+        while len(self._cache) > self.cache_blocks:
+            self._cache.popitem(last=False)
+
+        return block
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+
+        end = self.size if size is None or size < 0 else min(self.size, self._position + size)
+
+        chunks = []
+        while self._position < end:
+            index = self._position // self.block_size
+            block = self.get_block(index)
+            offset = self._position - index * self.block_size
+            chunk = block[offset:offset + end - self._position]
+            if len(chunk) == 0:
+                break
+
+            chunks.append(chunk)
+            self.update_hash(chunk)
+            self._position += len(chunk)
+
+        return b''.join(chunks)
+
+    def update_hash(self, chunk):
+        """
+        hash the part of a chunk read at the current position which is not hashed yet,
+        a chunk read again after a seek back is skipped
+
+        Args:
+            chunk:
+                bytes => data read at the current position
+
+        Return:
+            None
+        """
+
+        if self.hasher is None:
+            return
+
+        end = self._position + len(chunk)
+        if self._position <= self.hashed_until < end:
+            self.hasher.update(chunk[self.hashed_until - self._position:])
+            self.hashed_until = end
+
+    def is_hash_complete(self):
+        return self.hasher is not None and self.hashed_until == self.size
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            for future in self._blocks.values():
+                future.cancel()
+            self._blocks.clear()
+            self._cache.clear()
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+        super().close()
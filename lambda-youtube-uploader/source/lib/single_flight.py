@@ -0,0 +1,108 @@
+# ===========================================================
+# Single-flight creation of shared resources, e.g. the
+# playlist of a new camera location. Threads of a process
+# wait on a lock, processes on a lease in the state store:
+# one creator proceeds and the others wait for its result
+# ===========================================================
+
+import threading
+import time
+
+from lib.retry_policy import check_deadline
+from lib.state_store import get_state_store
+
+# ===========================
+#        Properties
+# ===========================
+
+# seconds between two looks at the lease of another process
+POLL_SECONDS = 1
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+def get_local_lock(key):
+    with _locks_lock:
+        if key not in _locks:
+            _locks[key] = threading.Lock()
+        return _locks[key]
+
+def single_flight(key, find, create, lease_seconds):
+    """
+    create the resource of a key once, the threads and processes which ask
+    at the same time get the result of the one creator
+
+    Args:
+        key:
+            string => resource key, e.g. 'playlist:<title>'
+        find:
+            function => returns the resource if this process knows it already, None otherwise
+        create:
+            function => creates the resource and returns it, None on failure
+        lease_seconds:
+            float => time the creator has before another process takes over,
+                     its result is also handed out for this long
+
+    Return:
+        object => resource
+    """
+
+    with get_local_lock(key):
+        # another thread may have created it while this one waited
+        result = find()
+        if result is not None:
+            return result
+
+        state_store = get_state_store()
+        if state_store is None:
+            return create()
+
+        lease_key = 'lease:{}'.format(key)
+        while True:
+            lease, version = state_store.get_versioned(lease_key)
+            new_lease = {'expires_at': time.time() + lease_seconds, 'result': None}
+
+            if lease is None:
+                acquired = state_store.put_if_absent(lease_key, new_lease, lease_seconds)
+
+            # the resource was created recently, afterwards find() of the callers knows it
+            elif lease['result'] is not None and lease['expires_at'] > time.time():
+                return lease['result']
+
+            # the creator is gone or its result is old, only one of the waiters replaces the lease it read
+            elif lease['expires_at'] <= time.time():
+                acquired = state_store.replace_if(lease_key, version, new_lease, lease_seconds)
+
+            else:
+                check_deadline(POLL_SECONDS, 'waiting for {}'.format(key))
+                time.sleep(POLL_SECONDS)
+                continue
+
+            if acquired:
+                try:
+                    result = create()
+                except BaseException:
+                    state_store.delete(lease_key)
+                    raise
+
+                if result is None:
+                    state_store.delete(lease_key)
+                else:
+                    state_store.put(lease_key, {'expires_at': time.time() + lease_seconds, 'result': result}, lease_seconds)
+                return result
+
+def forget(key):
+    """
+    drop the result of a key, e.g. the resource was deleted, so the next caller creates it again
+
+    Args:
+        key:
+            string => resource key
+
+    Return:
+        None
+    """
+
+    state_store = get_state_store()
+    if state_store is not None:
+        state_store.delete('lease:{}'.format(key))
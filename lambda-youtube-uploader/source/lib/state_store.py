@@ -0,0 +1,557 @@
+# ===========================================================
+# Small json documents that outlive a lambda invocation
+# e.g. the YouTube resumable upload session of a video
+# Stores: local directory, s3 prefix or DynamoDB table
+# ===========================================================
+
+import json
+import os
+import threading
+import time
+import uuid
+
+import botocore.exceptions
+
+from lib.sys_params import SYS_PARAMS
+from lib.clients import get_boto3_session, get_s3_client
+from lib.common_helpers import to_md5_hexdigest
+
+# ===========================
+#        Properties
+# ===========================
+
+# a lock file of the local store older than this was left by a stopped process
+STALE_LOCK_SECONDS = 10
+
+_store = {'instance': None}
+_store_lock = threading.Lock()
+
+# etag sent with the conditional replace of the current thread
+_if_match = threading.local()
+
+# ===========================
+#          Stores
+# ===========================
+
+class LocalFileStateStore:
+    """
+    one json file per key in a local directory, for tests and the local worker.
+    documents are kept until they are deleted, whatever their ttl
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def get_file_path(self, key):
+        return os.path.join(self.path, '{}.json'.format(to_md5_hexdigest(key)))
+
+    def get(self, key):
+        """
+        get the document of a key
+
+        Args:
+            key:
+                string => document key
+
+        Return:
+            dict => document, None if it does not exist
+        """
+
+        try:
+            with open(self.get_file_path(key), encoding='utf8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, value, ttl=None):
+        """
+        save the document of a key, the old file is replaced in one step
+
+        Args:
+            key:
+                string => document key
+            value:
+                dict => document
+            ttl:
+                int => seconds the document is needed, None to keep it
+
+        Return:
+            None
+        """
+
+        path = self.get_file_path(key)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def put_if_absent(self, key, value, ttl=None):
+        """
+        save the document of a key only if the key does not exist
+
+        Args:
+            key:
+                string => document key
+            value:
+                dict => document
+            ttl:
+                int => seconds the document is needed, None to keep it
+
+        Return:
+            bool => True if the document was saved
+        """
+
+        path = self.get_file_path(key)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(value, f, ensure_ascii=False)
+
+        # a hard link is created in one step and fails if the file exists
+        try:
+            os.link(tmp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    def get_versioned(self, key):
+        """
+        get the document of a key with the version replace_if compares
+
+        Args:
+            key:
+                string => document key
+
+        Return:
+            tuple => document and version, (None, None) if it does not exist
+        """
+
+        try:
+            with open(self.get_file_path(key), encoding='utf8') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None, None
+
+        return json.loads(content), content
+
+    def replace_if(self, key, version, value, ttl=None):
+        """
+        replace the document of a key only if it is still the version read by get_versioned.
+        the writers of a key take turns with a lock file, the new file replaces the old one in one step
+
+        Args:
+            key:
+                string => document key
+            version:
+                string => version returned by get_versioned
+            value:
+                dict => document
+            ttl:
+                int => seconds the document is needed, None to keep it
+
+        Return:
+            bool => True if the document was replaced
+        """
+
+        path = self.get_file_path(key)
+        lock_path = '{}.lock'.format(path)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(value, f, ensure_ascii=False)
+
+        try:
+            self.acquire_lock(lock_path)
+            try:
+                with open(path, encoding='utf8') as f:
+                    if f.read() != version:
+                        return False
+                os.replace(tmp_path, path)
+                return True
+            except FileNotFoundError:
+                return False
+            finally:
+                os.remove(lock_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def acquire_lock(self, lock_path):
+        # creating a file with O_EXCL fails if it exists, on every platform
+        while True:
+            try:
+                os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return
+            except FileExistsError:
+                pass
+
+            try:
+                if time.time() - os.path.getmtime(lock_path) > STALE_LOCK_SECONDS:
+                    os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+
+            time.sleep(0.001)
+
+    def delete(self, key):
+        try:
+            os.remove(self.get_file_path(key))
+        except FileNotFoundError:
+            pass
+
+class S3StateStore:
+    """
+    one json object per key under a prefix. the prefix should not be
+    watched by the upload notification of the bucket. documents are
+    kept until they are deleted, whatever their ttl
+    """
+
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.conditional_s3 = None
+        self.if_match_s3 = None
+
+    def get_object_key(self, key):
+        return '{}{}.json'.format(self.prefix, to_md5_hexdigest(key))
+
+    def get(self, key):
+        """
+        get the document of a key
+
+        Args:
+            key:
+                string => document key
+
+        Return:
+            dict => document, None if it does not exist
+        """
+
+        try:
+            response = get_s3_client().get_object(Bucket=self.bucket, Key=self.get_object_key(key))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+
+        return json.loads(response['Body'].read().decode('utf8'))
+
+    def put(self, key, value, ttl=None):
+        """
+        save the document of a key
+
+        Args:
+            key:
+                string => document key
+            value:
+                dict => document
+            ttl:
+                int => seconds the document is needed, None to keep it
+
+        Return:
+            None
+        """
+
+        get_s3_client().put_object(Bucket=self.bucket,
+                                   Key=self.get_object_key(key),
+                                   Body=json.dumps(value, ensure_ascii=False).encode('utf8'),
+                                   ContentType='application/json')
+
+    def put_if_absent(self, key, value, ttl=None):
+        """
+        save the document of a key only if the key does not exist, with a conditional write of s3
+
+        Args:
+            key:
+                string => document key
+            value:
+                dict => document
+            ttl:
+                int => seconds the document is needed, None to keep it
+
+        Return:
+            bool => True if the document was saved
+        """
+
+        # every put of this client is sent with 'If-None-Match: *', which also works
+        # with the versions of botocore that have no IfNoneMatch parameter
+        if self.conditional_s3 is None:
+            conditional_s3 = get_boto3_session().client('s3')
+            conditional_s3.meta.events.register('before-sign.s3.PutObject', add_if_none_match_header)
+            self.conditional_s3 = conditional_s3
+
+        try:
+            self.conditional_s3.put_object(Bucket=self.bucket,
+                                           Key=self.get_object_key(key),
+                                           Body=json.dumps(value, ensure_ascii=False).encode('utf8'),
+                                           ContentType='application/json')
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+                return False
+            raise
+
+    def get_versioned(self, key):
+        """
+        get the document of a key with the etag replace_if compares
+
+        Args:
+            key:
+                string => document key
+
+        Return:
+            tuple => document and etag, (None, None) if it does not exist
+        """
+
+        try:
+            response = get_s3_client().get_object(Bucket=self.bucket, Key=self.get_object_key(key))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None, None
+            raise
+
+        return json.loads(response['Body'].read().decode('utf8')), response['ETag']
+
+    def replace_if(self, key, version, value, ttl=None):
+        """
+        replace the document of a key only if its etag is still version, with a conditional write of s3
+
+        Args:
+            key:
+                string => document key
+            version:
+                string => etag returned by get_versioned
+            value:
+                dict => document
+            ttl:
+                int => seconds the document is needed, None to keep it
+
+        Return:
+            bool => True if the document was replaced
+        """
+
+        # every put of this client is sent with the 'If-Match' etag of its thread
+        if self.if_match_s3 is None:
+            if_match_s3 = get_boto3_session().client('s3')
+            if_match_s3.meta.events.register('before-sign.s3.PutObject', add_if_match_header)
+            self.if_match_s3 = if_match_s3
+
+        _if_match.etag = version
+        try:
+            self.if_match_s3.put_object(Bucket=self.bucket,
+                                        Key=self.get_object_key(key),
+                                        Body=json.dumps(value, ensure_ascii=False).encode('utf8'),
+                                        ContentType='application/json')
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', 'NoSuchKey', '412', '409', '404'):
+                return False
+            raise
+        finally:
+            _if_match.etag = None
+
+    def delete(self, key):
+        get_s3_client().delete_object(Bucket=self.bucket, Key=self.get_object_key(key))
+
+class DynamoDBStateStore:
+    """
+    one item per key in a table with the string partition key 'key'.
+    items written with a ttl carry 'expires_at' for the TTL of the table,
+    the indexes are written without one and kept. every item has a random
+    'version', which is new on every write, for replace_if
+    """
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.dynamodb = get_boto3_session().client('dynamodb')
+
+    def get(self, key):
+        """
+        get the document of a key
+
+        Args:
+            key:
+                string => document key
+
+        Return:
+            dict => document, None if it does not exist
+        """
+
+        response = self.dynamodb.get_item(TableName=self.table_name,
+                                          Key={'key': {'S': key}},
+                                          ConsistentRead=True)
+        if 'Item' not in response:
+            return None
+
+        return json.loads(response['Item']['value']['S'])
+
+    def put(self, key, value, ttl=None):
+        """
+        save the document of a key
+
+        Args:
+            key:
+                string => document key
+            value:
+                dict => document
+            ttl:
+                int => seconds the document is needed, None to keep it
+
+        Return:
+            None
+        """
+
+        self.dynamodb.put_item(TableName=self.table_name, Item=self.create_item(key, value, ttl))
+
+    def create_item(self, key, value, ttl):
+        item = {
+            'key': {'S': key},
+            'value': {'S': json.dumps(value, ensure_ascii=False)},
+            'version': {'S': uuid.uuid4().hex}
+        }
+        if ttl is not None:
+            item['expires_at'] = {'N': str(int(time.time() + ttl))}
+        return item
+
+    def put_if_absent(self, key, value, ttl=None):
+        """
+        save the document of a key only if the key does not exist
+
+        Args:
+            key:
+                string => document key
+            value:
+                dict => document
+            ttl:
+                int => seconds the document is needed, None to keep it
+
+        Return:
+            bool => True if the document was saved
+        """
+
+        try:
+            self.dynamodb.put_item(TableName=self.table_name,
+                                   Item=self.create_item(key, value, ttl),
+                                   ConditionExpression='attribute_not_exists(#key)',
+                                   ExpressionAttributeNames={'#key': 'key'})
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def get_versioned(self, key):
+        """
+        get the document of a key with the version replace_if compares
+
+        Args:
+            key:
+                string => document key
+
+        Return:
+            tuple => document and version, (None, None) if it does not exist
+        """
+
+        response = self.dynamodb.get_item(TableName=self.table_name,
+                                          Key={'key': {'S': key}},
+                                          ConsistentRead=True)
+        if 'Item' not in response:
+            return None, None
+
+        # items written before the versions have an empty one
+        return json.loads(response['Item']['value']['S']), response['Item'].get('version', {}).get('S', '')
+
+    def replace_if(self, key, version, value, ttl=None):
+        """
+        replace the document of a key only if its version is still the one read by get_versioned
+
+        Args:
+            key:
+                string => document key
+            version:
+                string => version returned by get_versioned
+            value:
+                dict => document
+            ttl:
+                int => seconds the document is needed, None to keep it
+
+        Return:
+            bool => True if the document was replaced
+        """
+
+        if version:
+            condition = {'ConditionExpression': '#version = :version',
+                         'ExpressionAttributeNames': {'#version': 'version'},
+                         'ExpressionAttributeValues': {':version': {'S': version}}}
+        else:
+            condition = {'ConditionExpression': 'attribute_exists(#key) AND attribute_not_exists(#version)',
+                         'ExpressionAttributeNames': {'#key': 'key', '#version': 'version'}}
+
+        try:
+            self.dynamodb.put_item(TableName=self.table_name, Item=self.create_item(key, value, ttl), **condition)
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def delete(self, key):
+        self.dynamodb.delete_item(TableName=self.table_name, Key={'key': {'S': key}})
+
+def add_if_none_match_header(request, **kwargs):
+    request.headers['If-None-Match'] = '*'
+
+def add_if_match_header(request, **kwargs):
+    request.headers['If-Match'] = _if_match.etag
+
+# ===========================
+#        Commen usage
+# ===========================
+
+def create_state_store(store_type, location):
+    """
+    create a state store
+
+    Args:
+        store_type:
+            string => 'local', 's3' or 'dynamodb'
+        location:
+            string => directory for 'local', bucket/prefix for 's3', table name for 'dynamodb'
+
+    Return:
+        object => state store
+    """
+
+    if store_type == 'local':
+        return LocalFileStateStore(location)
+
+    if store_type == 's3':
+        bucket, _, prefix = location.replace('s3://', '', 1).partition('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        return S3StateStore(bucket, prefix)
+
+    if store_type == 'dynamodb':
+        return DynamoDBStateStore(location)
+
+    raise ValueError('Unknown state store: {}'.format(store_type))
+
+def get_state_store():
+    """
+    get the state store configured by STATE_STORE and STATE_STORE_LOCATION
+
+    Args:
+        None
+
+    Return:
+        object => state store, None if STATE_STORE is not set
+    """
+
+    if not SYS_PARAMS.STATE_STORE:
+        return None
+
+    with _store_lock:
+        if _store['instance'] is None:
+            _store['instance'] = create_state_store(SYS_PARAMS.STATE_STORE, SYS_PARAMS.STATE_STORE_LOCATION)
+        return _store['instance']
@@ -32,5 +32,62 @@ SYS_PARAMS = ObjDict({
     'CLIENT_ID': os.environ['CLIENT_ID'],
     'CLIENT_SECRET': os.environ['CLIENT_SECRET'],
     'REFRESH_TOKEN': os.environ['REFRESH_TOKEN'],
-    'TAIBIF_API_URL': os.environ['TAIBIF_API_URL']
+    'TAIBIF_API_URL': os.environ['TAIBIF_API_URL'],
+    'MAX_WORKERS': int(os.environ.get('MAX_WORKERS', '4')),
+    'REUSE_CLIENTS': os.environ.get('REUSE_CLIENTS', 'true').lower() in ('1', 'true', 'yes'),
+    'STREAM_UPLOAD': os.environ.get('STREAM_UPLOAD', 'false').lower() in ('1', 'true', 'yes'),
+    'STREAM_BLOCK_SIZE': int(os.environ.get('STREAM_BLOCK_SIZE', str(8 * 1024 * 1024))),
+    'STREAM_READ_AHEAD': int(os.environ.get('STREAM_READ_AHEAD', '4')),
+    # 0 lets the download pick the value from the object size and the lambda memory size
+    'DOWNLOAD_MAX_CONCURRENCY': int(os.environ.get('DOWNLOAD_MAX_CONCURRENCY', '0')),
+    'DOWNLOAD_PART_SIZE': int(os.environ.get('DOWNLOAD_PART_SIZE', '0')),
+    'DOWNLOAD_USE_THREADS': os.environ.get('DOWNLOAD_USE_THREADS', 'true').lower() in ('1', 'true', 'yes'),
+    # 'local', 's3' or 'dynamodb', upload sessions are not persisted if empty
+    'STATE_STORE': os.environ.get('STATE_STORE', ''),
+    'STATE_STORE_LOCATION': os.environ.get('STATE_STORE_LOCATION', ''),
+    # chunk size of the uploads whose session is persisted, a multiple of 256KB
+    'UPLOAD_CHUNK_SIZE': int(os.environ.get('UPLOAD_CHUNK_SIZE', str(32 * 1024 * 1024))),
+    # upload in chunks sized by the measured throughput, UPLOAD_CHUNK_SIZE is the first chunk
+    'UPLOAD_ADAPTIVE_CHUNKS': os.environ.get('UPLOAD_ADAPTIVE_CHUNKS', 'false').lower() in ('1', 'true', 'yes'),
+    'UPLOAD_CHUNK_TARGET_SECONDS': float(os.environ.get('UPLOAD_CHUNK_TARGET_SECONDS', '10')),
+    # largest chunk in bytes, 0 for a quarter of the lambda memory
+    'UPLOAD_MEMORY_LIMIT': int(os.environ.get('UPLOAD_MEMORY_LIMIT', '0')),
+    # total upload bytes per second of all the uploads of a process, 0 for no limit
+    'UPLOAD_BANDWIDTH_LIMIT': int(os.environ.get('UPLOAD_BANDWIDTH_LIMIT', '0')),
+    # seconds kept before the lambda timeout for saving the progress and returning
+    'DEADLINE_MARGIN_SECONDS': float(os.environ.get('DEADLINE_MARGIN_SECONDS', '15')),
+    # TaiBIF media queries of concurrent records are sent together in '$or' batches
+    'TAIBIF_BATCH_WINDOW_MS': float(os.environ.get('TAIBIF_BATCH_WINDOW_MS', '20')),
+    'TAIBIF_MAX_BATCH_SIZE': int(os.environ.get('TAIBIF_MAX_BATCH_SIZE', '50')),
+    'TAIBIF_MAX_PAYLOAD_BYTES': int(os.environ.get('TAIBIF_MAX_PAYLOAD_BYTES', str(64 * 1024))),
+    # 'requests' or 'urllib3', both keep a pool of keep-alive connections
+    'TAIBIF_HTTP_BACKEND': os.environ.get('TAIBIF_HTTP_BACKEND', 'requests'),
+    'TAIBIF_CONNECT_TIMEOUT': float(os.environ.get('TAIBIF_CONNECT_TIMEOUT', '3.05')),
+    'TAIBIF_READ_TIMEOUT': float(os.environ.get('TAIBIF_READ_TIMEOUT', '10')),
+    # media query results are cached, videos found for a long time and videos not found for a short time
+    'TAIBIF_CACHE_SIZE': int(os.environ.get('TAIBIF_CACHE_SIZE', '1024')),
+    'TAIBIF_CACHE_TTL': float(os.environ.get('TAIBIF_CACHE_TTL', str(24 * 60 * 60))),
+    'TAIBIF_CACHE_NEGATIVE_TTL': float(os.environ.get('TAIBIF_CACHE_NEGATIVE_TTL', '60')),
+    # sqlite file shared by the worker processes of a machine, empty to cache in the process only
+    'TAIBIF_CACHE_PATH': os.environ.get('TAIBIF_CACHE_PATH', ''),
+    # send a duplicate media query when the first one is slower than the observed p95
+    'TAIBIF_HEDGE': os.environ.get('TAIBIF_HEDGE', 'false').lower() in ('1', 'true', 'yes'),
+    # largest share of the queries which may be duplicated
+    'TAIBIF_HEDGE_BUDGET': float(os.environ.get('TAIBIF_HEDGE_BUDGET', '0.05')),
+    'TAIBIF_HEDGE_MIN_SAMPLES': int(os.environ.get('TAIBIF_HEDGE_MIN_SAMPLES', '20')),
+    'TAIBIF_HEDGE_MIN_DELAY_MS': float(os.environ.get('TAIBIF_HEDGE_MIN_DELAY_MS', '10')),
+    # bucket/key of the json snapshot of the playlist titles and ids, empty to keep them in memory only
+    'PLAYLIST_SNAPSHOT_LOCATION': os.environ.get('PLAYLIST_SNAPSHOT_LOCATION', ''),
+    # add the videos of a batch to their playlists with batch requests after all of them are uploaded
+    'PLAYLIST_ITEMS_BATCH': os.environ.get('PLAYLIST_ITEMS_BATCH', 'false').lower() in ('1', 'true', 'yes'),
+    'PLAYLIST_ITEMS_BATCH_SIZE': int(os.environ.get('PLAYLIST_ITEMS_BATCH_SIZE', '50')),
+    # YouTube Data API units a day, and the units backfill leaves to the uploads of new videos
+    'YOUTUBE_QUOTA_BUDGET': int(os.environ.get('YOUTUBE_QUOTA_BUDGET', '10000')),
+    'YOUTUBE_QUOTA_RESERVE': int(os.environ.get('YOUTUBE_QUOTA_RESERVE', '3300')),
+    # sqs queue of sqs_batch_handler or the worker, the deferred records of an s3 event are
+    # sent there instead of failing the invocation, whose retries run out within minutes
+    'DEFERRED_QUEUE_URL': os.environ.get('DEFERRED_QUEUE_URL', ''),
+    'DEFERRED_DELAY_SECONDS': int(os.environ.get('DEFERRED_DELAY_SECONDS', '900')),
+    # seconds a process may take to create a playlist before another one takes over
+    'PLAYLIST_LEASE_SECONDS': float(os.environ.get('PLAYLIST_LEASE_SECONDS', '60'))
 })
@@ -4,10 +4,16 @@
 
 from lib.sys_params import SYS_PARAMS
 import json
+import threading
+import time
 from http import HTTPStatus
 from urllib.error import HTTPError
 
-import requests
+from lib.clients import get_http_pool, get_http_session
+from lib.hedging import HedgeBudget, hedged_call
+from lib.latency import get_histogram
+from lib.retry_policy import DEFAULT_RETRY_POLICY
+from lib.ttl_cache import SqliteCache, TTLCache
 
 REQ_HEADER = {
     'Content-Type': 'application/json'
@@ -15,6 +21,19 @@ REQ_HEADER = {
 
 TAIBIF_API_URL = SYS_PARAMS.TAIBIF_API_URL
 
+# fields identifying a video in a media query, also used to match the results of a batch
+QUERY_FIELDS = ('uploaded_file_name', 'date_time_original_timestamp', 'fullCameraLocationMd5')
+
+_hedge_budget = HedgeBudget(SYS_PARAMS.TAIBIF_HEDGE_BUDGET)
+
+_cache = {'instance': None, 'created': False}
+_cache_lock = threading.Lock()
+
+# results of prefetch_multimedia_metadata waiting for their records, each is used once
+PREFETCH_MAX_ENTRIES = 10000
+PREFETCH_TTL_SECONDS = 15 * 60 # the longest lambda invocation
+_prefetched = TTLCache(PREFETCH_MAX_ENTRIES)
+
 def create_endpoint(resource, action):
     """
     create an endpoint by giving resourcr and action names
@@ -30,6 +49,123 @@ def create_endpoint(resource, action):
 
     return '{}/{}/{}'.format(TAIBIF_API_URL, resource, action)
 
+class TaibifResponse:
+    """
+    response of either http backend
+    """
+
+    def __init__(self, status_code, reason, content):
+        self.status_code = status_code
+        self.reason = reason
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf8', errors='replace')
+
+class TaibifServerError(Exception):
+    """
+    TaiBIF answered with a 5xx status
+    """
+
+    def __init__(self, resp):
+        super().__init__('status code: {}, reason: {}'.format(resp.status_code, resp.reason))
+        self.response = resp
+
+def is_retriable_error(e):
+    """
+    check if a failed TaiBIF request may succeed when it is sent again
+
+    Args:
+        e: 
+            exception => error raised by the request
+
+    Return:
+        bool => True for connection errors, timeouts and 5xx responses
+    """
+
+    import requests
+    import urllib3
+
+    return isinstance(e, (TaibifServerError,
+                          requests.ConnectionError,
+                          requests.Timeout,
+                          urllib3.exceptions.HTTPError))
+
+def get_endpoint_histogram(endpoint, batch=False):
+    # '$or' queries of many videos take longer than single queries, their latencies
+    # are kept apart so that the p95 of one does not decide the hedging of the other
+    name = 'taibif {}'.format(endpoint[len(TAIBIF_API_URL) + 1:])
+    if batch:
+        name += ' batch'
+    return get_histogram(name)
+
+def post(endpoint, payload, batch=False):
+    """
+    post a payload to TaiBIF over the pooled connections of TAIBIF_HTTP_BACKEND,
+    5xx responses are raised so they can be retried
+
+    Args:
+        endpoint: 
+            string => endpoint url
+        payload: 
+            bytes => request body
+        batch:
+            bool => the payload queries many records, its latency is recorded apart
+
+    Return:
+        object => TaibifResponse
+    """
+
+    histogram = get_endpoint_histogram(endpoint, batch)
+    start_time = time.time()
+
+    try:
+        if SYS_PARAMS.TAIBIF_HTTP_BACKEND == 'urllib3':
+            import urllib3
+
+            raw = get_http_pool().request('POST', endpoint, body=payload, headers=REQ_HEADER,
+                                          timeout=urllib3.Timeout(connect=SYS_PARAMS.TAIBIF_CONNECT_TIMEOUT,
+                                                                  read=SYS_PARAMS.TAIBIF_READ_TIMEOUT))
+            resp = TaibifResponse(raw.status, raw.reason, raw.data)
+        else:
+            raw = get_http_session().post(endpoint, headers=REQ_HEADER, data=payload,
+                                          timeout=(SYS_PARAMS.TAIBIF_CONNECT_TIMEOUT, SYS_PARAMS.TAIBIF_READ_TIMEOUT))
+            resp = TaibifResponse(raw.status_code, raw.reason, raw.content)
+    finally:
+        histogram.record(time.time() - start_time)
+
+    if resp.status_code >= 500:
+        raise TaibifServerError(resp)
+    return resp
+
+def post_hedged(endpoint, payload, batch=False):
+    """
+    post a payload to TaiBIF, with TAIBIF_HEDGE a duplicate is sent when the answer
+    takes longer than the p95 of the endpoint, only for requests which change nothing
+
+    Args:
+        endpoint: 
+            string => endpoint url
+        payload: 
+            bytes => request body
+        batch:
+            bool => the payload queries many records, it is compared with the p95 of other batches
+
+    Return:
+        object => TaibifResponse of the first request which answers
+    """
+
+    if not SYS_PARAMS.TAIBIF_HEDGE:
+        return post(endpoint, payload, batch)
+
+    return hedged_call(lambda: post(endpoint, payload, batch),
+                       get_endpoint_histogram(endpoint, batch),
+                       _hedge_budget,
+                       SYS_PARAMS.TAIBIF_HEDGE_MIN_SAMPLES,
+                       SYS_PARAMS.TAIBIF_HEDGE_MIN_DELAY_MS / 1000,
+                       'taibif api')
+
 def query_multimedia_metadata(file_name, original_datetime, fullCameraLocationMd5):
     """
     check if metadata exists in TaiBIF
@@ -57,7 +193,7 @@ def query_multimedia_metadata(file_name, original_datetime, fullCameraLocationMd
     }, ensure_ascii=False).encode('utf8')
 
     try:
-        resp = requests.post(endpoint, headers=REQ_HEADER, data=payload)
+        resp = DEFAULT_RETRY_POLICY.call(lambda: post_hedged(endpoint, payload), is_retriable_error, 'taibif api')
         json_data = json.loads(resp.content.decode())
 
         if resp.status_code == HTTPStatus.OK:
@@ -71,4 +207,291 @@ def query_multimedia_metadata(file_name, original_datetime, fullCameraLocationMd
 
     return json_data
 
+def split_batches(queries, max_batch_size, max_payload_bytes):
+    """
+    split queries into batches whose '$or' payload stays under the size limits
+
+    Args:
+        queries: 
+            list => query dicts
+        max_batch_size: 
+            int => maximum number of queries in a batch
+        max_payload_bytes: 
+            int => maximum size of the encoded payload
+
+    Return:
+        list => lists of query dicts
+    """
+
+    # the payload wraps the queries in {"query": {"$or": [...]}} and separates them with ", "
+    wrapper_bytes = len(json.dumps({'query': {'$or': []}}).encode('utf8'))
+
+    batches = []
+    batch = []
+    batch_bytes = wrapper_bytes
+    for query in queries:
+        query_bytes = len(json.dumps(query, ensure_ascii=False).encode('utf8')) + 2
+        if len(batch) > 0 and (len(batch) >= max_batch_size or batch_bytes + query_bytes > max_payload_bytes):
+            batches.append(batch)
+            batch = []
+            batch_bytes = wrapper_bytes
+
+        batch.append(query)
+        batch_bytes += query_bytes
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+def query_multimedia_metadata_batch(queries):
+    """
+    check if metadata exists in TaiBIF for many videos with '$or' queries,
+    one request per batch of TAIBIF_MAX_BATCH_SIZE / TAIBIF_MAX_PAYLOAD_BYTES
+
+    Args:
+        queries: 
+            list => (file_name, original_datetime, fullCameraLocationMd5) of every video
+
+    Return:
+        list => result of every query in the same order, in the format of query_multimedia_metadata
+                with the status code of its batch
+    """
+
+    endpoint = create_endpoint('media', 'query')
+
+    query_dicts = [dict(zip(QUERY_FIELDS, query)) for query in queries]
+    results = {tuple(query): [] for query in queries}
+    status_codes = {}
+
+    for batch in split_batches(query_dicts, SYS_PARAMS.TAIBIF_MAX_BATCH_SIZE, SYS_PARAMS.TAIBIF_MAX_PAYLOAD_BYTES):
+        if len(batch) == 1:
+            payload = {'query': batch[0]}
+        else:
+            payload = {'query': {'$or': batch}}
+
+        data = json.dumps(payload, ensure_ascii=False).encode('utf8')
+        resp = DEFAULT_RETRY_POLICY.call(lambda: post_hedged(endpoint, data, len(batch) > 1),
+                                         is_retriable_error, 'taibif api')
+        json_data = json.loads(resp.content.decode())
+
+        for query in batch:
+            status_codes[tuple(query[field] for field in QUERY_FIELDS)] = resp.status_code
+
+        if resp.status_code != HTTPStatus.OK:
+            print('status code: {}, reason: {}. full messag: {}'.format(resp.status_code, resp.reason, resp.text))
+            continue
+
+        print('taibif api - {} queries, {} results'.format(len(batch), len(json_data.get('results') or [])))
+
+        # map every document back to the query it matches
+        for item in json_data.get('results') or []:
+            key = tuple(item.get(field) for field in QUERY_FIELDS)
+            if key in results:
+                results[key].append(item)
+            elif len(batch) == 1:
+                results[tuple(batch[0][field] for field in QUERY_FIELDS)].append(item)
+
+    return [{'results': results[tuple(query)], 'status_code': status_codes.get(tuple(query))} for query in queries]
+
+class QueryCoalescer:
+    """
+    collect the queries made by concurrent threads within a short window
+    and send them with one query_multimedia_metadata_batch call. it is the
+    fallback for the queries which were not prefetched
+    """
+
+    def __init__(self, window_seconds):
+        self.window_seconds = window_seconds
+        self.lock = threading.Lock()
+        self.pending = []
+        self.collecting = False
+
+    def query(self, file_name, original_datetime, fullCameraLocationMd5):
+        """
+        check if metadata exists in TaiBIF, batched with the queries of the other threads
+
+        Args:
+            file_name: 
+                string => target file name
+            original_datetime: 
+                int => video original datetime in timestamp
+            fullCameraLocationMd5: 
+                string => full location after md5
+
+        Return:
+            object => result, in the format of query_multimedia_metadata
+        """
+
+        slot = {'query': (file_name, original_datetime, fullCameraLocationMd5), 'done': threading.Event()}
+
+        with self.lock:
+            self.pending.append(slot)
+            is_sender = not self.collecting
+            self.collecting = True
+
+        # the first thread waits for the others and sends the batch for all of them
+        if is_sender:
+            time.sleep(self.window_seconds)
+            with self.lock:
+                batch = self.pending
+                self.pending = []
+                self.collecting = False
+
+            try:
+                results = query_multimedia_metadata_batch([item['query'] for item in batch])
+                for item, result in zip(batch, results):
+                    item['result'] = result
+            except Exception as e:
+                for item in batch:
+                    item['error'] = e
+            finally:
+                for item in batch:
+                    item['done'].set()
+
+        slot['done'].wait()
+        if 'error' in slot:
+            raise slot['error']
+
+        return slot['result']
+
+_coalescer = QueryCoalescer(SYS_PARAMS.TAIBIF_BATCH_WINDOW_MS / 1000)
+
+def query_multimedia_metadata_coalesced(file_name, original_datetime, fullCameraLocationMd5):
+    """
+    check if metadata exists in TaiBIF, the queries of concurrent records share one request
+
+    Args:
+        file_name: 
+            string => target file name
+        original_datetime: 
+            int => video original datetime in timestamp
+        fullCameraLocationMd5: 
+            string => full location after md5
+
+    Return:
+        object => result, in the format of query_multimedia_metadata
+    """
+
+    return _coalescer.query(file_name, original_datetime, fullCameraLocationMd5)
+
+def get_query_cache():
+    """
+    get the cache of media query results shared by the threads of this process
+
+    Args:
+        None
+
+    Return:
+        object => TTLCache, None if TAIBIF_CACHE_SIZE is 0
+    """
+
+    with _cache_lock:
+        if not _cache['created']:
+            _cache['created'] = True
+            if SYS_PARAMS.TAIBIF_CACHE_SIZE > 0:
+                backing = SqliteCache(SYS_PARAMS.TAIBIF_CACHE_PATH) if SYS_PARAMS.TAIBIF_CACHE_PATH else None
+                _cache['instance'] = TTLCache(SYS_PARAMS.TAIBIF_CACHE_SIZE, backing)
+        return _cache['instance']
+
+def get_query_cache_key(file_name, original_datetime, fullCameraLocationMd5):
+    return 'taibif:media:{}'.format(json.dumps([file_name, original_datetime, fullCameraLocationMd5], ensure_ascii=False))
+
+def prefetch_multimedia_metadata(queries):
+    """
+    query the videos of a batch of records at once, one query_multimedia_metadata_batch call
+    for the queries which are not cached. the results are kept for query_multimedia_metadata_cached
+
+    Args:
+        queries: 
+            list => (file_name, original_datetime, fullCameraLocationMd5) of every video
+
+    Return:
+        None
+    """
+
+    cache = get_query_cache()
+
+    missing = []
+    for query in queries:
+        key = get_query_cache_key(*query)
+        if tuple(query) in missing or (cache is not None and cache.get(key) is not None):
+            continue
+        missing.append(tuple(query))
+
+    if len(missing) == 0:
+        return
+
+    # the records query one by one if the batch fails
+    try:
+        results = query_multimedia_metadata_batch(missing)
+    except Exception as e:
+        print('Failed to prefetch {} TaiBIF queries: {}'.format(len(missing), e))
+        return
+
+    # a failed batch is asked again by the records themselves
+    for query, result in zip(missing, results):
+        if result.get('status_code') == HTTPStatus.OK:
+            _prefetched.put(get_query_cache_key(*query), result, PREFETCH_TTL_SECONDS)
+
+def query_multimedia_metadata_cached(file_name, original_datetime, fullCameraLocationMd5):
+    """
+    check if metadata exists in TaiBIF, answered from the cache when the same video was queried before.
+    found videos are cached for TAIBIF_CACHE_TTL seconds, videos not found for TAIBIF_CACHE_NEGATIVE_TTL seconds
+
+    Args:
+        file_name: 
+            string => target file name
+        original_datetime: 
+            int => video original datetime in timestamp
+        fullCameraLocationMd5: 
+            string => full location after md5
+
+    Return:
+        object => result, in the format of query_multimedia_metadata
+    """
+
+    cache = get_query_cache()
+    key = get_query_cache_key(file_name, original_datetime, fullCameraLocationMd5)
+
+    result = cache.get(key) if cache is not None else None
+    if result is not None:
+        return result
+
+    result = _prefetched.get(key)
+    if result is not None:
+        _prefetched.delete(key)
+    else:
+        result = query_multimedia_metadata_coalesced(file_name, original_datetime, fullCameraLocationMd5)
+
+    if cache is None:
+        return result
+
+    # a failed query says nothing about the video, it is asked again next time
+    if result.get('status_code') == HTTPStatus.OK:
+        if len(result['results']) > 0:
+            cache.put(key, result, SYS_PARAMS.TAIBIF_CACHE_TTL)
+        else:
+            cache.put(key, result, SYS_PARAMS.TAIBIF_CACHE_NEGATIVE_TTL)
+
+    return result
+
+def invalidate_multimedia_metadata(file_name, original_datetime, fullCameraLocationMd5):
+    """
+    remove the cached result of a video, e.g. after its metadata is written
+
+    Args:
+        file_name: 
+            string => target file name
+        original_datetime: 
+            int => video original datetime in timestamp
+        fullCameraLocationMd5: 
+            string => full location after md5
+
+    Return:
+        None
+    """
 
+    cache = get_query_cache()
+    if cache is not None:
+        cache.delete(get_query_cache_key(file_name, original_datetime, fullCameraLocationMd5))
@@ -0,0 +1,166 @@
+# ===========================================================
+# Read-through cache with a time to live per entry
+# An LRU dict in the process, optionally backed by a sqlite
+# file which the worker processes of one machine share
+# ===========================================================
+
+import collections
+import json
+import sqlite3
+import threading
+import time
+
+class SqliteCache:
+    """
+    json values with an expiry time in a sqlite file, safe to share between processes
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.get_connection().execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)')
+
+    def get_connection(self):
+        # sqlite connections cannot be shared by threads, every thread opens its own
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return self.local.connection
+
+    def get(self, key):
+        """
+        get the value of a key
+
+        Args:
+            key:
+                string => cache key
+
+        Return:
+            object, float => value and its expiry time, (None, None) if missing or expired
+        """
+
+        row = self.get_connection().execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return None, None
+
+        return json.loads(row[0]), row[1]
+
+    def put(self, key, value, expires_at):
+        """
+        save the value of a key
+
+        Args:
+            key:
+                string => cache key
+            value:
+                object => json serializable value
+            expires_at:
+                float => unix time when the value expires
+
+        Return:
+            None
+        """
+
+        connection = self.get_connection()
+        connection.execute('INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                           (key, json.dumps(value, ensure_ascii=False), expires_at))
+
+        # expired rows are only removed here, so the file does not keep growing
+        connection.execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+
+    def delete(self, key):
+        self.get_connection().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+class TTLCache:
+    """
+    LRU cache of at most max_entries values, each with its own time to live
+    """
+
+    def __init__(self, max_entries, backing=None):
+        """
+        Args:
+            max_entries:
+                int => number of values kept in the process
+            backing:
+                object => SqliteCache shared with other processes, None to keep values in the process only
+        """
+
+        self.max_entries = max_entries
+        self.backing = backing
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        get the value of a key if it has not expired
+
+        Args:
+            key:
+                string => cache key
+
+        Return:
+            object => value, None if missing or expired
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self.entries.move_to_end(key)
+                    return entry[0]
+                del self.entries[key]
+
+        if self.backing is None:
+            return None
+
+        value, expires_at = self.backing.get(key)
+        if value is not None:
+            self.put_local(key, value, expires_at)
+
+        return value
+
+    def put(self, key, value, ttl):
+        """
+        save the value of a key for ttl seconds
+
+        Args:
+            key:
+                string => cache key
+            value:
+                object => value, json serializable when there is a backing cache
+            ttl:
+                float => seconds the value is valid
+
+        Return:
+            None
+        """
+
+        expires_at = time.time() + ttl
+        self.put_local(key, value, expires_at)
+
+        if self.backing is not None:
+            self.backing.put(key, value, expires_at)
+
+    def put_local(self, key, value, expires_at):
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        """
+        remove a key, e.g. when the cached value is known to be stale
+
+        Args:
+            key:
+                string => cache key
+
+        Return:
+            None
+        """
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+        if self.backing is not None:
+            self.backing.delete(key)
@@ -5,14 +5,23 @@
 import argparse
 import http.client
 import httplib2
-import random
+import threading
 import time
 
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.errors import HttpError, ResumableUploadError
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
 from oauth2client import client, GOOGLE_TOKEN_URI
 from lib.sys_params import SYS_PARAMS
+from lib.chunk_sizer import THROUGHPUT_WEIGHT, ChunkSizer
+from lib.common_helpers import get_memory_size, guess_video_mimetype
+from lib.discovery_document import API_SERVICE_NAME, API_VERSION, get_discovery_document
+from lib.playlist_cache import get_playlist_cache
+from lib.quota import record_quota, record_quota_error
+from lib.rate_limiter import ThrottledReader, get_upload_bucket
+from lib.retry_policy import DEFAULT_RETRY_POLICY, DeadlineExceeded, RetriesExhausted, check_deadline, get_remaining_seconds
+from lib.single_flight import forget, single_flight
+from lib.state_store import get_state_store
 
 # ===========================
 #        Properties
@@ -22,9 +31,6 @@ from lib.sys_params import SYS_PARAMS
 # we are handling retry logic ourselves.
 httplib2.RETRIES = 1
 
-# Maximum number of times to retry before giving up.
-MAX_RETRIES = 10
-
 # Always retry when these exceptions are raised.
 RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error, IOError, http.client.NotConnected,
                         http.client.IncompleteRead, http.client.ImproperConnectionState,
@@ -35,37 +41,120 @@ RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error, IOError, http.client.NotConnecte
 # codes is raised.
 RETRIABLE_STATUS_CODES = [500, 502, 503, 504]
 
+# status codes of a resumable session which has expired or been cancelled
+EXPIRED_SESSION_STATUS_CODES = [404, 410]
+
+# YouTube keeps an unfinished upload session for about a week
+UPLOAD_SESSION_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# largest page of playlists.list
+PLAYLISTS_PAGE_SIZE = 50
+
+class UploadFailed(Exception):
+    """
+    YouTube finished the upload without returning a video id
+    """
+
 # This OAuth 2.0 access scope allows an application to upload files to the
 # authenticated user's YouTube channel, but doesn't allow other types of access.
 SCOPES = ['https://www.googleapis.com/auth/youtube.upload']
-API_SERVICE_NAME = 'youtube'
-API_VERSION = 'v3'
+
+_playlist_item_batcher = {'instance': None}
+_playlist_item_batcher_lock = threading.Lock()
 
 # ===========================
 #        Commen usage
 # ===========================
 
-def get_authenticated_service():
+def get_credentials():
     """
-    authorize the request and store authorization credentials.
+    create authorization credentials from the refresh token.
+    the access token is fetched with the first request and refreshed when it expires
 
     Args:
         None
 
+    Return:
+        object => oauth2 credentials
+    """
+
+    return client.OAuth2Credentials(access_token=None,
+                                    client_id=SYS_PARAMS.CLIENT_ID,
+                                    client_secret=SYS_PARAMS.CLIENT_SECRET,
+                                    refresh_token=SYS_PARAMS.REFRESH_TOKEN,
+                                    token_expiry=None,
+                                    token_uri=GOOGLE_TOKEN_URI,
+                                    user_agent=None,
+                                    revoke_uri=None)
+
+def is_retriable_error(e):
+    """
+    check if a failed YouTube request may succeed when it is sent again
+
+    Args:
+        e:
+            exception => error raised by the request
+
+    Return:
+        bool => True if the request should be retried
+    """
+
+    if isinstance(e, HttpError):
+        return e.resp.status in RETRIABLE_STATUS_CODES
+
+    return isinstance(e, RETRIABLE_EXCEPTIONS)
+
+def execute_request(request, action, retriable=True):
+    """
+    execute an api request with the shared retry policy
+
+    Args:
+        :request
+            object => HttpRequest
+        :action
+            string => name of the api, for the messages
+        :retriable
+            bool => False for requests which must not be sent twice, e.g. inserts,
+                    they are still only started before the deadline
+
+    Return:
+        object => response
+    """
+
+    # every attempt is charged to the quota ledger, YouTube charges failed calls as well
+    def execute():
+        record_quota(action)
+        try:
+            return request.execute()
+        except HttpError as e:
+            record_quota_error(e)
+            raise
+
+    return DEFAULT_RETRY_POLICY.call(execute,
+                                     is_retriable_error if retriable else (lambda e: False),
+                                     action)
+
+def get_authenticated_service(credentials=None):
+    """
+    authorize the request and store authorization credentials.
+
+    Args:
+        :credentials
+            object => oauth2 credentials to share, new ones are created if not given
+
     Return:
         resource => api resource
     """
 
-    credentials = client.OAuth2Credentials(access_token=None,
-                                           client_id=SYS_PARAMS.CLIENT_ID,
-                                           client_secret=SYS_PARAMS.CLIENT_SECRET,
-                                           refresh_token=SYS_PARAMS.REFRESH_TOKEN,
-                                           token_expiry=None,
-                                           token_uri=GOOGLE_TOKEN_URI,
-                                           user_agent=None,
-                                           revoke_uri=None)
+    if credentials is None:
+        credentials = get_credentials()
+
+    discovery_document = get_discovery_document()
+    if discovery_document is None:
+        # fall back to fetching the document from Google
+        return build(API_SERVICE_NAME, API_VERSION, credentials=credentials)
 
-    return build(API_SERVICE_NAME, API_VERSION, credentials=credentials)
+    return build_from_document(discovery_document, credentials=credentials)
 
 def build_resource(properties):
     """
@@ -142,6 +231,102 @@ def remove_empty_kwargs(**kwargs):
 #           Video
 # ===========================
 
+class AdaptiveMediaIoBaseUpload(MediaIoBaseUpload):
+    """
+    media upload from a file object, the client library asks for the chunk size
+    before every chunk, so it follows the chunk sizer
+    """
+
+    def __init__(self, fd, mimetype, chunk_sizer):
+        super().__init__(fd, mimetype, chunksize=chunk_sizer.chunk_size, resumable=True)
+        self.chunk_sizer = chunk_sizer
+
+    def chunksize(self):
+        return self.chunk_sizer.chunk_size
+
+class AdaptiveMediaFileUpload(MediaFileUpload):
+    """
+    media upload from a local file, the chunk size follows the chunk sizer
+    """
+
+    def __init__(self, filename, mimetype, chunk_sizer):
+        super().__init__(filename, mimetype=mimetype, chunksize=chunk_sizer.chunk_size, resumable=True)
+        self.chunk_sizer = chunk_sizer
+
+    def chunksize(self):
+        return self.chunk_sizer.chunk_size
+
+def create_chunk_sizer():
+    """
+    create the chunk sizer of an upload from UPLOAD_* settings
+
+    Args:
+        None
+
+    Return:
+        object => chunk sizer
+    """
+
+    # chunks are sent from the file object without copying, but a failed chunk is sent
+    # again from the start, so the ceiling also bounds the cost of a retry
+    memory_limit = SYS_PARAMS.UPLOAD_MEMORY_LIMIT
+    if memory_limit <= 0:
+        memory_limit = get_memory_size() * 1024 * 1024 // 4
+
+    return ChunkSizer(SYS_PARAMS.UPLOAD_CHUNK_SIZE, memory_limit, SYS_PARAMS.UPLOAD_CHUNK_TARGET_SECONDS)
+
+def create_media_body(options):
+    """
+    create the media of the upload, from options.stream if it is given, else from options.file
+
+    Args:
+        :options
+            objects
+
+    Return:
+        object => media upload
+    """
+
+    # The chunksize parameter specifies the size of each chunk of data, in
+    # bytes, that will be uploaded at a time. Set a higher value for
+    # reliable connections as fewer chunks lead to faster uploads. Set a lower
+    # value for better recovery on less reliable connections.
+    #
+    # Setting 'chunksize' equal to -1 in the code below means that the entire
+    # file will be uploaded in a single HTTP request. (If the upload fails,
+    # it will still be retried where it left off.) This is usually a best
+    # practice, but if you're using Python older than 2.6 or if you're
+    # running on App Engine, you should set the chunksize to something like
+    # 1024 * 1024 (1 megabyte).
+    stream = getattr(options, 'stream', None)
+
+    # with a bandwidth limit the video is read through the shared token bucket, so a local
+    # file is opened as a stream as well. it is kept in options.stream for the caller to close
+    bucket = get_upload_bucket()
+    if bucket is not None:
+        if stream is None:
+            options.stream = open(options.file, 'rb')
+            options.mimetype = guess_video_mimetype(options.file)
+        stream = ThrottledReader(options.stream, bucket)
+
+    if SYS_PARAMS.UPLOAD_ADAPTIVE_CHUNKS:
+        if stream is not None:
+            return AdaptiveMediaIoBaseUpload(stream, getattr(options, 'mimetype', None) or 'application/octet-stream', create_chunk_sizer())
+        return AdaptiveMediaFileUpload(options.file, guess_video_mimetype(options.file), create_chunk_sizer())
+
+    chunksize = -1
+
+    # a persisted session is saved after every chunk. besides, the client library
+    # sends a wrong Content-Range when a single request upload resumes in the middle
+    if getattr(options, 'session_key', None) and get_state_store() is not None:
+        chunksize = SYS_PARAMS.UPLOAD_CHUNK_SIZE
+
+    if stream is not None:
+        # the stream is sent as the request body, read block by block while it is uploaded
+        return MediaIoBaseUpload(stream, mimetype=getattr(options, 'mimetype', None) or 'application/octet-stream', chunksize=chunksize, resumable=True)
+
+    return MediaFileUpload(options.file, chunksize=chunksize, resumable=True)
+
 def initialize_upload(client_instance, options):
     """
     initiate the upload process
@@ -177,30 +362,134 @@ def initialize_upload(client_instance, options):
     insert_request = client_instance.videos().insert(
         part=','.join(body.keys()),
         body=body,
-        # The chunksize parameter specifies the size of each chunk of data, in
-        # bytes, that will be uploaded at a time. Set a higher value for
-        # reliable connections as fewer chunks lead to faster uploads. Set a lower
-        # value for better recovery on less reliable connections.
-        #
-        # Setting 'chunksize' equal to -1 in the code below means that the entire
-        # file will be uploaded in a single HTTP request. (If the upload fails,
-        # it will still be retried where it left off.) This is usually a best
-        # practice, but if you're using Python older than 2.6 or if you're
-        # running on App Engine, you should set the chunksize to something like
-        # 1024 * 1024 (1 megabyte).
-        media_body=MediaFileUpload(options.file, chunksize=-1, resumable=True)
+        media_body=create_media_body(options)
     )
 
-    video_id = resumable_upload(insert_request)
+    video_id = resumable_upload(insert_request, getattr(options, 'session_key', None))
     return video_id
 
-def resumable_upload(request):
+def start_upload_session(request):
+    """
+    create the resumable session of a request, the same way next_chunk() does,
+    so its uri can be saved before any byte of the video is sent
+
+    Args:
+        :request
+            object => resumable HttpRequest
+
+    Return:
+        None
+    """
+
+    size = request.resumable.size()
+
+    headers = dict(request.headers)
+    headers['X-Upload-Content-Type'] = request.resumable.mimetype()
+    if size is not None:
+        headers['X-Upload-Content-Length'] = str(size)
+    headers['content-length'] = str(request.body_size)
+
+    resp, content = request.http.request(request.uri, method=request.method, body=request.body, headers=headers)
+    if resp.status == 200 and 'location' in resp:
+        request.resumable_uri = resp['location']
+    else:
+        raise ResumableUploadError(resp, content)
+
+def save_upload_session(request, state_store, session_key):
+    """
+    save the session uri and the bytes confirmed by YouTube
+
+    Args:
+        :request
+            object => resumable HttpRequest
+        :state_store
+            object => state store
+        :session_key
+            string => key of the video in the state store
+
+    Return:
+        None
+    """
+
+    state_store.put(session_key, {
+        'resumable_uri': request.resumable_uri,
+        'offset': request.resumable_progress,
+        'size': request.resumable.size(),
+        'updated_at': int(time.time())
+    }, UPLOAD_SESSION_TTL_SECONDS)
+
+def restore_upload_session(request, session):
+    """
+    continue the saved session of a video, e.g. after the lambda timed out
+
+    Args:
+        :request
+            object => resumable HttpRequest
+        :session
+            dict => saved by save_upload_session, None if there is none
+
+    Return:
+        bool => True if a saved session is continued
+    """
+
+    if session is None or session['size'] != request.resumable.size():
+        return False
+
+    print('Resuming upload session from byte {} of {}'.format(session['offset'], session['size']))
+    request.resumable_uri = session['resumable_uri']
+    request.resumable_progress = session['offset']
+
+    # in error state, next_chunk() first asks YouTube for the bytes it has received
+    request._in_error_state = True
+    return True
+
+def finish_upload_session(session_key):
+    """
+    forget the session of a video once everything after its upload is done
+
+    Args:
+        :session_key
+            string => key of the video in the state store, None if the session is not saved
+
+    Return:
+        None
+    """
+
+    state_store = get_state_store() if session_key else None
+    if state_store is not None:
+        state_store.delete(session_key)
+
+def get_next_chunk_size(request):
+    """
+    get the bytes the next next_chunk() call sends
+
+    Args:
+        :request
+            object => resumable HttpRequest
+
+    Return:
+        int => bytes, None if the size of the media is unknown
+    """
+
+    size = request.resumable.size()
+    chunksize = request.resumable.chunksize()
+
+    if size is None:
+        return chunksize if chunksize > 0 else None
+
+    left = size - request.resumable_progress
+    return left if chunksize < 0 else min(chunksize, left)
+
+def resumable_upload(request, session_key=None):
     """
     this method implements an exponential backoff strategy to resume a failed upload.
 
     Args:
         :request
             object
+        :session_key
+            string => key of the video, the session is saved in the state store after
+                      every chunk if both are given
 
     Return:
         int => return yotube video id if success
@@ -210,25 +499,95 @@ def resumable_upload(request):
     error = None
     retry = 0
     video_id = None
+    action = 'upload'
+    throughput = None # bytes per second of the chunks sent so far, for the fixed size chunks
+
+    state_store = get_state_store() if session_key else None
+    if state_store is not None:
+        session = state_store.get(session_key)
+
+        # an earlier attempt finished the upload, only the steps after it failed
+        if session is not None and session.get('video_id') is not None:
+            print('Video id "%s" was uploaded by an earlier attempt.' % session['video_id'])
+            return session['video_id']
+
+        restore_upload_session(request, session)
 
     while response is None:
+        error = None
         try:
+            # a new session is a new videos.insert call
+            if request.resumable_uri is None:
+                record_quota('videos.insert')
+
+            if state_store is not None and request.resumable_uri is None:
+                start_upload_session(request)
+                save_upload_session(request, state_store, session_key)
+
+            # only start a chunk which can be sent before the deadline, the session
+            # saved after the last chunk lets the redelivered event continue from there
+            chunk_sizer = getattr(request.resumable, 'chunk_sizer', None)
+            check_deadline(0, 'uploading')
+            if chunk_sizer is not None and chunk_sizer.throughput is not None:
+                remaining = get_remaining_seconds()
+                if remaining is not None:
+                    chunk_sizer.fit(remaining)
+                check_deadline(chunk_sizer.chunk_size / chunk_sizer.throughput, 'the next chunk')
+            elif throughput is not None:
+                next_chunk_size = get_next_chunk_size(request)
+                if next_chunk_size is not None:
+                    check_deadline(next_chunk_size / throughput, 'the next chunk')
+
             print('Uploading file...')
+            chunk_start = request.resumable_progress
+            start_time = time.time()
+
             status, response = request.next_chunk()
+
+            sent_bytes = request.resumable_progress - chunk_start
+            if status is not None and sent_bytes > 0:
+                chunk_throughput = sent_bytes / max(time.time() - start_time, 0.001)
+                if throughput is None:
+                    throughput = chunk_throughput
+                else:
+                    throughput = THROUGHPUT_WEIGHT * chunk_throughput + (1 - THROUGHPUT_WEIGHT) * throughput
+
+            if chunk_sizer is not None and status is not None:
+                chunk_sizer.record_success(request.resumable_progress - chunk_start, time.time() - start_time)
+                print('Uploaded {} of {} bytes, next chunk {} bytes'.format(request.resumable_progress,
+                                                                           request.resumable.size(),
+                                                                           chunk_sizer.chunk_size))
+
+            if status is not None and state_store is not None:
+                save_upload_session(request, state_store, session_key)
+
             if response is not None:
                 print(response)
                 if 'id' in response:
                     print('Video id "%s" was successfully uploaded.' %
                           response['id'])
                     video_id = response['id']
+
+                    # kept until finish_upload_session, so a redelivered event does not upload it again
+                    if state_store is not None:
+                        state_store.put(session_key, {'video_id': video_id, 'updated_at': int(time.time())}, UPLOAD_SESSION_TTL_SECONDS)
                 else:
-                    exit('The upload failed with an unexpected response: %s' % response)
+                    raise UploadFailed('The upload failed with an unexpected response: %s' % response)
         except HttpError as e:
-            if e.resp.status in RETRIABLE_STATUS_CODES:
+            if state_store is not None and e.resp.status in EXPIRED_SESSION_STATUS_CODES:
+                # the saved session is gone, start a new one from the first byte
+                print('Upload session expired, starting a new one')
+                state_store.delete(session_key)
+                request.resumable_uri = None
+                request.resumable_progress = 0
+                request._in_error_state = False
+                error = 'The upload session expired'
+            elif e.resp.status in RETRIABLE_STATUS_CODES:
                 error = 'A retriable HTTP error %d occurred:\n%s' % (e.resp.status,
                                                                      e.content)
                 print(e)
             else:
+                record_quota_error(e)
                 raise
         except RETRIABLE_EXCEPTIONS as e:
             error = ('A retriable error occurred: %s' % e)
@@ -236,14 +595,12 @@ def resumable_upload(request):
 
         if error is not None:
             print(error)
-            retry += 1
-            if retry > MAX_RETRIES:
-                exit('No longer attempting to retry.')
+            chunk_sizer = getattr(request.resumable, 'chunk_sizer', None)
+            if chunk_sizer is not None:
+                chunk_sizer.record_error()
 
-            max_sleep = 2 ** retry
-            sleep_seconds = random.random() * max_sleep
-            print('Sleeping %f seconds and then retrying...' % sleep_seconds)
-            time.sleep(sleep_seconds)
+            retry += 1
+            DEFAULT_RETRY_POLICY.backoff(retry, action)
 
     return video_id
 
@@ -268,7 +625,7 @@ def playlists_list_mine(client_instance, **kwargs):
     # See full sample for function
     kwargs = remove_empty_kwargs(**kwargs)
 
-    response = client_instance.playlists().list(**kwargs).execute()
+    response = execute_request(client_instance.playlists().list(**kwargs), 'playlists.list')
 
     return response
 
@@ -294,16 +651,192 @@ def playlist_items_insert(client_instance, properties, **kwargs):
     kwargs = remove_empty_kwargs(**kwargs)
 
     try:
-        client_instance.playlistItems().insert(
+        execute_request(client_instance.playlistItems().insert(
             body=resource,
             **kwargs
-        ).execute()
+        ), 'playlistItems.insert', retriable=False)
         return True
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         print(e)
         return False
 
 
+class PlaylistItemBatcher:
+    """
+    collect (playlist id, video id) pairs and insert them with batch requests,
+    every pair has its own callback and the retriable failures are sent again
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def add(self, playlist_id, video_id, callback=None):
+        """
+        queue a video for its playlist
+
+        Args:
+            :playlist_id
+                string => the youtube playlist id
+            :video_id
+                string => the youtube video id
+            :callback
+                function => called with None on success or the error, after the pair is sent
+
+        Return:
+            None
+        """
+
+        with self.lock:
+            self.pending.append({'playlist_id': playlist_id, 'video_id': video_id, 'callback': callback})
+
+    def send(self, client_instance, items):
+        """
+        send one batch request
+
+        Args:
+            :client_instance
+                resource => youtube resource
+            :items
+                list => queued pairs, at most batch_size
+
+        Return:
+            list => (item, error) of the failed pairs
+        """
+
+        # checked before anything is charged, the caller defers the pairs
+        check_deadline(0, 'playlistItems.insert batch')
+
+        failures = []
+        answered = set()
+
+        def on_response(request_id, response, exception):
+            answered.add(int(request_id))
+            item = items[int(request_id)]
+            if exception is None:
+                finish_playlist_item(item, None)
+            else:
+                record_quota_error(exception)
+                failures.append((item, exception))
+
+        batch = client_instance.new_batch_http_request()
+        for index, item in enumerate(items):
+            resource = build_resource({'snippet.playlistId': item['playlist_id'],
+                                       'snippet.resourceId.kind': 'youtube#video',
+                                       'snippet.resourceId.videoId': item['video_id']})
+            batch.add(client_instance.playlistItems().insert(body=resource, part='snippet'),
+                      callback=on_response,
+                      request_id=str(index))
+            record_quota('playlistItems.insert')
+
+        try:
+            batch.execute()
+        except Exception as e:
+            # the batch itself failed, the pairs without an answer failed with it
+            failures.extend((item, e) for index, item in enumerate(items) if index not in answered)
+
+        return failures
+
+    def flush(self, client_instance):
+        """
+        insert every queued pair, the retriable failures are retried with backoff.
+        the pairs which cannot be sent before the deadline are returned, their callbacks are not called
+
+        Args:
+            :client_instance
+                resource => youtube resource
+
+        Return:
+            list => pairs deferred to the next attempt, dicts with playlist_id and video_id
+        """
+
+        with self.lock:
+            items = self.pending
+            self.pending = []
+
+        deferred = []
+        retry = 0
+        while len(items) > 0:
+            failures = []
+            sent = 0
+            try:
+                while sent < len(items):
+                    failures.extend(self.send(client_instance, items[sent:sent + self.batch_size]))
+                    sent += self.batch_size
+            except DeadlineExceeded as e:
+                print('{}, {} playlist items are deferred'.format(e, len(items) - sent))
+                deferred.extend(items[sent:])
+
+            items = []
+            for item, error in failures:
+                if is_retriable_error(error):
+                    print('A retriable error occurred in playlistItems.insert of {}: {}'.format(item['video_id'], error))
+                    items.append(item)
+                else:
+                    finish_playlist_item(item, error)
+
+            # the retries would not be sent either
+            if len(deferred) > 0:
+                deferred.extend(items)
+                break
+
+            if len(items) > 0:
+                retry += 1
+                try:
+                    DEFAULT_RETRY_POLICY.backoff(retry, 'playlistItems.insert batch')
+                except DeadlineExceeded as e:
+                    print('{}, {} playlist items are deferred'.format(e, len(items)))
+                    deferred.extend(items)
+                    break
+                except RetriesExhausted as e:
+                    for item in items:
+                        finish_playlist_item(item, e)
+                    break
+
+        return deferred
+
+def finish_playlist_item(item, error):
+    """
+    tell the caller of a queued playlist item the result, error is None on success
+    """
+
+    if item['callback'] is not None:
+        item['callback'](error)
+
+def get_playlist_item_batcher():
+    """
+    get the playlist item queue shared by the threads of this process
+
+    Args:
+        None
+
+    Return:
+        object => PlaylistItemBatcher
+    """
+
+    with _playlist_item_batcher_lock:
+        if _playlist_item_batcher['instance'] is None:
+            _playlist_item_batcher['instance'] = PlaylistItemBatcher(SYS_PARAMS.PLAYLIST_ITEMS_BATCH_SIZE)
+        return _playlist_item_batcher['instance']
+
+def flush_playlist_items(client_instance):
+    """
+    add the queued videos to their playlists
+
+    Args:
+        :client_instance
+            resource => youtube resource
+
+    Return:
+        list => pairs deferred to the next attempt, dicts with playlist_id and video_id
+    """
+
+    return get_playlist_item_batcher().flush(client_instance)
+
+
 def playlists_insert(client_instance, properties, **kwargs):
     """
     api - create a playlist
@@ -325,53 +858,76 @@ def playlists_insert(client_instance, properties, **kwargs):
     kwargs = remove_empty_kwargs(**kwargs)
 
     try:
-        response = client_instance.playlists().insert(
+        response = execute_request(client_instance.playlists().insert(
             body=resource,
             **kwargs
-        ).execute()
+        ), 'playlists.insert', retriable=False)
 
         print(response)
         return response['id']
 
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         print(e)
         return None
 
 
-def search_target_playlist(client_instance, key, next_page_token):
+def list_playlist_ids(client_instance):
     """
-    search if the playlist exists or not
+    get the ids of all the playlists of mine
 
     Args:
         :client_instance
             resource => youtube resource
-        :key
-            string => the title of playlist
-        :next_page_token
-            string => give this token to fetch the next page of the result list
 
     Return:
-        int => return the playlist id if the playlist exists
+        dict => playlist title -> playlist id
     """
 
-    # find if playlist contains the duplicated item
+    playlist_ids = {}
+    next_page_token = None
+
     while True:
         playlist = playlists_list_mine(client_instance,
-                                       part='snippet,contentDetails',
+                                       part='snippet',
                                        mine=True,
-                                       maxResults=5,
+                                       maxResults=PLAYLISTS_PAGE_SIZE,
                                        pageToken=next_page_token)
 
         for item in playlist['items']:
-            if item['snippet']['title'] == key:
-                return item['id']
+            # keep the first playlist of a title, as the page by page search did
+            playlist_ids.setdefault(item['snippet']['title'], item['id'])
 
         if 'nextPageToken' in playlist:
             # change page and keep searching
             next_page_token = playlist['nextPageToken']
         else:
-            # end of the page, nothing has found
-            return None
+            return playlist_ids
+
+def search_target_playlist(client_instance, key):
+    """
+    search if the playlist exists or not, from the playlist cache when possible
+
+    Args:
+        :client_instance
+            resource => youtube resource
+        :key
+            string => the title of playlist
+
+    Return:
+        int => return the playlist id if the playlist exists
+    """
+
+    playlist_cache = get_playlist_cache()
+    playlist_id, generation = playlist_cache.get(key)
+
+    # the cache may miss playlists created by other containers since it was built
+    if playlist_id is None:
+        playlist_cache.refresh(lambda: list_playlist_ids(client_instance), generation)
+        playlist_id, _ = playlist_cache.get(key)
+
+    return playlist_id
 
 
 def add_video_to_playlist(client_instance, video_id, cameraLocation):
@@ -389,34 +945,53 @@ def add_video_to_playlist(client_instance, video_id, cameraLocation):
     Return:
         int => return the playlist id
     """
-    playlist_id = None
 
     # get playlist and find if new one is duplicated
-    playlist = playlists_list_mine(client_instance,
-                                   part='snippet,contentDetails',
-                                   mine=True,
-                                   maxResults=5)
-
-    # set true if target if found
-    for item in playlist['items']:
-        if item['snippet']['title'] == cameraLocation:
-            playlist_id = item['id']
-            break
-
-    # else find the following pages
-    if playlist_id is None and 'nextPageToken' in playlist:
-        playlist_id = search_target_playlist(client_instance,
-                                             cameraLocation, playlist['nextPageToken'])
-
-    # insert new playlist if neccessary
+    playlist_id = search_target_playlist(client_instance, cameraLocation)
+
+    # insert new playlist if neccessary, only one of the uploads of a new camera location creates it
     if playlist_id is None:
-        playlist_id = playlists_insert(client_instance,
-                                       {'snippet.title': cameraLocation,
-                                        'snippet.description': cameraLocation,
-                                        'snippet.tags[]': cameraLocation,
-                                        'snippet.defaultLanguage': '',
-                                        'status.privacyStatus': 'public'},
-                                       part='snippet,status')
+        playlist_id = single_flight('playlist:{}'.format(cameraLocation),
+                                    lambda: get_playlist_cache().get(cameraLocation)[0],
+                                    lambda: create_playlist(client_instance, cameraLocation),
+                                    SYS_PARAMS.PLAYLIST_LEASE_SECONDS)
+
+        # the playlist was created by another process
+        if playlist_id is not None and get_playlist_cache().get(cameraLocation)[0] != playlist_id:
+            get_playlist_cache().add(cameraLocation, playlist_id)
+
+    add_playlist_item(client_instance, playlist_id, video_id, cameraLocation)
+
+    return playlist_id
+
+
+def add_playlist_item(client_instance, playlist_id, video_id, cameraLocation):
+    """
+    add a video to a known playlist, or queue it when PLAYLIST_ITEMS_BATCH is set
+
+    Args:
+        :client_instance
+            resource => youtube resource
+        :playlist_id
+            string => the youtube playlist id
+        :video_id
+            string => the youtube video id
+        :cameraLocation
+            string => title of the playlist
+
+    Return:
+        None
+    """
+
+    # sent with the other videos of the batch by flush_playlist_items
+    if SYS_PARAMS.PLAYLIST_ITEMS_BATCH:
+        def on_done(error):
+            if error is not None:
+                print(error)
+            report_playlist_item(video_id, playlist_id, cameraLocation, error is None)
+
+        get_playlist_item_batcher().add(playlist_id, video_id, on_done)
+        return
 
     # add video to playlist
     is_item_uploaded = playlist_items_insert(client_instance,
@@ -426,6 +1001,41 @@ def add_video_to_playlist(client_instance, video_id, cameraLocation):
                                               'snippet.position': ''},
                                              part='snippet')
 
+    report_playlist_item(video_id, playlist_id, cameraLocation, is_item_uploaded)
+
+
+def create_playlist(client_instance, cameraLocation):
+    """
+    create the playlist of a camera location and add it to the playlist cache
+
+    Args:
+        :client_instance
+            resource => youtube resource
+        :cameraLocation
+            string => title of the playlist
+
+    Return:
+        string => the playlist id, None if it could not be created
+    """
+
+    playlist_id = playlists_insert(client_instance,
+                                   {'snippet.title': cameraLocation,
+                                    'snippet.description': cameraLocation,
+                                    'snippet.tags[]': cameraLocation,
+                                    'snippet.defaultLanguage': '',
+                                    'status.privacyStatus': 'public'},
+                                   part='snippet,status')
+    if playlist_id is not None:
+        get_playlist_cache().add(cameraLocation, playlist_id)
+
+    return playlist_id
+
+
+def report_playlist_item(video_id, playlist_id, cameraLocation, is_item_uploaded):
+    """
+    print the result of a playlistItems.insert, the cached playlist is dropped if it failed
+    """
+
     if is_item_uploaded:
         print('Video {} has been added to playlist {}'.format(
             video_id, playlist_id))
@@ -433,4 +1043,7 @@ def add_video_to_playlist(client_instance, video_id, cameraLocation):
         print('Error: Failed to add video {} to playlist {}'.format(
             video_id, playlist_id))
 
-    return playlist_id
+        # e.g. the playlist was deleted, the next video looks it up again and
+        # does not get the deleted id back from the lease of its creation
+        get_playlist_cache().remove(cameraLocation)
+        forget('playlist:{}'.format(cameraLocation))
@@ -0,0 +1,84 @@
+# ===========================================================
+# Reservations of the YouTube quota ledger shared by processes
+# Run in the source folder:
+#   python -m pytest tests
+# ===========================================================
+
+import concurrent.futures
+import os
+import sys
+
+# lib.sys_params reads the lambda settings on import
+for name in ('SRC_BUCKET', 'YOUTUBE_VIDEO_URL', 'DIR', 'ENDPOINT_MMA', 'ENDPOINT_MMM',
+             'CLIENT_ID', 'CLIENT_SECRET', 'REFRESH_TOKEN', 'TAIBIF_API_URL'):
+    os.environ.setdefault(name, 'test')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import lib.quota
+from lib.quota import MAX_UPDATE_ATTEMPTS, QUOTA_COSTS, UPLOAD_QUOTA_COST, QuotaLedger, QuotaLedgerBusy
+from lib.state_store import LocalFileStateStore
+
+BUDGET = 10000
+
+# reservations which try the same budget at once, each as its own process would
+CONCURRENT_RESERVATIONS = 20
+
+def test_concurrent_reservations_fit_the_budget(tmp_path):
+    # every ledger has its own lock, like the ledgers of separate processes
+    ledgers = [QuotaLedger(BUDGET, LocalFileStateStore(str(tmp_path))) for _ in range(CONCURRENT_RESERVATIONS)]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=CONCURRENT_RESERVATIONS) as executor:
+        reservation_ids = list(executor.map(lambda ledger: ledger.reserve(UPLOAD_QUOTA_COST, 0), ledgers))
+
+    granted = [reservation_id for reservation_id in reservation_ids if reservation_id is not None]
+    assert len(granted) == BUDGET // UPLOAD_QUOTA_COST
+
+    document = ledgers[0].read()
+    assert sorted(document['reservations']) == sorted(granted)
+    assert sum(reservation['units'] for reservation in document['reservations'].values()) <= BUDGET
+
+    # a released reservation makes room for one more
+    ledgers[0].release(granted[0])
+    assert ledgers[1].reserve(UPLOAD_QUOTA_COST, 0) is not None
+    assert ledgers[2].reserve(UPLOAD_QUOTA_COST, 0) is None
+
+def test_recorded_units_leave_the_reservation(tmp_path):
+    ledger = QuotaLedger(BUDGET, LocalFileStateStore(str(tmp_path)))
+
+    reservation_id = ledger.reserve(UPLOAD_QUOTA_COST, 0)
+    ledger.record('videos.insert', reservation_id)
+
+    document = ledger.read()
+    assert document['spent'] == QUOTA_COSTS['videos.insert']
+    assert document['reservations'][reservation_id]['units'] == QUOTA_COSTS['playlistItems.insert']
+
+    ledger.record('playlistItems.insert', reservation_id)
+    ledger.release(reservation_id)
+
+    document = ledger.read()
+    assert document['spent'] == UPLOAD_QUOTA_COST
+    assert document['reservations'] == {}
+    assert ledger.remaining() == BUDGET - UPLOAD_QUOTA_COST
+
+class ChangingStateStore(LocalFileStateStore):
+    # another process changes the ledger before every conditional write
+    def put_if_absent(self, key, value, ttl=None):
+        self.attempts += 1
+        return False
+
+    def replace_if(self, key, version, value, ttl=None):
+        self.attempts += 1
+        return False
+
+def test_busy_ledger_gives_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(lib.quota.time, 'sleep', lambda seconds: None)
+    state_store = ChangingStateStore(str(tmp_path))
+    state_store.attempts = 0
+    ledger = QuotaLedger(BUDGET, state_store)
+
+    with pytest.raises(QuotaLedgerBusy):
+        ledger.reserve(UPLOAD_QUOTA_COST, 0)
+    assert state_store.attempts == MAX_UPDATE_ATTEMPTS
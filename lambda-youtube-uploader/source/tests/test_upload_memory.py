@@ -0,0 +1,125 @@
+# ===========================================================
+# Peak memory of an upload does not grow with the file size
+# Run in the source folder:
+#   python -m pytest tests
+# ===========================================================
+
+import json
+import os
+import sys
+import tracemalloc
+
+# lib.sys_params reads the lambda settings on import
+for name in ('SRC_BUCKET', 'YOUTUBE_VIDEO_URL', 'DIR', 'ENDPOINT_MMA', 'ENDPOINT_MMM',
+             'CLIENT_ID', 'CLIENT_SECRET', 'REFRESH_TOKEN', 'TAIBIF_API_URL'):
+    os.environ.setdefault(name, 'test')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httplib2
+import pytest
+
+import lib.upload_video as UploadVideo
+from lib.sys_params import SYS_PARAMS
+
+MB = 1024 * 1024
+
+# the transport reads the request body in blocks of this size, as a socket would
+READ_BLOCK_SIZE = 64 * 1024
+
+# building the insert request takes about 800KB, a copy of the file or of
+# a chunk would take at least 4MB, the small file or the largest adaptive chunk
+PEAK_MEMORY_BOUND = 2 * MB
+
+# the peak may differ a little between two uploads, but not by the file size
+PEAK_MEMORY_TOLERANCE = 256 * 1024
+
+class FakeUploadHttp:
+    """
+    resumable upload endpoint which drains the request bodies without keeping them
+    """
+
+    def __init__(self):
+        self.received = 0
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        headers = headers or {}
+
+        if 'uploadType=resumable' in uri:
+            return httplib2.Response({'status': 200, 'location': 'https://upload.test/session'}), b''
+
+        content_range = headers['Content-Range']
+        total = int(content_range.split('/')[1])
+
+        if isinstance(body, bytes):
+            self.received += len(body)
+        else:
+            while True:
+                block = body.read(READ_BLOCK_SIZE)
+                if not block:
+                    break
+                self.received += len(block)
+
+        if self.received == total:
+            return httplib2.Response({'status': 200}), json.dumps({'id': 'VIDEO_ID'}).encode('utf8')
+
+        return httplib2.Response({'status': 308, 'range': 'bytes=0-{}'.format(self.received - 1)}), b''
+
+class Options:
+
+    def __init__(self, path):
+        self.file = path
+        self.session_key = None
+
+def upload_peak_memory(path):
+    """
+    upload a file through create_media_body and resumable_upload
+
+    Args:
+        path:
+            string => file to upload
+
+    Return:
+        int => tracemalloc peak in bytes
+    """
+
+    service = UploadVideo.get_authenticated_service()
+    service._http = FakeUploadHttp()
+
+    tracemalloc.start()
+    try:
+        request = service.videos().insert(part='snippet,status',
+                                          body={'snippet': {'title': 'test'}, 'status': {'privacyStatus': 'private'}},
+                                          media_body=UploadVideo.create_media_body(Options(path)))
+        video_id = UploadVideo.resumable_upload(request)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert video_id == 'VIDEO_ID'
+    assert service._http.received == os.path.getsize(path)
+    return peak
+
+def create_file(path, size):
+    # a sparse file, its size is what matters
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    return str(path)
+
+@pytest.mark.parametrize('adaptive', [False, True])
+def test_peak_memory_is_flat(tmp_path, monkeypatch, adaptive):
+    monkeypatch.setitem(SYS_PARAMS, 'UPLOAD_ADAPTIVE_CHUNKS', adaptive)
+    monkeypatch.setitem(SYS_PARAMS, 'UPLOAD_CHUNK_SIZE', 1 * MB)
+    monkeypatch.setitem(SYS_PARAMS, 'UPLOAD_MEMORY_LIMIT', 16 * MB)
+    monkeypatch.setitem(SYS_PARAMS, 'UPLOAD_BANDWIDTH_LIMIT', 0)
+    monkeypatch.setitem(SYS_PARAMS, 'STATE_STORE', '')
+
+    # the first upload loads what is loaded only once, e.g. the mimetypes table
+    upload_peak_memory(create_file(tmp_path / 'warm_up.mp4', 1 * MB))
+
+    small_peak = upload_peak_memory(create_file(tmp_path / 'small.mp4', 4 * MB))
+    large_peak = upload_peak_memory(create_file(tmp_path / 'large.mp4', 64 * MB))
+
+    assert small_peak < PEAK_MEMORY_BOUND
+    assert large_peak < PEAK_MEMORY_BOUND
+    assert abs(large_peak - small_peak) < PEAK_MEMORY_TOLERANCE
@@ -0,0 +1,28 @@
+# ==================================================================
+# Regenerate the YouTube discovery document bundled in lib/discovery
+# Usage:
+#   python update_discovery_document.py
+# ==================================================================
+
+import argparse
+
+from lib.discovery_document import (API_SERVICE_NAME, DISCOVERY_DOCUMENT_PATH, DISCOVERY_URL,
+                                    fetch_discovery_document, save_discovery_document)
+
+def main():
+    parser = argparse.ArgumentParser(description='Download the pinned YouTube discovery document')
+    parser.add_argument('--url', default=DISCOVERY_URL)
+    parser.add_argument('--output', default=DISCOVERY_DOCUMENT_PATH)
+    args = parser.parse_args()
+
+    try:
+        document = fetch_discovery_document(args.url)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+    save_discovery_document(document, args.output)
+
+    print('{} revision {} saved to {}'.format(API_SERVICE_NAME, document.get('revision'), args.output))
+
+if __name__ == '__main__':
+    main()
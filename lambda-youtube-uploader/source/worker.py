@@ -0,0 +1,155 @@
+# ======================================================
+# Long-running worker for on-prem ingestion
+# Usage:
+#   python -m worker --queue sqs --queue-url <url>
+#   python -m worker --queue dir --spool-dir <path>
+# ======================================================
+
+import argparse
+import signal
+import time
+
+import lib.clients as Clients
+from lib.job_queue import DirectorySpoolQueue, SqsQueue
+from lib.latency import print_latency_report
+from lib.quota import print_quota_metric
+from lambda_function import process_records
+
+# set by SIGINT / SIGTERM, the worker stops after the current jobs
+_stop_requested = False
+
+def request_stop(signum, frame):
+    global _stop_requested
+    print('Signal {} received, stopping after the current jobs'.format(signum))
+    _stop_requested = True
+
+def build_queue(args):
+    """
+    create the job queue from command line arguments
+
+    Args:
+        args:
+            object => parsed arguments
+
+    Return:
+        object => job queue
+    """
+
+    if args.queue == 'sqs':
+        return SqsQueue(args.queue_url)
+    else:
+        return DirectorySpoolQueue(args.spool_dir)
+
+def run_once(job_queue, max_jobs, wait_seconds, defer_seconds=900):
+    """
+    receive jobs once, run the pipeline and ack, nack or defer every job
+
+    Args:
+        job_queue:
+            object => job queue
+        max_jobs:
+            int => maximum number of jobs to receive
+        wait_seconds:
+            int => seconds to wait for jobs
+        defer_seconds:
+            int => seconds a deferred job waits before it is received again
+
+    Return:
+        int => number of jobs handled
+    """
+
+    jobs = job_queue.receive(max_jobs, wait_seconds)
+    if len(jobs) == 0:
+        return 0
+
+    job_records = [(job, record) for job in jobs for record in job.records]
+    results = process_records([record for _, record in job_records])
+
+    failed_job_ids = set()
+    deferred_job_ids = set()
+    for (job, _), result in zip(job_records, results):
+        if result['status'] == 'failed':
+            failed_job_ids.add(job.job_id)
+        elif result['status'] == 'deferred':
+            deferred_job_ids.add(job.job_id)
+
+    for job in jobs:
+        if job.job_id in failed_job_ids:
+            print('Job {} failed'.format(job.job_id))
+            job_queue.nack(job)
+
+        # out of quota or time, it is tried again later instead of failing
+        elif job.job_id in deferred_job_ids:
+            print('Job {} deferred for {} seconds'.format(job.job_id, defer_seconds))
+            job_queue.defer(job, defer_seconds)
+
+        else:
+            job_queue.ack(job)
+
+    return len(jobs)
+
+def run(job_queue, max_jobs=10, wait_seconds=20, idle_seconds=5, exit_when_empty=False, defer_seconds=900):
+    """
+    keep receiving and handling jobs until a stop is requested
+
+    Args:
+        job_queue:
+            object => job queue, MemoryQueue can be given for tests
+        max_jobs:
+            int => maximum number of jobs to receive at once
+        wait_seconds:
+            int => seconds to wait for jobs
+        idle_seconds:
+            int => seconds to sleep when there is no job
+        exit_when_empty:
+            bool => return when the queue is empty
+        defer_seconds:
+            int => seconds a deferred job waits before it is received again
+
+    Return:
+        None
+    """
+
+    Clients.enable_reuse()
+
+    try:
+        while not _stop_requested:
+            handled = run_once(job_queue, max_jobs, wait_seconds, defer_seconds)
+            if handled == 0:
+                if exit_when_empty:
+                    return
+                time.sleep(idle_seconds)
+    finally:
+        print_latency_report()
+        print_quota_metric()
+
+def main():
+    parser = argparse.ArgumentParser(description='Camera trap video ingestion worker')
+    parser.add_argument('--queue', choices=['sqs', 'dir'], default='sqs')
+    parser.add_argument('--queue-url', help='sqs queue url')
+    parser.add_argument('--spool-dir', help='directory of the local spool')
+    parser.add_argument('--max-jobs', type=int, default=10)
+    parser.add_argument('--wait-seconds', type=int, default=20)
+    parser.add_argument('--idle-seconds', type=int, default=5)
+    parser.add_argument('--exit-when-empty', action='store_true')
+    parser.add_argument('--defer-seconds', type=int, default=900,
+                        help='seconds a job deferred for the quota or the deadline waits, 900 at most for sqs')
+    args = parser.parse_args()
+
+    if args.queue == 'sqs' and not args.queue_url:
+        parser.error('--queue-url is required for the sqs queue')
+    if args.queue == 'dir' and not args.spool_dir:
+        parser.error('--spool-dir is required for the dir queue')
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    run(build_queue(args),
+        max_jobs=args.max_jobs,
+        wait_seconds=args.wait_seconds,
+        idle_seconds=args.idle_seconds,
+        exit_when_empty=args.exit_when_empty,
+        defer_seconds=args.defer_seconds)
+
+if __name__ == '__main__':
+    main()